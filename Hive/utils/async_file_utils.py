@@ -0,0 +1,73 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Tuple
+
+from Hive.utils.log_utils import get_logger, DEBUG
+
+logger = get_logger(__name__)
+
+DEFAULT_FILE_OPERATIONS_CONCURRENCY = 64
+
+
+async def run_file_operations_async(
+        operations: Iterable[Tuple[Callable, Tuple]], max_concurrency: int = DEFAULT_FILE_OPERATIONS_CONCURRENCY
+) -> List[object]:
+    """
+    Run blocking file operations (``stat``, ``rename``, ``copy``, ...) with bounded concurrency, using asyncio on top of a
+    thread pool: up to ``max_concurrency`` operations are in flight at once, so that the per-file latency of network
+    file systems (NFS, SMB) is overlapped. The first raised exception is propagated.
+
+    Parameters
+    ----------
+    operations :
+        Iterable of ``(function, arguments)`` tuples.
+    max_concurrency :
+        Maximum number of operations in flight. Default: ``64``.
+
+    Returns
+    -------
+        List of the operation results, in the same order as ``operations``.
+    """
+    operations = list(operations)
+    results = [None] * len(operations)
+    indexed_operations = iter(enumerate(operations))
+    loop = asyncio.get_running_loop()
+
+    with ThreadPoolExecutor(max(1, min(max_concurrency, len(operations)))) as executor:
+
+        async def run_operations():
+            # the workers share the same iterator, each one starting the next operation as soon as its own completes
+            for index, (function, arguments) in indexed_operations:
+                results[index] = await loop.run_in_executor(executor, function, *arguments)
+
+        await asyncio.gather(*[run_operations() for _ in range(max(1, min(max_concurrency, len(operations))))])
+
+    logger.log(DEBUG, "Completed {} file operations".format(len(operations)))
+    return results
+
+
+def run_file_operations(
+        operations: Iterable[Tuple[Callable, Tuple]], max_concurrency: int = DEFAULT_FILE_OPERATIONS_CONCURRENCY
+) -> List[object]:
+    """
+    Run blocking file operations with bounded concurrency, blocking until all of them are completed (see
+    :func:`run_file_operations_async`). When called from a running event loop, the operations are run in a separate
+    thread with their own event loop.
+
+    Parameters
+    ----------
+    operations :
+        Iterable of ``(function, arguments)`` tuples.
+    max_concurrency :
+        Maximum number of operations in flight. Default: ``64``.
+
+    Returns
+    -------
+        List of the operation results, in the same order as ``operations``.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run_file_operations_async(operations, max_concurrency))
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, run_file_operations_async(operations, max_concurrency)).result()
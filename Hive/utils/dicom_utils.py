@@ -0,0 +1,260 @@
+import json
+import os
+import sqlite3
+from multiprocessing import Pool
+from os import PathLike
+from pathlib import Path
+from typing import Union, List, Dict
+
+import pydicom
+from tqdm import tqdm
+
+from Hive.utils.log_utils import get_logger, DEBUG, INFO
+
+logger = get_logger(__name__)
+
+DICOM_INDEX_TAGS = [
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "Modality",
+    "ImageOrientationPatient",
+]
+
+DICOM_INDEX_COLUMNS = [
+    "patient",
+    "study",
+    "series",
+    "series_folder",
+    "patient_id",
+    "study_instance_uid",
+    "series_instance_uid",
+    "modality",
+    "image_orientation",
+    "n_files",
+    "files",
+]
+
+
+def _sorted_subfolders(folder: Union[str, PathLike]) -> List[str]:
+    with os.scandir(folder) as entries:
+        return sorted(entry.name for entry in entries if entry.is_dir())
+
+
+def read_series_header(dicom_file: Union[str, PathLike]) -> pydicom.Dataset:
+    """
+    Read the DICOM header fields needed to index a series, skipping the pixel data and all the other tags.
+
+    Parameters
+    ----------
+    dicom_file :
+        DICOM file path.
+
+    Returns
+    -------
+        DICOM dataset including only the :data:`DICOM_INDEX_TAGS` tags.
+    """
+    return pydicom.dcmread(str(dicom_file), stop_before_pixels=True, specific_tags=DICOM_INDEX_TAGS)
+
+
+def index_patient_dicom_folder(patient_dicom_folder: Union[str, PathLike]) -> List[Dict[str, object]]:
+    """
+    Index a Patient DICOM folder (structured as Study-Series), reading a single DICOM header for each series.
+
+    Parameters
+    ----------
+    patient_dicom_folder :
+        DICOM folder containing a single patient Studies.
+
+    Returns
+    -------
+        List of series records, one for each series including at least one ``.dcm`` file. Each record includes the
+        :data:`DICOM_INDEX_COLUMNS` fields.
+    """
+    patient = Path(patient_dicom_folder).name
+    series_records = []
+    for study in _sorted_subfolders(patient_dicom_folder):
+        for serie in _sorted_subfolders(Path(patient_dicom_folder).joinpath(study)):
+            series_folder = str(Path(patient_dicom_folder).joinpath(study, serie))
+            with os.scandir(series_folder) as entries:
+                files = sorted(entry.name for entry in entries if entry.name.endswith(".dcm") and entry.is_file())
+            if len(files) == 0:
+                logger.log(DEBUG, "No DICOM files found in {}: skipping series".format(series_folder))
+                continue
+            ds = read_series_header(Path(series_folder).joinpath(files[0]))
+            image_orientation = ds.get("ImageOrientationPatient", None)
+            series_records.append(
+                {
+                    "patient": patient,
+                    "study": study,
+                    "series": serie,
+                    "series_folder": series_folder,
+                    "patient_id": str(ds.get("PatientID", "")),
+                    "study_instance_uid": str(ds.get("StudyInstanceUID", "")),
+                    "series_instance_uid": str(ds.get("SeriesInstanceUID", "")),
+                    "modality": str(ds.get("Modality", "")),
+                    "image_orientation": [float(x) for x in image_orientation] if image_orientation is not None else None,
+                    "n_files": len(files),
+                    "files": files,
+                }
+            )
+    return series_records
+
+
+def _insert_series_records(connection: sqlite3.Connection, series_records: List[Dict[str, object]]):
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS series ("
+        "patient TEXT, study TEXT, series TEXT, series_folder TEXT PRIMARY KEY, patient_id TEXT, "
+        "study_instance_uid TEXT, series_instance_uid TEXT, modality TEXT, image_orientation TEXT, "
+        "n_files INTEGER, files TEXT)"
+    )
+    connection.executemany(
+        "INSERT OR REPLACE INTO series VALUES ({})".format(", ".join(["?"] * len(DICOM_INDEX_COLUMNS))),
+        [
+            [
+                json.dumps(record[column]) if column in ("image_orientation", "files") else record[column]
+                for column in DICOM_INDEX_COLUMNS
+            ]
+            for record in series_records
+        ],
+    )
+    connection.commit()
+
+
+def save_dicom_index(series_records: List[Dict[str, object]], index_file: Union[str, PathLike]):
+    """
+    Save the series records in the ``series`` table of a SQLite database. Records for the same series folder are
+    replaced.
+
+    Parameters
+    ----------
+    series_records :
+        List of series records, as returned by :func:`index_patient_dicom_folder`.
+    index_file :
+        SQLite database file.
+    """
+    connection = sqlite3.connect(str(index_file))
+    try:
+        _insert_series_records(connection, series_records)
+    finally:
+        connection.close()
+
+
+def query_dicom_index(
+        index_file: Union[str, PathLike], patient: str = None, study_instance_uid: str = None, modality: str = None
+) -> List[Dict[str, object]]:
+    """
+    Query the DICOM index, optionally filtering the series by patient folder, Study Instance UID and Modality.
+
+    Parameters
+    ----------
+    index_file :
+        SQLite database file, created with :func:`build_dicom_index`.
+    patient :
+        Optional patient folder name.
+    study_instance_uid :
+        Optional Study Instance UID.
+    modality :
+        Optional Modality.
+
+    Returns
+    -------
+        List of series records, sorted by patient, study and series folder.
+    """
+    conditions = []
+    parameters = []
+    for column, value in (("patient", patient), ("study_instance_uid", study_instance_uid), ("modality", modality)):
+        if value is not None:
+            conditions.append("{} = ?".format(column))
+            parameters.append(value)
+    query = "SELECT {} FROM series".format(", ".join(DICOM_INDEX_COLUMNS))
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY patient, study, series"
+
+    connection = sqlite3.connect(str(index_file))
+    try:
+        rows = connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+
+    series_records = []
+    for row in rows:
+        record = dict(zip(DICOM_INDEX_COLUMNS, row))
+        record["image_orientation"] = json.loads(record["image_orientation"])
+        record["files"] = json.loads(record["files"])
+        series_records.append(record)
+    return series_records
+
+
+def query_dicom_index_patients(index_file: Union[str, PathLike], modalities: List[str] = None) -> List[str]:
+    """
+    Query the DICOM index for the patient folders including at least one series for each of the given Modalities.
+
+    Parameters
+    ----------
+    index_file :
+        SQLite database file, created with :func:`build_dicom_index`.
+    modalities :
+        Optional list of required Modalities. If ``None``, all the indexed patients are returned.
+
+    Returns
+    -------
+        Sorted list of patient folder names.
+    """
+    if modalities is None or len(modalities) == 0:
+        query = "SELECT DISTINCT patient FROM series ORDER BY patient"
+        parameters = []
+    else:
+        modalities = sorted(set(modalities))
+        query = (
+            "SELECT patient FROM series WHERE modality IN ({}) GROUP BY patient "
+            "HAVING COUNT(DISTINCT modality) = ? ORDER BY patient".format(", ".join(["?"] * len(modalities)))
+        )
+        parameters = modalities + [len(modalities)]
+
+    connection = sqlite3.connect(str(index_file))
+    try:
+        rows = connection.execute(query, parameters).fetchall()
+    finally:
+        connection.close()
+    return [row[0] for row in rows]
+
+
+def build_dicom_index(
+        dicom_data_folder: Union[str, PathLike], index_file: Union[str, PathLike], num_threads: int = 1
+) -> int:
+    """
+    Build a DICOM index for a DICOM dataset (structured as Patient-Study-Series), reading the series headers in
+    parallel across patients. The index is saved as a SQLite database, to be queried with :func:`query_dicom_index`.
+
+    Parameters
+    ----------
+    dicom_data_folder :
+        DICOM dataset folder.
+    index_file :
+        SQLite database file where to save the index.
+    num_threads :
+        Number of processes used to index the patients. Default: ``1``.
+
+    Returns
+    -------
+        Number of indexed series.
+    """
+    patient_folders = [str(Path(dicom_data_folder).joinpath(patient)) for patient in _sorted_subfolders(dicom_data_folder)]
+
+    n_series = 0
+    connection = sqlite3.connect(str(index_file))
+    try:
+        _insert_series_records(connection, [])
+        with Pool(num_threads) as pool:
+            for series_records in tqdm(
+                    pool.imap_unordered(index_patient_dicom_folder, patient_folders), total=len(patient_folders)
+            ):
+                _insert_series_records(connection, series_records)
+                n_series += len(series_records)
+    finally:
+        connection.close()
+
+    logger.log(INFO, "Indexed {} series from {} patients".format(n_series, len(patient_folders)))
+    return n_series
@@ -1,23 +1,28 @@
-import SimpleITK
 import json
 import nibabel as nib
-import numpy as np
 import os
 import pydicom
 import pydicom_seg
 import random
 import shutil
-from distutils.dir_util import copy_tree
+from bisect import bisect_right
 from multiprocessing import Pool
 from os import PathLike
 from pathlib import Path
 from tqdm import tqdm
-from typing import Union, List, Tuple, Dict
+from typing import Union, List, Tuple, Dict, Optional
 
+from Hive.utils.async_file_utils import run_file_operations
+from Hive.utils.dicom_utils import index_patient_dicom_folder
+from Hive.utils.gzip_utils import save_nifti_image
 from Hive.utils.log_utils import get_logger, DEBUG, WARN, INFO
+from Hive.utils.seg_mask_utils import prepare_nndet_label_file
+from Hive.utils.volume_cache_utils import load_nifti, prefetch_volumes, read_image
 
 logger = get_logger(__name__)
 
+COPY_MODES = ("copy", "hardlink", "symlink")
+
 
 def subfiles(
         folder: Union[str, PathLike], join: bool = True, prefix: str = None, suffix: str = None, sort: bool = True
@@ -46,11 +51,12 @@ def subfiles(
         l = os.path.join  # noqa: E741
     else:
         l = lambda x, y: y  # noqa: E741, E731
-    res = [
-        l(folder, i.name)
-        for i in Path(folder).iterdir()
-        if i.is_file() and (prefix is None or i.name.startswith(prefix)) and (suffix is None or i.name.endswith(suffix))
-    ]
+    with os.scandir(folder) as entries:
+        res = [
+            l(folder, i.name)
+            for i in entries
+            if i.is_file() and (prefix is None or i.name.startswith(prefix)) and (suffix is None or i.name.endswith(suffix))
+        ]
     if sort:
         res.sort()
     return res
@@ -77,12 +83,59 @@ def subfolders(folder: Union[str, PathLike], join: bool = True, sort: bool = Tru
         l = os.path.join  # noqa: E741
     else:
         l = lambda x, y: y  # noqa: E741, E731
-    res = [l(folder, i.name) for i in Path(folder).iterdir() if i.is_dir()]
+    with os.scandir(folder) as entries:
+        res = [l(folder, i.name) for i in entries if i.is_dir()]
     if sort:
         res.sort()
     return res
 
 
+def index_dataset_folder(
+        input_data_folder: Union[str, PathLike], subjects: List[str] = None, file_extension: str = None
+) -> Dict[str, Dict[str, str]]:
+    """
+    Index a dataset folder (structured as ``<input_data_folder>/<subject>/<subject><suffix>``) in a single pass, using
+    ``os.scandir`` and the file type information cached in each ``DirEntry``. The returned index maps each subject to
+    a dictionary ``{suffix -> file path}``, where the suffix is the filename without the leading subject ID
+    (for example ``_CT.nii.gz``). Files not starting with the subject ID are not indexed.
+
+    Parameters
+    ----------
+    input_data_folder :
+        Dataset folder path.
+    subjects :
+        Optional list of subjects to index. Default: ``None``, all the subject sub-folders are indexed. Subjects without
+        a corresponding sub-folder are indexed with an empty dictionary.
+    file_extension :
+        Optional file extension, used to filter the indexed files.
+
+    Returns
+    -------
+        Dictionary mapping each subject to the corresponding ``{suffix -> file path}`` dictionary.
+    """
+    if subjects is None:
+        subjects = subfolders(input_data_folder, join=False)
+
+    dataset_index = {}
+    for subject in subjects:
+        subject_folder = os.path.join(input_data_folder, subject)
+        subject_files = {}
+        try:
+            with os.scandir(subject_folder) as entries:
+                for entry in entries:
+                    if (
+                            entry.name.startswith(subject)
+                            and (file_extension is None or entry.name.endswith(file_extension))
+                            and entry.is_file()
+                    ):
+                        subject_files[entry.name[len(subject):]] = os.path.join(subject_folder, entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            logger.log(DEBUG, "{} is not a subject folder".format(subject_folder))
+        dataset_index[subject] = subject_files
+
+    return dataset_index
+
+
 def create_nnunet_data_folder_tree(data_folder: str, task_name: str, task_id: str):
     """
     Create nnUnet folder tree, ready to be populated with the dataset.
@@ -237,7 +290,98 @@ def split_dataset(input_data_folder: Union[str, PathLike], test_split_ratio: int
     return train_subjects, test_subjects
 
 
-def copy_image_file(input_filepath: Union[str, PathLike], output_filepath: Union[str, PathLike]):
+def select_stratified_subset(
+        data_class_dict: Dict[str, str],
+        classes: List[str],
+        max_size: int = None,
+        seed: int = 0,
+        dataset_index: Dict[str, Dict[str, str]] = None,
+) -> List[str]:
+    """
+    Select a reproducible subset of subjects, given the class of each subject. The subjects belonging to ``classes``
+    are shuffled with the given seed (starting from a sorted order, so the result does not depend on the dictionary
+    ordering) and, when ``max_size`` is set, each class contributes proportionally to its size.
+
+    Parameters
+    ----------
+    data_class_dict :
+        dictionary mapping each subject ID to the corresponding class.
+    classes :
+        list of classes from where to select the subjects.
+    max_size :
+        maximum number of selected subjects. Default: ``None``, all the subjects in ``classes`` are selected.
+    seed :
+        integer value to be used as random seed.
+    dataset_index :
+        Optional dataset index, as returned by :func:`index_dataset_folder`. When given, only the indexed subjects are
+        considered for the selection.
+
+    Returns
+    -------
+        Sorted list of selected subject IDs.
+    """
+    rng = random.Random(seed)
+    class_subjects = {}
+    for subject in sorted(data_class_dict.keys()):
+        if dataset_index is not None and subject not in dataset_index:
+            continue
+        if data_class_dict[subject] in classes:
+            class_subjects.setdefault(data_class_dict[subject], []).append(subject)
+
+    n_subjects = sum(len(subjects) for subjects in class_subjects.values())
+    if max_size is None or max_size >= n_subjects:
+        return sorted(subject for subjects in class_subjects.values() for subject in subjects)
+
+    class_sizes = {}
+    remainders = []
+    for subject_class, subjects in sorted(class_subjects.items()):
+        rng.shuffle(subjects)
+        quota = len(subjects) * max_size / n_subjects
+        class_sizes[subject_class] = int(quota)
+        remainders.append((quota - int(quota), subject_class))
+
+    for _, subject_class in sorted(remainders, key=lambda x: x[0], reverse=True)[: max_size - sum(class_sizes.values())]:
+        class_sizes[subject_class] += 1
+
+    return sorted(
+        subject for subject_class, subjects in class_subjects.items() for subject in subjects[: class_sizes[subject_class]]
+    )
+
+
+def materialize_file(
+        input_filepath: Union[str, PathLike], output_filepath: Union[str, PathLike], copy_mode: str = "copy"
+) -> Union[str, PathLike]:
+    """
+    Materialize a file at the output location, either copying it, or creating a hardlink or a symlink to the input file.
+    Existing output files are replaced.
+
+    Parameters
+    ----------
+    input_filepath :
+        file path for the file to materialize
+    output_filepath :
+        file path where to materialize the file
+    copy_mode :
+        one of ``"copy"``, ``"hardlink"`` and ``"symlink"``. Default: ``"copy"``.
+
+    Returns
+    -------
+        Output file path.
+    """
+    if copy_mode not in COPY_MODES:
+        raise ValueError("Copy mode must be one of {}, got '{}'".format(COPY_MODES, copy_mode))
+    if copy_mode == "copy":
+        return shutil.copy2(input_filepath, output_filepath)
+    if os.path.lexists(output_filepath):
+        os.remove(output_filepath)
+    if copy_mode == "hardlink":
+        os.link(input_filepath, output_filepath)
+    else:
+        os.symlink(os.path.abspath(input_filepath), output_filepath)
+    return output_filepath
+
+
+def copy_image_file(input_filepath: Union[str, PathLike], output_filepath: Union[str, PathLike], copy_mode: str = "copy"):
     """
     Copy image file.
 
@@ -247,11 +391,16 @@ def copy_image_file(input_filepath: Union[str, PathLike], output_filepath: Union
         file path for the file to copy
     output_filepath :
         file path where to copy the file
+    copy_mode :
+        one of ``"copy"``, ``"hardlink"`` and ``"symlink"``. Default: ``"copy"``.
     """
-    shutil.copy(
-        input_filepath,
-        output_filepath,
-    )
+    if copy_mode == "copy":
+        shutil.copy(
+            input_filepath,
+            output_filepath,
+        )
+    else:
+        materialize_file(input_filepath, output_filepath, copy_mode)
 
 
 def copy_label_file(input_image: Union[str, PathLike], input_label: Union[str, PathLike],
@@ -264,15 +413,15 @@ def copy_label_file(input_image: Union[str, PathLike], input_label: Union[str, P
     input_image :
         file path for the input image, to be used as reference when copying image information
     input_label :
-        file path for the input label to be copied
+        file path for the input label to be copied, or NIFTI image already loaded
     output_filepath :
         file location where to save the label image
     """
-    label_nib = nib.load(input_label)
-    image_nib = nib.load(input_image)
+    label_nib = load_nifti(input_label)
+    image_nib = load_nifti(input_image)
 
     label_nib_out = nib.Nifti1Image(label_nib.get_fdata(), image_nib.affine)
-    nib.save(label_nib_out, output_filepath)
+    save_nifti_image(label_nib_out, output_filepath)
 
 
 def copy_data_to_dataset_folder(
@@ -283,6 +432,9 @@ def copy_data_to_dataset_folder(
         label_folder: Union[str, PathLike] = None,
         num_threads: int = None,
         save_label_instance_config: bool = False,
+        dataset_index: Dict[str, Dict[str, str]] = None,
+        copy_mode: str = "copy",
+        semantic_labels: bool = False,
 ):
     """
 
@@ -301,10 +453,20 @@ def copy_data_to_dataset_folder(
         folder path where to store labels (labelsTr/labelsTs). Default: ``None``.
         If **label_suffix** is ``None``, the label files are not saved.
     num_threads :
-        number of threads to use in multiprocessing ( Default: ``os.environ['N_THREADS']`` )
+        number of threads to use in multiprocessing ( Default: ``os.environ['N_THREADS']`` ). With a single thread, the
+        label volumes are prefetched in background (see :func:`Hive.utils.volume_cache_utils.prefetch_volumes`).
     save_label_instance_config :
         Flag to save label mask together with an instance dictionary as JSON file. NOTE: All the instances are assigned
-         to instance class ``1``.
+         to instance class ``1``. Each label is decoded once, with :func:`prepare_nndet_label_file`.
+    dataset_index :
+        Optional dataset index, as returned by :func:`index_dataset_folder`. If ``None``, the index is created by scanning
+        the subject folders once.
+    copy_mode :
+        How the image files are materialized in the image folder: ``"copy"``, ``"hardlink"`` or ``"symlink"``.
+        Label files are always re-written, using the image affine. Default: ``"copy"``.
+    semantic_labels :
+        Flag to convert semantic label masks into instance masks (one class for each semantic label) when saving the
+        instance dictionary. Default: ``False``.
     """
     label_suffix = str(config_dict["label_suffix"])
     if num_threads is None:
@@ -314,15 +476,14 @@ def copy_data_to_dataset_folder(
             logger.warning("N_THREADS is not set as environment variable. Using Default [1]")
             num_threads = 1
 
-    pool = Pool(num_threads)
-    copied_files = []
+    if dataset_index is None:
+        dataset_index = index_dataset_folder(input_data_folder, subjects, file_extension=str(config_dict["FileExtension"]))
+
+    label_jobs = []
+    image_copies = []
     for directory in subjects:
 
-        files = subfiles(
-            str(Path(input_data_folder).joinpath(directory)),
-            join=False,
-            suffix=str(config_dict["FileExtension"]),
-        )
+        files = dataset_index.get(directory, {})
 
         image_suffix_list = config_dict["Modalities"].keys()
 
@@ -330,17 +491,16 @@ def copy_data_to_dataset_folder(
             modality_code = "_{0:04d}".format(modality)
             image_filename = directory + image_suffix
 
-            if image_filename in files:
+            if image_suffix in files:
                 updated_image_filename = image_filename.replace(image_suffix,
                                                                 modality_code + str(config_dict["FileExtension"]))
-                copied_files.append(
-                    pool.starmap_async(
+                image_copies.append(
+                    (
                         copy_image_file,
                         (
-                            (
-                                str(Path(input_data_folder).joinpath(directory, image_filename)),
-                                str(Path(image_folder).joinpath(updated_image_filename)),
-                            ),
+                            files[image_suffix],
+                            str(Path(image_folder).joinpath(updated_image_filename)),
+                            copy_mode,
                         ),
                     )
                 )
@@ -350,34 +510,34 @@ def copy_data_to_dataset_folder(
 
             label_filename = directory + label_suffix
 
-            if label_filename in files:
+            if label_suffix in files:
 
                 updated_label_filename = label_filename.replace(label_suffix, str(config_dict["FileExtension"]))
 
-                copied_files.append(
-                    pool.starmap_async(
-                        copy_label_file,
+                if save_label_instance_config:
+                    label_jobs.append(
                         (
+                            prepare_nndet_label_file,
                             (
                                 str(Path(input_data_folder).joinpath(directory, directory + image_suffix)),
-                                str(Path(input_data_folder).joinpath(directory, directory + label_suffix)),
+                                files[label_suffix],
                                 str(Path(label_folder).joinpath(updated_label_filename)),
+                                str(Path(label_folder).joinpath(label_filename.replace(label_suffix, ".json"))),
+                                semantic_labels,
                             ),
-                        ),
+                        )
                     )
-                )
-                if save_label_instance_config:
-                    label_map = SimpleITK.GetArrayFromImage(
-                        SimpleITK.ReadImage(str(Path(input_data_folder).joinpath(directory, directory + label_suffix)))
+                else:
+                    label_jobs.append(
+                        (
+                            copy_label_file,
+                            (
+                                str(Path(input_data_folder).joinpath(directory, directory + image_suffix)),
+                                files[label_suffix],
+                                str(Path(label_folder).joinpath(updated_label_filename)),
+                            ),
+                        )
                     )
-                    instances = np.unique(label_map)
-                    instances = instances[instances > 0]
-
-                    json_dict = {
-                        "instances": {str(int(i)): 0 for i in instances},
-                    }
-                    save_config_json(json_dict,
-                                     str(Path(label_folder).joinpath(label_filename.replace(label_suffix, ".json"))))
             else:
                 logger.warning("{} is not found: skipping {} case".format(label_filename, directory))
 
@@ -386,27 +546,38 @@ def copy_data_to_dataset_folder(
                 task_code = "_{0:04d}".format(task_id)
                 label_filename = directory + label_s
 
-                if label_filename in files:
+                if label_s in files:
 
                     updated_label_filename = label_filename.replace(label_s,
                                                                     task_code + str(config_dict["FileExtension"]))
 
-                    copied_files.append(
-                        pool.starmap_async(
+                    label_jobs.append(
+                        (
                             copy_label_file,
                             (
-                                (
-                                    str(Path(input_data_folder).joinpath(directory, directory + image_suffix)),
-                                    str(Path(input_data_folder).joinpath(directory, directory + label_s)),
-                                    str(Path(label_folder).joinpath(updated_label_filename)),
-                                ),
+                                str(Path(input_data_folder).joinpath(directory, directory + image_suffix)),
+                                files[label_s],
+                                str(Path(label_folder).joinpath(updated_label_filename)),
                             ),
                         )
                     )
                 else:
                     logger.warning("{} is not found: skipping {} case".format(label_filename, directory))
 
-    _ = [i.get() for i in tqdm(copied_files)]
+    if num_threads > 1:
+        # the image files are copied with concurrent file operations, while the label files are processed in the pool
+        with Pool(num_threads) as pool:
+            copied_files = [pool.apply_async(function, arguments) for function, arguments in label_jobs]
+            run_file_operations(image_copies, num_threads)
+            _ = [i.get() for i in tqdm(copied_files)]
+    else:
+        run_file_operations(image_copies, num_threads)
+        # the label volumes of the next cases are read in background while the current one is processed
+        label_volumes = prefetch_volumes(
+            (label_job_id, {"label": arguments[1]}) for label_job_id, (_, arguments) in enumerate(label_jobs)
+        )
+        for (function, arguments), (_, volumes) in tqdm(zip(label_jobs, label_volumes), total=len(label_jobs)):
+            function(arguments[0], volumes["label"], *arguments[2:])
 
 
 def save_config_json(config_dict: Dict[str, object], output_json: Union[str, PathLike]):
@@ -488,25 +659,132 @@ def generate_dataset_json(
     save_config_json(json_dict, output_file)
 
 
-def remove_empty_folder_recursive(folder_path: Union[str, PathLike]):
+def longest_prefix_match(sorted_prefixes: List[str], name: str) -> Optional[str]:
     """
-    Recursively removes all the empty subdirectories of the root folder.
+    Find the longest prefix of ``name`` in a sorted list of prefixes, using bisection. When the closest candidate is
+    not a prefix, the search key is shortened to the common prefix between the candidate and the key, so every
+    iteration strictly reduces the key length.
 
     Parameters
     ----------
-    folder_path :
-        Root folder path.
+    sorted_prefixes :
+        Sorted list of prefixes (e.g. Patient IDs).
+    name :
+        String to match.
+
+    Returns
+    -------
+        Longest matching prefix, or ``None`` if no prefix matches.
+    """
+    key = name
+    while key:
+        idx = bisect_right(sorted_prefixes, key)
+        if idx == 0:
+            return None
+        candidate = sorted_prefixes[idx - 1]
+        if key.startswith(candidate):
+            return candidate
+        key = os.path.commonprefix([candidate, key])
+    return None
+
+
+def move_files(file_moves: List[Tuple[str, str]], num_threads: int = 1):
+    """
+    Move files with ``os.rename``. When ``num_threads`` is greater than 1, up to ``num_threads`` moves are in flight at
+    once (see :func:`Hive.utils.async_file_utils.run_file_operations`), to hide the per-file latency of network file
+    systems.
+
+    Parameters
+    ----------
+    file_moves :
+        List of ``(source file, target file)`` tuples.
+    num_threads :
+        Maximum number of concurrent moves. Default: ``1``.
     """
-    for subfolder_path in Path(folder_path).glob("*"):
-        if Path(subfolder_path).is_dir():
-            try:
-                os.rmdir(subfolder_path)
-            except FileNotFoundError as e:
-                logger.log(WARN, e)
-            except OSError as e:
-                logger.log(WARN, e)
-                remove_empty_folder_recursive(subfolder_path)
-                os.rmdir(subfolder_path)
+    if num_threads > 1 and len(file_moves) > 1:
+        run_file_operations([(os.rename, file_move) for file_move in file_moves], num_threads)
+    else:
+        for source_file, target_file in file_moves:
+            os.rename(source_file, target_file)
+
+
+def plan_data_in_single_folder(
+        root_path: Union[str, PathLike],
+        output_path: Union[str, PathLike],
+        assign_parent_dir_name: bool = False,
+        file_extension: str = "",
+) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """
+    Plan the moves needed to collect the entries of the root directory sub-folders into the output folder, scanning
+    each folder only once. The entries at depth 2 (``<root_path>/<folder>/<entry>``) are moved, or, if
+    *assign_parent_dir_name* is set, the entries at depth 3 (``<root_path>/<folder>/<subfolder>/<entry>``), with the
+    parent directory name appended as suffix. Entries are moved as they are: sub-folders at the selected depth are
+    moved with their content, and files at lower depths are left in place. Collisions (two entries mapped to the same
+    target, or a target already existing) are detected before anything is moved.
+
+    Parameters
+    ----------
+    root_path   :
+        Root folder.
+    output_path :
+        Output folder. If the output folder is a sub-folder of the root folder, it is excluded from the scan.
+    assign_parent_dir_name  :
+        Flag to set if to assign the parent directory name as suffix.
+    file_extension  :
+        File extension for the files in the selected folder.
+
+    Returns
+    -------
+        List of ``(source, target)`` moves and list of the sub-folders that will be empty once the moves are
+        completed, ordered bottom-up.
+
+    Raises
+    ------
+    FileExistsError
+        If any target filename collides with another target or with an existing file.
+    """
+    root_path = os.path.abspath(root_path)
+    output_path = os.path.abspath(output_path)
+    file_moves = []
+    empty_folders = []
+
+    def get_target_filename(filename: str, parent_folder: str) -> str:
+        if not assign_parent_dir_name:
+            return filename
+        if file_extension and filename.endswith(file_extension):
+            filename = filename[: -len(file_extension)]
+        return filename + "_" + os.path.basename(parent_folder) + file_extension
+
+    def plan_folder(folder: str, depth: int) -> bool:
+        # returns True if the folder is left empty once the planned moves are completed
+        n_kept_entries = 0
+        with os.scandir(folder) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.path == output_path:
+                n_kept_entries += 1
+            elif depth == 1:
+                file_moves.append((entry.path, os.path.join(output_path, get_target_filename(entry.name, folder))))
+            elif entry.is_dir(follow_symlinks=False) and plan_folder(entry.path, depth - 1):
+                empty_folders.append(entry.path)
+            else:
+                n_kept_entries += 1
+        return n_kept_entries == 0
+
+    plan_folder(root_path, 3 if assign_parent_dir_name else 2)
+
+    target_sources = {}
+    collisions = []
+    for source_file, target_file in file_moves:
+        if target_file in target_sources or os.path.lexists(target_file):
+            collisions.append("'{}' -> '{}'".format(source_file, target_file))
+        target_sources[target_file] = source_file
+    if len(collisions) > 0:
+        raise FileExistsError(
+            "{} target files collide with other files, no file was moved: {}".format(len(collisions), collisions[:10])
+        )
+
+    return file_moves, empty_folders
 
 
 def order_data_in_single_folder(
@@ -514,12 +792,17 @@ def order_data_in_single_folder(
         output_path: Union[str, PathLike],
         assign_parent_dir_name: bool = False,
         file_extension: str = "",
-):
+        num_threads: int = 1,
+        dry_run: bool = False,
+) -> List[Tuple[str, str]]:
     """
-    Moves all the sub-files, found iteratively from the root directory, to the output folder.
-    Recursively removes all the empty subdirectories.
-    If the *assign_parent_dir_name* flag is set to True, the parent directory name for each file will be used as suffix
-    appended to the filename (used when images and masks are divided in different subfolders).
+    Moves all the entries of the root directory sub-folders (``<root_path>/<folder>/<entry>``) to the output folder.
+    Removes all the subdirectories left empty, bottom-up.
+    If the *assign_parent_dir_name* flag is set to True, the entries one level deeper
+    (``<root_path>/<folder>/<subfolder>/<entry>``) are moved instead, and the parent directory name for each entry will
+    be used as suffix appended to the filename (used when images and masks are divided in different subfolders).
+    All the moves are planned in advance (see :func:`plan_data_in_single_folder`), and no file is moved if any
+    collision is found.
 
     Parameters
     ----------
@@ -531,44 +814,44 @@ def order_data_in_single_folder(
         Root folder.
     output_path :
         Output folder.
+    num_threads :
+        Number of threads used to move the files. Default: ``1``.
+    dry_run :
+        If set to ``True``, the planned moves are logged and no file is moved. Default: ``False``.
+
+    Returns
+    -------
+        List of the planned ``(source file, target file)`` moves.
     """
+    file_moves, empty_folders = plan_data_in_single_folder(root_path, output_path, assign_parent_dir_name, file_extension)
+
+    if dry_run:
+        for source_file, target_file in file_moves:
+            logger.log(INFO, "Moving '{}' file to '{}'".format(source_file, target_file))
+        for folder in empty_folders:
+            logger.log(INFO, "Removing empty folder '{}'".format(folder))
+        return file_moves
+
     logger.log(DEBUG, "Creating folder at '{}'".format(output_path))
-    search_regex = "*/*"
-    if assign_parent_dir_name:
-        search_regex = "*/*/*"
-
-    for file_path in Path(root_path).glob(search_regex):
-        if assign_parent_dir_name:
-
-            logger.log(
-                DEBUG,
-                "Moving '{}' file to '{}'".format(
-                    file_path,
-                    Path(output_path).joinpath(
-                        str(Path(file_path).name[: -len(file_extension)])
-                        + "_"
-                        + str(Path(file_path).parent.name)
-                        + file_extension
-                    ),
-                ),
-            )
-            Path(file_path).rename(
-                Path(output_path).joinpath(
-                    str(Path(file_path).name[: -len(file_extension)]) + "_" + str(
-                        Path(file_path).parent.name) + file_extension
-                )
-            )
-        else:
-            logger.log(DEBUG,
-                       "Moving '{}' file to '{}'".format(file_path, Path(output_path).joinpath(Path(file_path).name)))
-            Path(file_path).rename(Path(output_path).joinpath(Path(file_path).name))
-    remove_empty_folder_recursive(root_path)
+    Path(output_path).mkdir(parents=True, exist_ok=True)
+
+    logger.log(DEBUG, "Moving {} files to '{}'".format(len(file_moves), output_path))
+    move_files(file_moves, num_threads)
 
+    for folder in empty_folders:
+        try:
+            os.rmdir(folder)
+        except OSError as e:
+            logger.log(WARN, e)
+
+    return file_moves
 
-def order_data_folder_by_patient(folder_path: Union[str, PathLike], file_pattern: str):
+
+def order_data_folder_by_patient(folder_path: Union[str, PathLike], file_pattern: str, num_threads: int = 1):
     """
     Order all the files in the root folder into corresponding subdirectories, according to the specified
-    file pattern.
+    file pattern. Each file is assigned to the Patient ID corresponding to the longest matching prefix, so
+    Patient IDs that are prefixes of each other (e.g. ``P1`` and ``P10``) are correctly separated.
 
     Parameters
     ----------
@@ -576,37 +859,116 @@ def order_data_folder_by_patient(folder_path: Union[str, PathLike], file_pattern
         Root folder path.
     file_pattern    :
         File pattern to group the files and create the corresponding subdirectories.
+    num_threads :
+        Maximum number of concurrent file operations (folder creations and moves). Default: ``1``.
     """
-    patient_id_list = []
-    for file_path in Path(folder_path).glob("*"):
-        if Path(file_path).is_file() and str(file_path).endswith(file_pattern):
-            patient_id_list.append(str(file_path.name)[: -len(file_pattern)])
+    with os.scandir(folder_path) as entries:
+        filenames = [entry.name for entry in entries if entry.is_file()]
+
+    patient_id_list = sorted({filename[: -len(file_pattern)] for filename in filenames if filename.endswith(file_pattern)})
 
     logger.log(INFO, "Patient folders in database: {}".format(len(patient_id_list)))
 
-    for patient_id in patient_id_list:
-        logger.log(DEBUG, "Creating folder at '{}'".format(Path(folder_path).joinpath(patient_id)))
-        Path(folder_path).joinpath(patient_id).mkdir(exist_ok=True, parents=True)
+    file_moves = []
+    for filename in filenames:
+        patient_id = longest_prefix_match(patient_id_list, filename)
+        if patient_id is not None:
+            file_moves.append(
+                (os.path.join(folder_path, filename), os.path.join(folder_path, patient_id, filename))
+            )
+
+    logger.log(DEBUG, "Creating {} patient folders at '{}'".format(len(patient_id_list), folder_path))
+    run_file_operations(
+        [(_make_folder, (os.path.join(folder_path, patient_id),)) for patient_id in patient_id_list], num_threads
+    )
 
-    for file_path in Path(folder_path).glob("*"):
-        if Path(file_path).is_file():
-            for patient_id in patient_id_list:
+    logger.log(DEBUG, "Moving {} files to the patient folders".format(len(file_moves)))
+    move_files(file_moves, num_threads)
+
+
+def _make_folder(folder_path: str):
+    os.makedirs(folder_path, exist_ok=True)
+
+
+def _plan_folder_tree_copy(
+        input_folder: Union[str, PathLike], output_folder: Union[str, PathLike], copy_mode: str = "copy"
+) -> Tuple[List[str], List[Tuple[str, str, str]]]:
+    # symlinked sub-folders are followed, and their content is copied, as done by shutil.copytree
+    output_folders = []
+    file_copies = []
+    for dirpath, _, filenames in os.walk(input_folder, followlinks=True):
+        output_dirpath = os.path.join(output_folder, os.path.relpath(dirpath, input_folder))
+        output_folders.append(output_dirpath)
+        for filename in filenames:
+            file_copies.append((os.path.join(dirpath, filename), os.path.join(output_dirpath, filename), copy_mode))
+    return output_folders, file_copies
 
-                if file_path.name.startswith(patient_id):
-                    logger.log(
-                        DEBUG,
-                        "Moving '{}' file to '{}'".format(
-                            file_path, Path(folder_path).joinpath(patient_id, Path(file_path).name)
-                        ),
-                    )
-                    Path(file_path).rename(Path(folder_path).joinpath(patient_id, Path(file_path).name))
+
+def _is_file_unchanged(input_filepath: str, output_filepath: str) -> bool:
+    try:
+        output_stat = os.stat(output_filepath)
+    except FileNotFoundError:
+        return False
+    input_stat = os.stat(input_filepath)
+    return input_stat.st_size == output_stat.st_size and int(input_stat.st_mtime) == int(output_stat.st_mtime)
+
+
+def _sync_file(file_copy: Tuple[str, str, str]) -> bool:
+    input_filepath, output_filepath, copy_mode = file_copy
+    if _is_file_unchanged(input_filepath, output_filepath):
+        return False
+    materialize_file(input_filepath, output_filepath, copy_mode)
+    return True
+
+
+def sync_folder_tree(
+        input_folder: Union[str, PathLike], output_folder: Union[str, PathLike], num_threads: int = 1, copy_mode: str = "copy"
+) -> int:
+    """
+    Incrementally copy a folder tree into the output folder. Files already present in the output folder, with the same
+    size and modification time as the input files, are skipped. Up to ``num_threads`` file operations (``stat`` and
+    copy) are in flight at once (see :func:`Hive.utils.async_file_utils.run_file_operations`).
+
+    Parameters
+    ----------
+    input_folder :
+        Input folder.
+    output_folder :
+        Output folder.
+    num_threads :
+        Maximum number of concurrent file operations. Default: ``1``.
+    copy_mode :
+        How the files are materialized in the output folder: ``"copy"``, ``"hardlink"`` or ``"symlink"``.
+        Default: ``"copy"``. Copies preserve the modification time, so they are skipped in the following runs.
+
+    Returns
+    -------
+        Number of copied files.
+    """
+    output_folders, file_copies = _plan_folder_tree_copy(input_folder, output_folder, copy_mode)
+    run_file_operations([(_make_folder, (output_dirpath,)) for output_dirpath in output_folders], num_threads)
+    copied_files = sum(run_file_operations([(_sync_file, (file_copy,)) for file_copy in file_copies], num_threads))
+
+    logger.log(
+        DEBUG, "Copied {} files, {} unchanged files skipped, to '{}'".format(
+            copied_files, len(file_copies) - copied_files, output_folder
+        )
+    )
+    return copied_files
 
 
 def copy_subject_folder_to_data_folder(
-        input_data_folder: Union[str, PathLike], subjects: List[str], data_folder: Union[str, PathLike]
+        input_data_folder: Union[str, PathLike],
+        subjects: List[str],
+        data_folder: Union[str, PathLike],
+        num_threads: int = 1,
+        copy_mode: str = "copy",
+        dataset_index: Dict[str, Dict[str, str]] = None,
 ):
     """
-    Copy all the specified subject sub-folders to a new data folder.
+    Copy all the specified subject sub-folders to a new data folder. The subject folder trees are walked first
+    (following symlinked sub-folders), and then up to ``num_threads`` folder creations, followed by the file copies,
+    are in flight at once (see :func:`Hive.utils.async_file_utils.run_file_operations`).
 
     Parameters
     ----------
@@ -616,12 +978,113 @@ def copy_subject_folder_to_data_folder(
         Subjects to copy.
     data_folder :
         Destination data folder.
+    num_threads :
+        Maximum number of concurrent file copies. Default: ``1``.
+    copy_mode :
+        How the files are materialized in the destination folder: ``"copy"``, ``"hardlink"`` or ``"symlink"``.
+        Default: ``"copy"``.
+    dataset_index :
+        Optional dataset index of ``input_data_folder``, as returned by :func:`index_dataset_folder`, used to look up the
+        available subjects without listing the input data folder again. The subject folder trees are still walked, since
+        the index only covers the files at the top level of each subject folder.
     """
     Path(data_folder).mkdir(parents=True, exist_ok=True)
+    if dataset_index is not None:
+        available_subjects = set(dataset_index.keys())
+    else:
+        available_subjects = set(subfolders(input_data_folder, join=False))
+    output_folders = []
+    file_copies = []
     for subject in subjects:
-        if Path(input_data_folder).joinpath(subject).is_dir():
+        if subject in available_subjects:
             logger.log(DEBUG, "Copying Subject {}".format(subject))
-            copy_tree(str(Path(input_data_folder).joinpath(subject)), str(Path(data_folder).joinpath(subject)))
+            subject_folders, subject_file_copies = _plan_folder_tree_copy(
+                os.path.join(input_data_folder, subject), os.path.join(data_folder, subject), copy_mode
+            )
+            output_folders.extend(subject_folders)
+            file_copies.extend(subject_file_copies)
+
+    run_file_operations([(_make_folder, (output_dirpath,)) for output_dirpath in output_folders], num_threads)
+    run_file_operations([(materialize_file, file_copy) for file_copy in file_copies], num_threads)
+
+
+def create_dicom_seg_writer(template_file: Union[str, PathLike]) -> pydicom_seg.MultiClassWriter:
+    """
+    Create the ``pydicom_seg`` writer used to save the NIFTI predictions as DICOM SEG files.
+
+    Parameters
+    ----------
+    template_file :
+        Template JSON file for the prediction model/algorithm used. Generated from : http://qiicr.org/dcmqi/#/home
+
+    Returns
+    -------
+        DICOM SEG Multi-class writer.
+    """
+    template = pydicom_seg.template.from_dcmqi_metainfo(str(template_file))
+    return pydicom_seg.MultiClassWriter(
+        template=template,
+        inplane_cropping=False,
+        skip_empty_slices=False,
+        skip_missing_segment=False,
+    )
+
+
+def get_source_series_files(
+        series_records: List[Dict[str, object]], study_instance_uid: str = None, study: str = None
+) -> Optional[List[str]]:
+    """
+    Returns the DICOM files of the first non-SEG series in the given study, selected by Study Instance UID or by study
+    folder name.
+
+    Parameters
+    ----------
+    series_records :
+        List of series records, as returned by :func:`Hive.utils.dicom_utils.query_dicom_index`.
+    study_instance_uid :
+        Optional Study Instance UID.
+    study :
+        Optional study folder name.
+
+    Returns
+    -------
+        List of DICOM file paths, or ``None`` if no series is found.
+    """
+    for series_record in series_records:
+        if series_record["modality"] == "SEG":
+            continue
+        if study_instance_uid is not None and series_record["study_instance_uid"] != study_instance_uid:
+            continue
+        if study is not None and series_record["study"] != study:
+            continue
+        return [str(Path(series_record["series_folder"]).joinpath(file)) for file in series_record["files"]]
+    return None
+
+
+def write_nifti_pred_as_dicom_seg(
+        nifti_pred_file: Union[str, PathLike],
+        source_dicom_files: List[str],
+        writer: pydicom_seg.MultiClassWriter,
+        output_dicom_seg: Union[str, PathLike],
+):
+    """
+    Save a NIFTI prediction file (segmentation mask) as DICOM SEG file, referencing the given source DICOM series.
+
+    Parameters
+    ----------
+    nifti_pred_file :
+        NIFTI prediction file (segmentation mask) to convert.
+    source_dicom_files :
+        DICOM files of the source series. Only the DICOM headers are read.
+    writer :
+        DICOM SEG writer, as returned by :func:`create_dicom_seg_writer`.
+    output_dicom_seg :
+        Output DICOM SEG file to save.
+    """
+    segmentation = read_image(nifti_pred_file)
+    source_images = [pydicom.dcmread(x, stop_before_pixels=True) for x in source_dicom_files]
+    dcm = writer.write(segmentation, source_images)
+    dcm.save_as(str(output_dicom_seg))
 
 
 def convert_nifti_pred_to_dicom_seg(
@@ -630,6 +1093,8 @@ def convert_nifti_pred_to_dicom_seg(
         template_file: Union[str, PathLike],
         output_dicom_seg: Union[str, PathLike],
         study_id,
+        series_records: List[Dict[str, object]] = None,
+        writer: pydicom_seg.MultiClassWriter = None,
 ):
     """
     Convert a NIFTI prediction file (segmentation mask), into a single DICOM SEG file. ``patient_dicom_folder`` and
@@ -647,30 +1112,73 @@ def convert_nifti_pred_to_dicom_seg(
         Template JSON file for the prediction model/algorithm used. Generated from : http://qiicr.org/dcmqi/#/home
     output_dicom_seg :
         Output DICOM SEG file to save.
+    series_records :
+        Optional list of series records for the patient, as returned by
+        :func:`Hive.utils.dicom_utils.query_dicom_index`. If ``None``, the patient folder is indexed reading one DICOM
+        header for each series.
+    writer :
+        Optional DICOM SEG writer, as returned by :func:`create_dicom_seg_writer`. If ``None``, the writer is created
+        from ``template_file``.
     """
-    segmentation = SimpleITK.ReadImage(nifti_pred_file)
-    reader = SimpleITK.ImageSeriesReader()
+    if series_records is None:
+        series_records = index_patient_dicom_folder(patient_dicom_folder)
 
-    studies = subfolders(Path(patient_dicom_folder), join=False)
+    dcm_files = get_source_series_files(series_records, study_instance_uid=study_id)
+    if dcm_files is None:
+        raise ValueError("No source DICOM series found for Study {} in {}".format(study_id, patient_dicom_folder))
 
-    dcm_files = None
-    for study in studies:
-        series = subfolders(Path(patient_dicom_folder).joinpath(studies[0]), join=False)
-        for serie in series:
-            first_file = next(Path(patient_dicom_folder).joinpath(studies[0], serie).glob("*.dcm"))
-            ds = pydicom.dcmread(str(first_file))
-            if ds.Modality != "SEG" and ds.StudyInstanceUID == study_id and dcm_files is None:
-                dcm_files = reader.GetGDCMSeriesFileNames(str(Path(patient_dicom_folder).joinpath(study, serie)))
+    if writer is None:
+        writer = create_dicom_seg_writer(template_file)
 
-    template = pydicom_seg.template.from_dcmqi_metainfo(template_file)
-    writer = pydicom_seg.MultiClassWriter(
-        template=template,
-        inplane_cropping=False,
-        skip_empty_slices=False,
-        skip_missing_segment=False,
-    )
+    write_nifti_pred_as_dicom_seg(nifti_pred_file, dcm_files, writer, output_dicom_seg)
 
-    source_images = [pydicom.dcmread(x, stop_before_pixels=True) for x in dcm_files]
-    dcm = writer.write(segmentation, source_images)
 
-    dcm.save_as(output_dicom_seg)
+_DICOM_SEG_WRITER = None
+
+
+def _init_dicom_seg_writer(template_file: str):
+    global _DICOM_SEG_WRITER
+    _DICOM_SEG_WRITER = create_dicom_seg_writer(template_file)
+
+
+def _export_dicom_seg_job(export_job: Dict[str, object]) -> Tuple[Dict[str, object], Optional[str]]:
+    try:
+        write_nifti_pred_as_dicom_seg(
+            export_job["nifti_pred_file"], export_job["source_dicom_files"], _DICOM_SEG_WRITER, export_job["output_dicom_seg"]
+        )
+    except Exception as e:
+        return export_job, "{!r}".format(e)
+    return export_job, None
+
+
+def export_nifti_preds_to_dicom_seg(
+        export_jobs: List[Dict[str, object]], template_file: Union[str, PathLike], num_threads: int = 1
+) -> List[str]:
+    """
+    Convert a list of NIFTI prediction files into DICOM SEG files, in parallel. The DICOM SEG template is loaded once
+    for each worker process. Failed conversions are logged and skipped.
+
+    Parameters
+    ----------
+    export_jobs :
+        List of export jobs. Each job is a dictionary including the ``nifti_pred_file`` to convert, the
+        ``source_dicom_files`` of the referenced series (see :func:`get_source_series_files`) and the
+        ``output_dicom_seg`` file.
+    template_file :
+        Template JSON file for the prediction model/algorithm used. Generated from : http://qiicr.org/dcmqi/#/home
+    num_threads :
+        Number of worker processes. Default: ``1``.
+
+    Returns
+    -------
+        List of the saved DICOM SEG files.
+    """
+    exported_files = []
+    with Pool(num_threads, initializer=_init_dicom_seg_writer, initargs=(str(template_file),)) as pool:
+        for export_job, error in tqdm(pool.imap_unordered(_export_dicom_seg_job, export_jobs), total=len(export_jobs)):
+            if error is not None:
+                logger.warning("DICOM SEG export of {} failed: {}".format(export_job["nifti_pred_file"], error))
+                continue
+            exported_files.append(str(export_job["output_dicom_seg"]))
+    logger.log(INFO, "Exported {} of {} predictions as DICOM SEG".format(len(exported_files), len(export_jobs)))
+    return exported_files
@@ -0,0 +1,499 @@
+import json
+import math
+from multiprocessing import Pool
+from os import PathLike
+from pathlib import Path
+from typing import Union, Dict, List, Tuple, Optional
+
+import numpy as np
+from scipy.ndimage import generate_binary_structure
+from tqdm import tqdm
+
+from Hive.utils.log_utils import get_logger, DEBUG
+from Hive.utils.seg_mask_utils import label_components
+from Hive.utils.volume_cache_utils import load_nifti, prefetch_volumes
+
+logger = get_logger(__name__)
+
+FINGERPRINT_PERCENTILES = (0.5, 1, 5, 25, 50, 75, 95, 99, 99.5)
+DEFAULT_INTENSITY_RANGE = (-1e5, 1e5)
+MAX_HISTOGRAM_BINS = 10**9
+
+
+def compute_histogram(
+        values: np.ndarray, bin_width: float, intensity_range: Tuple[float, float] = DEFAULT_INTENSITY_RANGE
+) -> Tuple[int, np.ndarray]:
+    """
+    Compute a mergeable histogram, with fixed-width bins aligned to multiples of ``bin_width``. Only the values in
+    ``intensity_range`` are counted (non-finite and out-of-range values are ignored), and only the bins between
+    the minimum and the maximum counted value are stored, as an offset (index of the first bin) and a count array.
+
+    Parameters
+    ----------
+    values :
+        Values to count.
+    bin_width :
+        Bin width.
+    intensity_range :
+        Minimum and maximum value to count. Default: ``(-1e5, 1e5)``.
+
+    Returns
+    -------
+        Index of the first bin and bin counts.
+    """
+    # NaN comparisons are False: non-finite values are excluded with the out-of-range ones
+    values = values[(values >= intensity_range[0]) & (values <= intensity_range[1])]
+    if values.size == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+    bins = np.floor(values / bin_width).astype(np.int64)
+    offset = int(bins.min())
+    return offset, np.bincount(bins - offset).astype(np.int64)
+
+
+def merge_histograms(histograms: List[Tuple[int, np.ndarray]]) -> Tuple[int, np.ndarray]:
+    """
+    Merge histograms computed with :func:`compute_histogram` with the same bin width.
+
+    Parameters
+    ----------
+    histograms :
+        List of histograms, as (first bin index, bin counts).
+
+    Returns
+    -------
+        Merged histogram, as (first bin index, bin counts).
+    """
+    histograms = [(offset, counts) for offset, counts in histograms if len(counts) > 0]
+    if len(histograms) == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+    offset = min(offset for offset, _ in histograms)
+    merged_counts = np.zeros(max(offset + len(counts) for offset, counts in histograms) - offset, dtype=np.int64)
+    for histogram_offset, counts in histograms:
+        merged_counts[histogram_offset - offset: histogram_offset - offset + len(counts)] += counts
+    return offset, merged_counts
+
+
+def get_histogram_percentiles(
+        histogram: Tuple[int, np.ndarray], bin_width: float, percentiles: Tuple[float, ...] = FINGERPRINT_PERCENTILES
+) -> Dict[str, float]:
+    """
+    Estimate percentiles from a histogram, as the center of the bin including each percentile (the error is at most
+    half a bin width).
+
+    Parameters
+    ----------
+    histogram :
+        Histogram, as (first bin index, bin counts).
+    bin_width :
+        Bin width.
+    percentiles :
+        Percentiles to estimate, in the range 0-100.
+
+    Returns
+    -------
+        Dictionary mapping each percentile to its estimated value.
+    """
+    offset, counts = histogram
+    cumulative_counts = np.cumsum(counts)
+    if len(cumulative_counts) == 0 or cumulative_counts[-1] == 0:
+        return {}
+    percentile_bins = np.searchsorted(cumulative_counts, np.array(percentiles) / 100 * cumulative_counts[-1])
+    percentile_bins = np.minimum(percentile_bins, len(counts) - 1)
+    return {
+        str(percentile): float((offset + percentile_bin + 0.5) * bin_width)
+        for percentile, percentile_bin in zip(percentiles, percentile_bins)
+    }
+
+
+def compute_case_fingerprint(
+        image_files: Dict[str, str],
+        label_file: Optional[str] = None,
+        bin_width: float = 1.0,
+        instance_labels: bool = True,
+        intensity_range: Tuple[float, float] = DEFAULT_INTENSITY_RANGE,
+        modality_intensity_ranges: Dict[str, Tuple[float, float]] = None,
+) -> Dict[str, object]:
+    """
+    Compute the fingerprint of a case, reading each image and label volume once: shape, spacing, intensity statistics
+    (minimum, maximum, sum, sum of squares and histogram, computed on the label foreground voxels if a label is given,
+    otherwise on all the voxels) and lesion volumes. Non-finite intensities are excluded from the statistics and
+    counted separately, as the values outside the modality intensity range, which are excluded from the histogram
+    only. If the
+    label shape does not match the image shape, the statistics are computed on all the voxels and the mismatch is
+    recorded as ``label_mismatch``.
+
+    Parameters
+    ----------
+    image_files :
+        Dictionary mapping each modality to the image file (or NIFTI image already loaded).
+    label_file :
+        Optional label file (or NIFTI image already loaded).
+    bin_width :
+        Intensity histogram bin width. Default: ``1.0``.
+    instance_labels :
+        Flag to consider each label value as a lesion (instance segmentation). If ``False``, the lesions are the
+        connected components of the label foreground. Default: ``True``.
+    intensity_range :
+        Minimum and maximum intensity counted in the histogram. Default: ``(-1e5, 1e5)``.
+    modality_intensity_ranges :
+        Optional dictionary mapping a modality to its intensity range, replacing ``intensity_range`` for that modality
+        (e.g. for PET volumes in Bq/ml).
+
+    Returns
+    -------
+        Case fingerprint.
+    """
+    fingerprint = {"modalities": {}}
+    foreground = None
+    if label_file is not None:
+        label_nib = load_nifti(label_file)
+        label_array = np.asanyarray(label_nib.dataobj)
+        if not np.issubdtype(label_array.dtype, np.integer):
+            label_array = np.rint(label_array).astype(np.int64)
+        foreground = label_array > 0
+        if not instance_labels:
+            label_array, _ = label_components(foreground, generate_binary_structure(3, 3), memory_lean=True)
+        lesion_sizes = np.bincount(label_array.ravel())[1:]
+        voxel_volume = float(np.prod(label_nib.header.get_zooms()[:3]))
+        fingerprint["lesion_volumes"] = (lesion_sizes[lesion_sizes > 0] * voxel_volume).tolist()
+        del label_array
+
+    for modality, image_file in image_files.items():
+        modality_range = intensity_range
+        if modality_intensity_ranges is not None and modality in modality_intensity_ranges:
+            modality_range = modality_intensity_ranges[modality]
+        image_nib = load_nifti(image_file)
+        fingerprint["shape"] = [int(size) for size in image_nib.shape]
+        fingerprint["spacing"] = [float(spacing) for spacing in image_nib.header.get_zooms()[:3]]
+        image_array = np.asarray(image_nib.dataobj, dtype=np.float64)
+        label_mismatch = foreground is not None and foreground.shape != image_array.shape
+        if label_mismatch:
+            logger.warning(
+                "Label shape {} does not match the {} image shape {}: using all the voxels".format(
+                    foreground.shape, modality, image_array.shape
+                )
+            )
+        values = image_array[foreground] if foreground is not None and not label_mismatch else image_array.ravel()
+        del image_array
+        finite_values = np.isfinite(values)
+        n_non_finite = int(values.size - np.count_nonzero(finite_values))
+        if n_non_finite > 0:
+            values = values[finite_values]
+        del finite_values
+        fingerprint["modalities"][modality] = {
+            "n_voxels": int(values.size),
+            "min": float(values.min()) if values.size > 0 else None,
+            "max": float(values.max()) if values.size > 0 else None,
+            "sum": float(values.sum()),
+            "sum_squares": float(np.square(values).sum()),
+            "histogram": compute_histogram(values, bin_width, modality_range),
+            "intensity_range": [float(modality_range[0]), float(modality_range[1])],
+            "n_non_finite": n_non_finite,
+            "n_below_range": int(np.count_nonzero(values < modality_range[0])),
+            "n_above_range": int(np.count_nonzero(values > modality_range[1])),
+            "label_mismatch": bool(label_mismatch),
+        }
+    return fingerprint
+
+
+def _compute_case_fingerprint(
+        case: Tuple[str, Dict[str, str], Optional[str], float, bool, Tuple[float, float], Dict[str, Tuple[float, float]]]
+) -> Tuple[str, Dict[str, object]]:
+    subject, image_files, label_file, bin_width, instance_labels, intensity_range, modality_intensity_ranges = case
+    return subject, compute_case_fingerprint(
+        image_files, label_file, bin_width, instance_labels, intensity_range, modality_intensity_ranges
+    )
+
+
+def merge_case_fingerprints(
+        case_fingerprints: Dict[str, Dict[str, object]],
+        bin_width: float,
+        intensity_range: Tuple[float, float] = DEFAULT_INTENSITY_RANGE,
+) -> Dict[str, object]:
+    """
+    Merge the case fingerprints into the dataset fingerprint: median and per-case spacings and shapes, intensity
+    minimum, maximum, mean, standard deviation and percentiles (of the values in the intensity range of the modality)
+    for each modality, with the number of non-finite and out-of-range values (a warning is logged for the modalities
+    with out-of-range values), the subjects with a label shape mismatch and lesion volume
+    distribution.
+
+    Parameters
+    ----------
+    case_fingerprints :
+        Dictionary mapping each subject to the case fingerprint, as returned by :func:`compute_case_fingerprint`.
+    bin_width :
+        Intensity histogram bin width.
+    intensity_range :
+        Default intensity range, for the case fingerprints without a modality intensity range. Default: ``(-1e5, 1e5)``.
+
+    Returns
+    -------
+        Dataset fingerprint.
+    """
+    subjects = sorted(case_fingerprints.keys())
+    spacings = [case_fingerprints[subject]["spacing"] for subject in subjects]
+    dataset_fingerprint = {
+        "subjects": subjects,
+        "bin_width": bin_width,
+        "intensity_range": list(intensity_range),
+        "spacings": spacings,
+        "shapes": [case_fingerprints[subject]["shape"] for subject in subjects],
+        "median_spacing": np.median(np.array(spacings), axis=0).tolist() if len(spacings) > 0 else None,
+        "modalities": {},
+        "label_mismatches": [
+            subject
+            for subject in subjects
+            if any(fingerprint["label_mismatch"] for fingerprint in case_fingerprints[subject]["modalities"].values())
+        ],
+    }
+
+    modalities = sorted({modality for subject in subjects for modality in case_fingerprints[subject]["modalities"]})
+    for modality in modalities:
+        modality_fingerprints = [
+            case_fingerprints[subject]["modalities"][modality]
+            for subject in subjects
+            if modality in case_fingerprints[subject]["modalities"]
+        ]
+        n_voxels = sum(fingerprint["n_voxels"] for fingerprint in modality_fingerprints)
+        if n_voxels == 0:
+            continue
+        mean = sum(fingerprint["sum"] for fingerprint in modality_fingerprints) / n_voxels
+        variance = sum(fingerprint["sum_squares"] for fingerprint in modality_fingerprints) / n_voxels - mean**2
+        histogram = merge_histograms([fingerprint["histogram"] for fingerprint in modality_fingerprints])
+        n_below_range = sum(fingerprint["n_below_range"] for fingerprint in modality_fingerprints)
+        n_above_range = sum(fingerprint["n_above_range"] for fingerprint in modality_fingerprints)
+        modality_range = modality_fingerprints[0].get("intensity_range", list(intensity_range))
+        if n_below_range + n_above_range > 0:
+            logger.warning(
+                "{}: {} voxels below and {} voxels above the intensity range {} are excluded from the percentiles".format(
+                    modality, n_below_range, n_above_range, modality_range
+                )
+            )
+        dataset_fingerprint["modalities"][modality] = {
+            "n_voxels": n_voxels,
+            "min": min(fingerprint["min"] for fingerprint in modality_fingerprints if fingerprint["min"] is not None),
+            "max": max(fingerprint["max"] for fingerprint in modality_fingerprints if fingerprint["max"] is not None),
+            "mean": mean,
+            "std": math.sqrt(max(variance, 0.0)),
+            "percentiles": get_histogram_percentiles(histogram, bin_width),
+            "intensity_range": modality_range,
+            "n_non_finite": sum(fingerprint["n_non_finite"] for fingerprint in modality_fingerprints),
+            "n_below_range": n_below_range,
+            "n_above_range": n_above_range,
+        }
+
+    lesion_volumes = np.array(
+        [volume for subject in subjects for volume in case_fingerprints[subject].get("lesion_volumes", [])]
+    )
+    dataset_fingerprint["lesions"] = {
+        "n_lesions": int(lesion_volumes.size),
+        "percentiles": {
+            str(percentile): float(np.percentile(lesion_volumes, percentile)) for percentile in FINGERPRINT_PERCENTILES
+        }
+        if lesion_volumes.size > 0
+        else {},
+    }
+    return dataset_fingerprint
+
+
+def save_dataset_fingerprint(
+        case_fingerprints: Dict[str, Dict[str, object]],
+        bin_width: float,
+        output_file: Union[str, PathLike],
+        intensity_range: Tuple[float, float] = DEFAULT_INTENSITY_RANGE,
+) -> Dict[str, object]:
+    """
+    Save the dataset fingerprint as a JSON summary (``<output_file>.json``, see :func:`merge_case_fingerprints`) and a
+    NPZ archive (``<output_file>.npz``) with the mergeable per-case statistics: intensity histograms, sums, minimum,
+    maximum and non-finite and out-of-range counts for each modality, and the lesion volumes.
+
+    Parameters
+    ----------
+    case_fingerprints :
+        Dictionary mapping each subject to the case fingerprint, as returned by :func:`compute_case_fingerprint`.
+    bin_width :
+        Intensity histogram bin width.
+    output_file :
+        Output file path, without extension.
+    intensity_range :
+        Default intensity range, for the case fingerprints without a modality intensity range. Default: ``(-1e5, 1e5)``.
+
+    Returns
+    -------
+        Dataset fingerprint.
+    """
+    dataset_fingerprint = merge_case_fingerprints(case_fingerprints, bin_width, intensity_range)
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(str(output_file) + ".json", "w") as json_file:
+        json.dump(dataset_fingerprint, json_file, indent=4)
+
+    arrays = {"bin_width": np.array(bin_width), "intensity_range": np.array(intensity_range, dtype=np.float64)}
+    for subject, fingerprint in case_fingerprints.items():
+        arrays["{}/shape".format(subject)] = np.array(fingerprint["shape"])
+        arrays["{}/spacing".format(subject)] = np.array(fingerprint["spacing"])
+        if "lesion_volumes" in fingerprint:
+            arrays["{}/lesion_volumes".format(subject)] = np.array(fingerprint["lesion_volumes"])
+        for modality, modality_fingerprint in fingerprint["modalities"].items():
+            prefix = "{}/{}/".format(subject, modality)
+            offset, counts = modality_fingerprint["histogram"]
+            arrays[prefix + "histogram_offset"] = np.array(offset)
+            arrays[prefix + "histogram"] = counts
+            arrays[prefix + "intensity_range"] = np.array(modality_fingerprint["intensity_range"], dtype=np.float64)
+            arrays[prefix + "stats"] = np.array(
+                [
+                    modality_fingerprint["n_voxels"],
+                    np.nan if modality_fingerprint["min"] is None else modality_fingerprint["min"],
+                    np.nan if modality_fingerprint["max"] is None else modality_fingerprint["max"],
+                    modality_fingerprint["sum"],
+                    modality_fingerprint["sum_squares"],
+                    modality_fingerprint["n_non_finite"],
+                    modality_fingerprint["n_below_range"],
+                    modality_fingerprint["n_above_range"],
+                    modality_fingerprint["label_mismatch"],
+                ]
+            )
+    np.savez_compressed(str(output_file) + ".npz", **arrays)
+    return dataset_fingerprint
+
+
+def load_case_fingerprints(
+        npz_file: Union[str, PathLike]
+) -> Tuple[Dict[str, Dict[str, object]], float, Tuple[float, float]]:
+    """
+    Load the per-case fingerprints saved by :func:`save_dataset_fingerprint`, to merge them with new cases or to
+    recompute the dataset statistics without reading the volumes again.
+
+    Parameters
+    ----------
+    npz_file :
+        Fingerprint NPZ file.
+
+    Returns
+    -------
+        Dictionary mapping each subject to the case fingerprint, intensity histogram bin width and intensity range.
+    """
+    case_fingerprints = {}
+    with np.load(npz_file) as arrays:
+        bin_width = float(arrays["bin_width"])
+        intensity_range = tuple(arrays["intensity_range"].tolist())
+        for key in arrays.files:
+            if key in ("bin_width", "intensity_range"):
+                continue
+            subject, *key_path = key.split("/")
+            fingerprint = case_fingerprints.setdefault(subject, {"modalities": {}})
+            if key_path[0] == "shape":
+                fingerprint["shape"] = arrays[key].tolist()
+            elif key_path[0] == "spacing":
+                fingerprint["spacing"] = arrays[key].tolist()
+            elif key_path[0] == "lesion_volumes":
+                fingerprint["lesion_volumes"] = arrays[key].tolist()
+            elif key_path[1] == "intensity_range":
+                fingerprint["modalities"].setdefault(key_path[0], {})["intensity_range"] = arrays[key].tolist()
+            elif key_path[1] == "stats":
+                (
+                    n_voxels, min_value, max_value, values_sum, values_sum_squares, n_non_finite, n_below_range,
+                    n_above_range, label_mismatch,
+                ) = arrays[key].tolist()
+                modality_fingerprint = fingerprint["modalities"].setdefault(key_path[0], {})
+                modality_fingerprint["n_voxels"] = int(n_voxels)
+                modality_fingerprint["min"] = None if math.isnan(min_value) else min_value
+                modality_fingerprint["max"] = None if math.isnan(max_value) else max_value
+                modality_fingerprint["sum"] = values_sum
+                modality_fingerprint["sum_squares"] = values_sum_squares
+                modality_fingerprint["n_non_finite"] = int(n_non_finite)
+                modality_fingerprint["n_below_range"] = int(n_below_range)
+                modality_fingerprint["n_above_range"] = int(n_above_range)
+                modality_fingerprint["label_mismatch"] = bool(label_mismatch)
+                modality_fingerprint["histogram"] = (
+                    int(arrays[key.replace("stats", "histogram_offset")]),
+                    arrays[key.replace("stats", "histogram")],
+                )
+    return case_fingerprints, bin_width, intensity_range
+
+
+def compute_dataset_fingerprint(
+        dataset_index: Dict[str, Dict[str, str]],
+        config_dict: Dict[str, object],
+        output_file: Union[str, PathLike],
+        num_threads: int = 1,
+        bin_width: float = 1.0,
+        instance_labels: bool = True,
+        intensity_range: Tuple[float, float] = DEFAULT_INTENSITY_RANGE,
+) -> Dict[str, object]:
+    """
+    Compute the dataset fingerprint, streaming each image and label volume once in parallel (see
+    :func:`compute_case_fingerprint`), and save it with :func:`save_dataset_fingerprint`. Per-modality intensity
+    ranges can be set in the configuration (**IntensityRange**, e.g. ``{"PET": [0, 1e7]}``), replacing
+    ``intensity_range`` for the listed modalities. With a single worker, the
+    volumes of the next cases are read in background (see :func:`Hive.utils.volume_cache_utils.prefetch_volumes`).
+
+    Parameters
+    ----------
+    dataset_index :
+        Dataset index, as returned by :func:`Hive.utils.file_utils.index_dataset_folder`.
+    config_dict :
+        Dictionary with dataset configuration parameters (**Modalities**, **label_suffix** and, optionally,
+        **IntensityRange**).
+    output_file :
+        Output file path, without extension.
+    num_threads :
+        Number of worker processes. Default: ``1``.
+    bin_width :
+        Intensity histogram bin width. Default: ``1.0``.
+    instance_labels :
+        Flag to consider each label value as a lesion (instance segmentation). Default: ``True``.
+    intensity_range :
+        Minimum and maximum intensity counted in the histograms, for the modalities not listed in **IntensityRange**.
+        Default: ``(-1e5, 1e5)``.
+
+    Returns
+    -------
+        Dataset fingerprint.
+    """
+    modality_intensity_ranges = {
+        modality: tuple(float(value) for value in modality_range)
+        for modality, modality_range in config_dict.get("IntensityRange", {}).items()
+    }
+    for modality, modality_range in [(None, tuple(intensity_range))] + list(modality_intensity_ranges.items()):
+        if (
+                len(modality_range) != 2
+                or not modality_range[0] < modality_range[1]
+                or (modality_range[1] - modality_range[0]) / bin_width > MAX_HISTOGRAM_BINS
+        ):
+            raise ValueError(
+                "Invalid intensity range{}: {} (at most {} histogram bins of width {})".format(
+                    "" if modality is None else " for {}".format(modality), list(modality_range), MAX_HISTOGRAM_BINS, bin_width
+                )
+            )
+    label_suffix = config_dict.get("label_suffix", None)
+    cases = []
+    for subject, files in sorted(dataset_index.items()):
+        image_files = {
+            modality: files[image_suffix] for image_suffix, modality in config_dict["Modalities"].items() if image_suffix in files
+        }
+        if len(image_files) == 0:
+            logger.warning("No image found for {}: skipping".format(subject))
+            continue
+        label_file = files.get(label_suffix, None) if isinstance(label_suffix, str) else None
+        cases.append(
+            (subject, image_files, label_file, bin_width, instance_labels, tuple(intensity_range), modality_intensity_ranges)
+        )
+
+    case_fingerprints = {}
+    if num_threads > 1:
+        with Pool(num_threads) as pool:
+            for subject, fingerprint in tqdm(pool.imap_unordered(_compute_case_fingerprint, cases), total=len(cases)):
+                logger.log(DEBUG, "Computed fingerprint for {}".format(subject))
+                case_fingerprints[subject] = fingerprint
+    else:
+        case_volume_files = [
+            (subject, {**image_files, **({} if label_file is None else {None: label_file})})
+            for subject, image_files, label_file, *_ in cases
+        ]
+        for subject, case_volumes in tqdm(prefetch_volumes(case_volume_files), total=len(cases)):
+            label_volume = case_volumes.pop(None, None)
+            case_fingerprints[subject] = compute_case_fingerprint(
+                case_volumes, label_volume, bin_width, instance_labels, intensity_range, modality_intensity_ranges
+            )
+
+    return save_dataset_fingerprint(case_fingerprints, bin_width, output_file, intensity_range)
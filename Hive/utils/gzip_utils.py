@@ -0,0 +1,255 @@
+import gzip
+import io
+import os
+import struct
+import time
+import uuid
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from os import PathLike
+from pathlib import Path
+from typing import Union
+
+import SimpleITK as sitk
+import nibabel as nib
+
+from Hive.utils.log_utils import get_logger
+
+logger = get_logger(__name__)
+
+GZIP_THREADS_ENV = "HIVE_GZIP_THREADS"
+GZIP_BLOCK_SIZE = 1024**2
+GZIP_DICTIONARY_SIZE = 32 * 1024
+
+
+def get_gzip_threads() -> int:
+    """
+    Returns the default number of compression threads, set with the ``HIVE_GZIP_THREADS`` environment variable
+    (Default: 1).
+
+    Returns
+    -------
+        Number of compression threads.
+    """
+    return int(os.environ.get(GZIP_THREADS_ENV, 1))
+
+
+def _compress_block(block: bytes, dictionary: bytes, compression_level: int, last: bool) -> bytes:
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(io.BufferedIOBase):
+    """
+    Writable file object producing a standard, single-member gzip file, with the deflate blocks compressed in parallel
+    (as in ``pigz``). The data are split in blocks, each block is compressed in a thread pool using the last 32 KB of
+    the previous block as dictionary, and the compressed blocks are written in order. The number of blocks in memory
+    is bounded by the number of threads.
+
+    Parameters
+    ----------
+    filename :
+        Output gzip file.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    num_threads :
+        Number of compression threads. Default: ``None``, set from the ``HIVE_GZIP_THREADS`` environment variable.
+    block_size :
+        Uncompressed block size, in bytes. Default: 1 MB.
+    """
+
+    def __init__(
+            self,
+            filename: Union[str, PathLike],
+            compression_level: int = 1,
+            num_threads: int = None,
+            block_size: int = GZIP_BLOCK_SIZE,
+    ):
+        super().__init__()
+        self.compression_level = compression_level
+        self.num_threads = num_threads if num_threads is not None else get_gzip_threads()
+        self.block_size = block_size
+        self._fileobj = open(filename, "wb")
+        self._pool = ThreadPool(self.num_threads)
+        self._pending_blocks = deque()
+        self._buffer = bytearray()
+        self._dictionary = b""
+        self._crc = 0
+        self._size = 0
+        # gzip header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+        self._fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff")
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._size
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        # only forward seeks are supported, filling the gap with zeros (as in gzip.GzipFile)
+        if whence == os.SEEK_CUR:
+            offset = self._size + offset
+        elif whence != os.SEEK_SET:
+            raise ValueError("Seek from end not supported")
+        if offset < self._size:
+            raise OSError("Negative seek in write mode")
+        self.write(bytes(offset - self._size))
+        return self._size
+
+    def write(self, data) -> int:
+        data = memoryview(data).cast("B")
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        offset = 0
+        while offset < len(data):
+            # a full block is submitted only when more data follow, the last block is submitted on close
+            if len(self._buffer) == self.block_size:
+                self._submit_block(bytes(self._buffer), False)
+                self._buffer = bytearray()
+            n_bytes = min(self.block_size - len(self._buffer), len(data) - offset)
+            self._buffer += data[offset: offset + n_bytes]
+            offset += n_bytes
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit_block(self, block: bytes, last: bool):
+        self._pending_blocks.append(
+            self._pool.apply_async(_compress_block, (block, self._dictionary, self.compression_level, last))
+        )
+        self._dictionary = block[-GZIP_DICTIONARY_SIZE:]
+        while len(self._pending_blocks) > 2 * self.num_threads:
+            self._fileobj.write(self._pending_blocks.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit_block(bytes(self._buffer), True)
+            self._buffer = bytearray()
+            while len(self._pending_blocks) > 0:
+                self._fileobj.write(self._pending_blocks.popleft().get())
+            self._fileobj.write(struct.pack("<II", self._crc, self._size & 0xFFFFFFFF))
+        finally:
+            self._pool.terminate()
+            self._fileobj.close()
+            super().close()
+
+
+def open_gzip_writer(
+        filename: Union[str, PathLike], compression_level: int = 1, num_threads: int = None
+):
+    """
+    Open a gzip file for writing. With more than one compression thread, a :class:`ParallelGzipFile` is returned,
+    otherwise a standard ``gzip`` file.
+
+    Parameters
+    ----------
+    filename :
+        Output gzip file.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    num_threads :
+        Number of compression threads. Default: ``None``, set from the ``HIVE_GZIP_THREADS`` environment variable.
+
+    Returns
+    -------
+        Writable file object.
+    """
+    if num_threads is None:
+        num_threads = get_gzip_threads()
+    if num_threads > 1:
+        return ParallelGzipFile(filename, compression_level, num_threads)
+    return gzip.open(filename, "wb", compresslevel=compression_level)
+
+
+def save_nifti_image(
+        image: nib.Nifti1Image, nii_out_path: Union[str, PathLike], compression_level: int = 1, num_threads: int = None
+):
+    """
+    Save a NIFTI image. If the output file has the ``.gz`` extension, the image is streamed to a gzip file with the
+    given compression level (see :func:`open_gzip_writer`), otherwise the image is saved uncompressed.
+
+    Parameters
+    ----------
+    image :
+        NIFTI image to save.
+    nii_out_path :
+        Output NIFTI file path (``.nii`` or ``.nii.gz``).
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    num_threads :
+        Number of compression threads. Default: ``None``, set from the ``HIVE_GZIP_THREADS`` environment variable.
+    """
+    if not str(nii_out_path).endswith(".gz"):
+        nib.save(image, nii_out_path)
+        return
+    with open_gzip_writer(nii_out_path, compression_level, num_threads) as fileobj:
+        file_holder = nib.fileholders.FileHolder(fileobj=fileobj)
+        image.to_file_map({"image": file_holder, "header": file_holder})
+
+
+def write_image(
+        image: sitk.Image, output_filename: Union[str, PathLike], compression_level: int = 1, num_threads: int = None
+):
+    """
+    Save a SimpleITK image. ``.nii.gz`` files are first written uncompressed by SimpleITK, then compressed with
+    :func:`open_gzip_writer`; all other formats are written by SimpleITK.
+
+    Parameters
+    ----------
+    image :
+        SimpleITK image to save.
+    output_filename :
+        Output file path.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    num_threads :
+        Number of compression threads. Default: ``None``, set from the ``HIVE_GZIP_THREADS`` environment variable.
+    """
+    if num_threads is None:
+        num_threads = get_gzip_threads()
+    if not str(output_filename).endswith(".nii.gz") or num_threads == 1:
+        sitk.WriteImage(image, str(output_filename), str(output_filename).endswith(".gz"), compression_level)
+        return
+
+    tmp_file = Path(output_filename).parent.joinpath(".{}.{}.nii".format(Path(output_filename).name, uuid.uuid4().hex))
+    try:
+        sitk.WriteImage(image, str(tmp_file), False)
+        compress_file(tmp_file, output_filename, compression_level, num_threads)
+    finally:
+        if tmp_file.is_file():
+            os.remove(tmp_file)
+
+
+def compress_file(
+        input_filename: Union[str, PathLike],
+        output_filename: Union[str, PathLike],
+        compression_level: int = 1,
+        num_threads: int = None,
+):
+    """
+    Compress a file into a gzip file with :func:`open_gzip_writer`, streaming the content in blocks.
+
+    Parameters
+    ----------
+    input_filename :
+        File to compress.
+    output_filename :
+        Output gzip file.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    num_threads :
+        Number of compression threads. Default: ``None``, set from the ``HIVE_GZIP_THREADS`` environment variable.
+    """
+    with open(input_filename, "rb") as source, open_gzip_writer(output_filename, compression_level, num_threads) as destination:
+        while True:
+            block = source.read(16 * GZIP_BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            destination.write(block)
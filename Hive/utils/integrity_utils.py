@@ -0,0 +1,412 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
+from os import PathLike
+from pathlib import Path
+from typing import Union, Dict, List, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+from tqdm import tqdm
+
+from Hive.utils.log_utils import get_logger, DEBUG, WARN
+
+logger = get_logger(__name__)
+
+DATASET_SPLITS = (("imagesTr", "labelsTr"), ("imagesTs", "labelsTs"))
+CHECKSUM_BLOCK_SIZE = 16 * 1024**2
+DECOMPRESSION_CHUNK_SIZE = 16 * 1024**2
+
+
+def _get_file_hash(algorithm: str):
+    if algorithm == "xxhash":
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError("The xxhash checksum requires the xxhash package: pip install xxhash")
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+def scan_file(
+        filename: Union[str, PathLike], checksum: str = None, verify_gzip: bool = False
+) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Read a file once, in blocks, computing the checksum of the raw bytes and, for gzip files, stream-decompressing the
+    data in the same pass (the decompressed data are discarded). The decompression verifies the gzip CRC and length of
+    each member, so truncated or corrupt gzip files are detected.
+
+    Parameters
+    ----------
+    filename :
+        File path.
+    checksum :
+        Optional checksum algorithm: any ``hashlib`` algorithm, or ``"xxhash"`` (64-bit xxHash), if the optional
+        ``xxhash`` package is installed. Default: ``None``, no checksum.
+    verify_gzip :
+        Flag to stream-decompress ``.gz`` files. Default: ``False``.
+
+    Returns
+    -------
+        Hexadecimal checksum (or ``None``) and decompressed size, in bytes (or ``None`` if the file is not decompressed).
+
+    Raises
+    ------
+    EOFError
+        If the gzip stream is truncated.
+    zlib.error
+        If the gzip stream is corrupt.
+    """
+    file_hash = _get_file_hash(checksum) if checksum is not None else None
+    decompressor = None
+    decompressed_size = None
+    if verify_gzip and str(filename).endswith(".gz"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressed_size = 0
+
+    with open(filename, "rb") as file:
+        while True:
+            block = file.read(CHECKSUM_BLOCK_SIZE)
+            if len(block) == 0:
+                break
+            if file_hash is not None:
+                file_hash.update(block)
+            while decompressor is not None and len(block) > 0:
+                if decompressor.eof:
+                    # concatenated gzip members
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                decompressed_size += len(decompressor.decompress(block, DECOMPRESSION_CHUNK_SIZE))
+                block = decompressor.unused_data if decompressor.eof else decompressor.unconsumed_tail
+
+    if decompressor is not None:
+        # flush the output still buffered in the decompressor, in bounded chunks
+        while not decompressor.eof:
+            decompressed_chunk = decompressor.decompress(decompressor.unconsumed_tail, DECOMPRESSION_CHUNK_SIZE)
+            if len(decompressed_chunk) == 0:
+                raise EOFError("Truncated gzip stream")
+            decompressed_size += len(decompressed_chunk)
+    return (file_hash.hexdigest() if file_hash is not None else None), decompressed_size
+
+
+def compute_file_checksum(filename: Union[str, PathLike], algorithm: str = "sha256") -> str:
+    """
+    Compute the checksum of a file, reading it in blocks (see :func:`scan_file`).
+
+    Parameters
+    ----------
+    filename :
+        File path.
+    algorithm :
+        Checksum algorithm. Default: ``"sha256"``.
+
+    Returns
+    -------
+        Hexadecimal checksum.
+    """
+    return scan_file(filename, algorithm)[0]
+
+
+def read_nifti_header_info(filename: Union[str, PathLike], check_gzip_trailer: bool = True) -> Dict[str, object]:
+    """
+    Read shape, affine and data type of a NIFTI file from its header only, without reading the voxel data. For
+    uncompressed files, the file size is also checked against the data size declared in the header. For compressed
+    files, the uncompressed size stored in the gzip trailer (the last 4 bytes, modulo 2**32) is checked instead, which
+    detects truncated files without decompressing them (see :func:`scan_file` for a full verification).
+
+    Parameters
+    ----------
+    filename :
+        NIFTI file.
+    check_gzip_trailer :
+        Flag to check the gzip trailer size of compressed files. Default: ``True``.
+
+    Returns
+    -------
+        Dictionary with the ``shape``, ``affine`` and ``dtype`` of the volume, and the expected uncompressed file size
+        (``file_size``, header and voxel data).
+
+    Raises
+    ------
+    ValueError
+        If the uncompressed file is smaller than the declared data size, or if the gzip trailer size does not match it.
+    """
+    image = nib.load(filename)
+    header = image.header
+    data_dtype = header.get_data_dtype()
+    expected_size = int(image.dataobj.offset) + int(np.prod(image.shape)) * data_dtype.itemsize
+    if not str(filename).endswith(".gz"):
+        if os.path.getsize(filename) < expected_size:
+            raise ValueError(
+                "Truncated file: {} bytes, expected {} bytes".format(os.path.getsize(filename), expected_size)
+            )
+    elif check_gzip_trailer:
+        with open(filename, "rb") as file:
+            file.seek(-4, os.SEEK_END)
+            trailer_size = struct.unpack("<I", file.read(4))[0]
+        if trailer_size != expected_size & 0xFFFFFFFF:
+            # multi-member gzip files only store the size of the last member: they need a full verification
+            raise ValueError(
+                "Truncated or multi-member gzip file: trailer size {}, expected {} bytes".format(trailer_size, expected_size)
+            )
+    return {
+        "shape": [int(size) for size in image.shape],
+        "affine": image.affine.tolist(),
+        "dtype": str(data_dtype),
+        "file_size": expected_size,
+    }
+
+
+def verify_case(
+        case: str,
+        image_files: List[Optional[str]],
+        label_file: Optional[str] = None,
+        label_json: Optional[str] = None,
+        checksum: Optional[str] = None,
+        affine_tolerance: float = 1e-3,
+        verify_gzip: bool = False,
+) -> Dict[str, object]:
+    """
+    Verify the files of a dataset case from the NIFTI headers: every modality file and the label file must exist and
+    decode, with a size matching the header (see :func:`read_nifti_header_info`; with ``verify_gzip``, compressed files
+    are also stream-decompressed, to detect corrupt files), the images and the label must share the same spatial shape
+    and affine (within ``affine_tolerance``), and the label data type must be an integer or floating point type. The
+    nnDetection label JSON file, when given, must include the ``instances`` dictionary.
+
+    Parameters
+    ----------
+    case :
+        Case ID.
+    image_files :
+        List of the modality files, in modality order (``None`` for missing modalities).
+    label_file :
+        Optional label file. Default: ``None``, the case is not labeled.
+    label_json :
+        Optional nnDetection label JSON file.
+    checksum :
+        Optional checksum algorithm (see :func:`compute_file_checksum`). Default: ``None``, no checksum.
+    affine_tolerance :
+        Absolute tolerance when comparing the affines. Default: ``1e-3``.
+    verify_gzip :
+        Flag to stream-decompress the compressed files, in the same pass as the checksum (see :func:`scan_file`).
+        Default: ``False``, only the headers and the gzip trailers are read.
+
+    Returns
+    -------
+        Case report, with the header information (and checksum) of each file, and the list of errors and warnings.
+    """
+    report = {"case": case, "files": {}, "errors": [], "warnings": []}
+
+    def check_file(filename: str) -> Optional[Dict[str, object]]:
+        try:
+            file_info = read_nifti_header_info(filename, check_gzip_trailer=not verify_gzip)
+            if checksum is not None or (verify_gzip and str(filename).endswith(".gz")):
+                file_checksum, decompressed_size = scan_file(filename, checksum, verify_gzip)
+                if file_checksum is not None:
+                    file_info[checksum] = file_checksum
+                if decompressed_size is not None and decompressed_size < file_info["file_size"]:
+                    raise EOFError(
+                        "Truncated data: {} bytes, expected {} bytes".format(decompressed_size, file_info["file_size"])
+                    )
+        except Exception as e:
+            report["errors"].append("{}: {}".format(filename, e))
+            return None
+        report["files"][filename] = file_info
+        return file_info
+
+    reference_info = None
+    for modality, image_file in enumerate(image_files):
+        if image_file is None:
+            report["errors"].append("Missing modality {:04d}".format(modality))
+            continue
+        image_info = check_file(image_file)
+        if image_info is None:
+            continue
+        if reference_info is None:
+            reference_info = image_info
+        elif image_info["shape"][:3] != reference_info["shape"][:3]:
+            report["errors"].append(
+                "{}: shape {} does not match {}".format(image_file, image_info["shape"], reference_info["shape"])
+            )
+        elif not np.allclose(image_info["affine"], reference_info["affine"], atol=affine_tolerance):
+            report["errors"].append("{}: affine does not match the first modality".format(image_file))
+
+    if label_file is not None:
+        label_info = check_file(label_file)
+        if label_info is not None:
+            if not (
+                    np.issubdtype(np.dtype(label_info["dtype"]), np.integer)
+                    or np.issubdtype(np.dtype(label_info["dtype"]), np.floating)
+            ):
+                report["errors"].append("{}: unsupported label data type {}".format(label_file, label_info["dtype"]))
+            elif np.issubdtype(np.dtype(label_info["dtype"]), np.floating):
+                report["warnings"].append("{}: floating point label data type {}".format(label_file, label_info["dtype"]))
+            if reference_info is not None:
+                if label_info["shape"][:3] != reference_info["shape"][:3]:
+                    report["errors"].append(
+                        "{}: shape {} does not match the image shape {}".format(
+                            label_file, label_info["shape"], reference_info["shape"]
+                        )
+                    )
+                elif not np.allclose(label_info["affine"], reference_info["affine"], atol=affine_tolerance):
+                    report["errors"].append("{}: affine does not match the image affine".format(label_file))
+
+    if label_json is not None:
+        try:
+            with open(label_json) as json_file:
+                if "instances" not in json.load(json_file):
+                    report["errors"].append("{}: missing instances dictionary".format(label_json))
+        except FileNotFoundError:
+            report["errors"].append("Missing label JSON file {}".format(label_json))
+        except ValueError as e:
+            report["errors"].append("{}: {}".format(label_json, e))
+
+    return report
+
+
+def _verify_case(case_files: Tuple[str, List[Optional[str]], Optional[str], Optional[str], Optional[str], float, bool]):
+    return verify_case(*case_files)
+
+
+def index_dataset_split(
+        image_folder: Union[str, PathLike], label_folder: Union[str, PathLike], file_extension: str, n_modalities: int = None
+) -> List[Tuple[str, List[Optional[str]], Optional[str], Optional[str]]]:
+    """
+    Index the cases of a prepared dataset split (``<CASE>_<MODALITY>.nii.gz`` images, ``<CASE>.nii.gz`` labels and
+    optional ``<CASE>.json`` nnDetection label files).
+
+    Parameters
+    ----------
+    image_folder :
+        Image folder (e.g. ``imagesTr``).
+    label_folder :
+        Label folder (e.g. ``labelsTr``). If it does not exist, the cases are not labeled.
+    file_extension :
+        NIFTI file extension.
+    n_modalities :
+        Expected number of modalities. Default: ``None``, the maximum number of modalities found in the split.
+
+    Returns
+    -------
+        List of (case ID, modality files, label file, label JSON file) tuples. Missing files are ``None``; the label
+        JSON file is ``None`` if no JSON file is found in the label folder.
+    """
+    image_pattern = re.compile(r"^(.+)_(\d{4})" + re.escape(file_extension) + "$")
+    case_images = {}
+    with os.scandir(image_folder) as entries:
+        for entry in entries:
+            match = image_pattern.match(entry.name)
+            if match is not None:
+                case_images.setdefault(match.group(1), {})[int(match.group(2))] = entry.path
+
+    label_files = set()
+    if Path(label_folder).is_dir():
+        with os.scandir(label_folder) as entries:
+            label_files = {entry.name for entry in entries}
+    has_label_json = any(filename.endswith(".json") for filename in label_files)
+
+    if n_modalities is None:
+        n_modalities = max([max(images.keys()) + 1 for images in case_images.values()], default=0)
+    cases = []
+    for case, images in sorted(case_images.items()):
+        label_file, label_json = None, None
+        if len(label_files) > 0:
+            label_file = os.path.join(label_folder, case + file_extension)
+            if has_label_json:
+                label_json = os.path.join(label_folder, case + ".json")
+        cases.append((case, [images.get(modality, None) for modality in range(n_modalities)], label_file, label_json))
+    for filename in label_files:
+        if filename.endswith(file_extension) and filename[: -len(file_extension)] not in case_images:
+            logger.log(WARN, "Label file without images: {}".format(os.path.join(label_folder, filename)))
+    return cases
+
+
+def verify_dataset_folder(
+        dataset_folder: Union[str, PathLike],
+        output_json: Union[str, PathLike] = None,
+        file_extension: str = ".nii.gz",
+        num_threads: int = 1,
+        checksum: str = None,
+        affine_tolerance: float = 1e-3,
+        verify_gzip: bool = False,
+) -> Dict[str, object]:
+    """
+    Verify a prepared dataset folder (including ``imagesTr``, ``labelsTr``, ``imagesTs`` and ``labelsTs``), checking
+    each case in a thread pool with :func:`verify_case`. The expected number of modalities is read from the
+    ``dataset.json`` file in the dataset folder (or in its parent folder, as in the nnDetection layout), if available.
+    The verification report is optionally saved as JSON file.
+
+    Parameters
+    ----------
+    dataset_folder :
+        Dataset folder.
+    output_json :
+        Optional output JSON report file.
+    file_extension :
+        NIFTI file extension. Default: ``".nii.gz"``.
+    num_threads :
+        Number of threads. Default: ``1``.
+    checksum :
+        Optional checksum algorithm (see :func:`compute_file_checksum`). Default: ``None``, no checksum.
+    affine_tolerance :
+        Absolute tolerance when comparing the affines. Default: ``1e-3``.
+    verify_gzip :
+        Flag to stream-decompress the compressed files, detecting corrupt files. Default: ``False``, only the headers
+        and the gzip trailers are read.
+
+    Returns
+    -------
+        Verification report.
+    """
+    n_modalities = None
+    for dataset_json in (Path(dataset_folder).joinpath("dataset.json"), Path(dataset_folder).parent.joinpath("dataset.json")):
+        if dataset_json.is_file():
+            with open(dataset_json) as json_file:
+                dataset_dict = json.load(json_file)
+            modalities = dataset_dict.get("modalities", dataset_dict.get("channel_names", None))
+            if modalities is not None:
+                n_modalities = len(modalities)
+            break
+
+    case_files = []
+    for image_split, label_split in DATASET_SPLITS:
+        if not Path(dataset_folder).joinpath(image_split).is_dir():
+            continue
+        for case, image_files, label_file, label_json in index_dataset_split(
+                Path(dataset_folder).joinpath(image_split), Path(dataset_folder).joinpath(label_split), file_extension,
+                n_modalities
+        ):
+            case_files.append(
+                (
+                    "{}/{}".format(image_split, case), image_files, label_file, label_json, checksum, affine_tolerance,
+                    verify_gzip,
+                )
+            )
+
+    case_reports = {}
+    with ThreadPool(num_threads) as pool:
+        for case_report in tqdm(pool.imap_unordered(_verify_case, case_files), total=len(case_files)):
+            case = case_report.pop("case")
+            case_reports[case] = case_report
+            if len(case_report["errors"]) > 0:
+                logger.log(WARN, "{}: {}".format(case, "; ".join(case_report["errors"])))
+            else:
+                logger.log(DEBUG, "{}: verified {} files".format(case, len(case_report["files"])))
+
+    failed_cases = sorted(case for case, case_report in case_reports.items() if len(case_report["errors"]) > 0)
+    report = {
+        "dataset_folder": str(dataset_folder),
+        "checksum": checksum,
+        "verify_gzip": verify_gzip,
+        "n_cases": len(case_reports),
+        "n_failed_cases": len(failed_cases),
+        "failed_cases": failed_cases,
+        "cases": {case: case_reports[case] for case in sorted(case_reports)},
+    }
+    if output_json is not None:
+        with open(output_json, "w") as json_file:
+            json.dump(report, json_file, indent=4)
+    return report
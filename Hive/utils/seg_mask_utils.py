@@ -1,18 +1,157 @@
+import itertools
+import json
+import math
+import os
+import tempfile
+import uuid
+from pathlib import Path
+from typing import Tuple, Dict, Iterator, Union, Sequence, List
+
 import nibabel as nib
-from scipy.ndimage import label, generate_binary_structure
+import numpy as np
+from scipy.ndimage import label, generate_binary_structure, find_objects
+
+from Hive.utils.gzip_utils import save_nifti_image, compress_file
+from Hive.utils.volume_cache_utils import load_nifti, get_cached_volume_file, get_volume_cache_folder
+
+
+def get_label_dtype(num_features: int) -> np.dtype:
+    """
+    Returns the smallest unsigned integer dtype able to store ``num_features`` labels.
+
+    Parameters
+    ----------
+    num_features :
+        Number of labels.
+
+    Returns
+    -------
+        Label dtype.
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if num_features <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def get_min_component_size(affine: np.ndarray, min_volume: float) -> int:
+    """
+    Convert a minimum region volume in mm3 into the minimum number of voxels, using the voxel volume of the affine.
+
+    Parameters
+    ----------
+    affine :
+        NIFTI affine matrix.
+    min_volume :
+        Minimum region volume, in mm3.
 
+    Returns
+    -------
+        Minimum region size, in voxels (at least 1).
+    """
+    voxel_volume = float(abs(np.linalg.det(affine[:3, :3])))
+    if voxel_volume == 0:
+        return 1
+    return max(1, math.ceil(min_volume / voxel_volume - 1e-6))
+
+
+def label_components(mask: np.ndarray, structure: np.ndarray, memory_lean: bool = False) -> Tuple[np.ndarray, int]:
+    """
+    Label the connected components of a mask. In ``memory_lean`` mode, the components are labeled into a ``uint16``
+    array, falling back to the default ``int32`` output only if the number of components does not fit.
+
+    Parameters
+    ----------
+    mask :
+        Input mask. Non-zero voxels are foreground.
+    structure :
+        Connectivity structuring element.
+    memory_lean :
+        Flag to label into a ``uint16`` array. Default: ``False``.
 
-def semantic_segmentation_to_instance(mask_filename: str, output_path: str) -> int:
+    Returns
+    -------
+        Labeled array and number of components.
+    """
+    if memory_lean:
+        try:
+            return label(mask, structure=structure, output=np.uint16)
+        except RuntimeError:
+            pass
+    return label(mask, structure=structure)
+
+
+def remove_small_components(
+        labeled_array: np.ndarray,
+        num_features: int,
+        min_size: int,
+        dtype: np.dtype = None,
+        component_sizes: np.ndarray = None,
+) -> Tuple[np.ndarray, int]:
+    """
+    Remove the connected components smaller than ``min_size`` voxels from a labeled array, relabeling the remaining
+    components with consecutive labels (preserving their order). The component sizes are computed with a single
+    ``np.bincount`` and the relabeling is done with a single lookup-table remap.
+
+    Parameters
+    ----------
+    labeled_array :
+        Labeled array, as returned by ``scipy.ndimage.label``.
+    num_features :
+        Number of components in ``labeled_array``.
+    min_size :
+        Minimum component size, in voxels.
+    dtype :
+        Optional dtype of the relabeled array. Default: ``None``, the ``labeled_array`` dtype.
+    component_sizes :
+        Optional component sizes, if already computed with ``np.bincount``.
+
+    Returns
+    -------
+        Relabeled array and number of remaining components.
+    """
+    if component_sizes is None:
+        component_sizes = np.bincount(labeled_array.ravel(), minlength=num_features + 1)
+    kept_components = component_sizes >= min_size
+    kept_components[0] = False
+    num_kept_features = int(np.count_nonzero(kept_components))
+
+    if dtype is None:
+        dtype = labeled_array.dtype
+    lookup_table = np.zeros(len(component_sizes), dtype=dtype)
+    lookup_table[kept_components] = np.arange(1, num_kept_features + 1, dtype=dtype)
+    return lookup_table[labeled_array], num_kept_features
+
+
+def semantic_segmentation_to_instance(
+        mask_filename: str,
+        output_path: str,
+        memory_lean: bool = False,
+        connectivity: int = 3,
+        min_size: int = 10,
+        min_volume: float = None,
+) -> int:
     """
     Given a semantic segmentation mask convert to instance segmentation and save in the given output path.
     Return the number of labels in instance segmentation mask.
+    In ``memory_lean`` mode, the mask is read in its stored dtype (e.g. ``uint8``) instead of ``float64``, labeled
+    into a ``uint16`` array when possible, and the instance mask is saved with the smallest unsigned integer dtype
+    holding the number of labels.
 
     Parameters
     ----------
     mask_filename:
-        File path of semantic segmentation mask.
+        File path of semantic segmentation mask, or NIFTI image already loaded.
     output_path:
         Output path including new instance segmentation mask file name.
+    memory_lean:
+        Flag to enable the memory-lean mode. Default: ``False``.
+    connectivity:
+        Connectivity used to label the connected regions, in the range 1-3 (3 for 26-connectivity). Default: ``3``.
+    min_size:
+        Minimum region size, in voxels. Smaller regions are ignored. Default: ``10``.
+    min_volume:
+        Optional minimum region volume, in mm3, computed from the mask affine. If given, it replaces ``min_size``.
 
     Returns
     -------
@@ -20,25 +159,437 @@ def semantic_segmentation_to_instance(mask_filename: str, output_path: str) -> i
     """
 
     # load segmentation mask and properties
-    mask = nib.load(mask_filename)
+    mask = load_nifti(mask_filename)
     affine = mask.affine
-    np_mask = mask.get_fdata()
+    if memory_lean:
+        np_mask = np.asanyarray(mask.dataobj)
+        if not np.issubdtype(np_mask.dtype, np.integer) and np_mask.dtype != bool:
+            np_mask = np_mask != 0
+    else:
+        np_mask = mask.get_fdata()
 
     # label connected regions in segmentation mask
-    labeled_array, num_features = label(np_mask, structure=generate_binary_structure(3, 3))
-
-    thresh = 10
-    # voxel count in each region from https://neurostars.org/t/roi-voxel-count-using-python/6451
-    # ignore regions below threshold = 10
-    for i in range(1, num_features + 1):
-        vox_count = (labeled_array == i).sum()
-        if vox_count < thresh:
-            labeled_array[labeled_array == i] = 0
+    labeled_array, num_features = label_components(np_mask, generate_binary_structure(3, connectivity), memory_lean)
+    del np_mask
 
-    labeled_array[labeled_array > 0] = 1
-    labeled_array, num_features = label(labeled_array, structure=generate_binary_structure(3, 3))
+    # ignore regions below threshold (default: 10 voxels)
+    if min_volume is not None:
+        min_size = get_min_component_size(mask.affine, min_volume)
+    labeled_array, num_features = remove_small_components(
+        labeled_array, num_features, min_size, get_label_dtype(num_features) if memory_lean else None
+    )
 
     # convert labeled array into Nifti file
     labeled_mask = nib.Nifti1Image(labeled_array, affine=affine)
-    nib.save(labeled_mask, output_path)
+    save_nifti_image(labeled_mask, output_path)
+    return num_features
+
+
+def semantic_to_instance_per_class(
+        semantic_array: np.ndarray, connectivity: int = 3, min_size: int = 1, memory_lean: bool = False
+) -> Tuple[np.ndarray, Dict[int, int]]:
+    """
+    Convert a multi-class semantic label array into an instance label array, labeling the connected regions of each
+    class separately. Each class is labeled only within its bounding box, and its regions are written in the instance
+    array with a label offset, so no full-size copy is created per class. Instances are numbered class by class.
+
+    Parameters
+    ----------
+    semantic_array :
+        Semantic label array, with non-negative integer class labels (``0`` for background).
+    connectivity :
+        Connectivity used to label the connected regions, in the range 1-3 (3 for 26-connectivity). Default: ``3``.
+    min_size :
+        Minimum region size, in voxels. Smaller regions are ignored. Default: ``1``.
+    memory_lean :
+        Flag to return the instance array with the smallest unsigned integer dtype. Default: ``False``.
+
+    Returns
+    -------
+        Instance label array and map from instance label to semantic class label.
+    """
+    structure = generate_binary_structure(semantic_array.ndim, connectivity)
+    instance_array = np.zeros(semantic_array.shape, dtype=np.int32)
+    instance_classes = [0]
+    num_features = 0
+    for class_index, class_slice in enumerate(find_objects(semantic_array)):
+        if class_slice is None:
+            continue
+        class_label = class_index + 1
+        class_instances, num_class_features = label(semantic_array[class_slice] == class_label, structure=structure)
+        class_foreground = class_instances > 0
+        instance_array[class_slice][class_foreground] = class_instances[class_foreground] + num_features
+        instance_classes.extend([class_label] * num_class_features)
+        num_features += num_class_features
+
+    instance_classes = np.array(instance_classes, dtype=np.int64)
+    component_sizes = np.bincount(instance_array.ravel(), minlength=num_features + 1)
+    kept_components = component_sizes >= min_size
+    kept_components[0] = False
+    instance_array, num_features = remove_small_components(
+        instance_array, num_features, min_size, get_label_dtype(num_features) if memory_lean else None, component_sizes
+    )
+    instance_class_map = {
+        instance + 1: int(class_label) for instance, class_label in enumerate(instance_classes[kept_components])
+    }
+    return instance_array, instance_class_map
+
+
+def get_instance_boxes(instance_array: np.ndarray) -> Tuple[Dict[int, List[int]], Dict[int, int]]:
+    """
+    Compute the bounding box and the voxel count of each instance in an instance label array, with a single
+    ``find_objects`` and a single ``np.bincount`` pass.
+
+    Parameters
+    ----------
+    instance_array :
+        Instance label array, with non-negative integer labels (``0`` for background).
+
+    Returns
+    -------
+        Map from instance label to bounding box (``[start, stop)`` voxel indices along each array axis, as
+        ``[start_0, stop_0, start_1, stop_1, ...]``) and map from instance label to voxel count.
+    """
+    instance_sizes = np.bincount(instance_array.ravel())
+    instance_boxes = {}
+    for instance_index, instance_slice in enumerate(find_objects(instance_array)):
+        if instance_slice is None:
+            continue
+        instance_boxes[instance_index + 1] = [int(index) for axis in instance_slice for index in (axis.start, axis.stop)]
+    return instance_boxes, {instance: int(instance_sizes[instance]) for instance in instance_boxes}
+
+
+def prepare_nndet_label_file(
+        input_image: str,
+        input_label: str,
+        output_label: str,
+        output_json: str,
+        semantic: bool = False,
+        connectivity: int = 3,
+        min_size: int = 1,
+) -> int:
+    """
+    Prepare a label file for nnDetection, decoding the label volume only once. In a single pass, the label is
+    (optionally) converted from semantic to instance segmentation (see :func:`semantic_to_instance_per_class`), the
+    instance bounding boxes and voxel counts are computed, the instance mask is saved with the affine of the reference
+    image, and the nnDetection label JSON file is saved as
+    ``{"instances": {"<INSTANCE>": <CLASS>}, "instance_boxes": {...}, "instance_sizes": {...}}``.
+    For instance masks, all the instances are assigned to class ``0``; for semantic masks, the class index is the
+    semantic label minus one.
+
+    Parameters
+    ----------
+    input_image :
+        File path of the reference image, used only for its affine.
+    input_label :
+        File path of the label mask, or NIFTI image already loaded.
+    output_label :
+        Output path of the instance mask.
+    output_json :
+        Output path of the nnDetection label JSON file.
+    semantic :
+        Flag to convert a semantic label mask into instance segmentation. Default: ``False``.
+    connectivity :
+        Connectivity used in the semantic to instance conversion, in the range 1-3. Default: ``3``.
+    min_size :
+        Minimum instance size, in voxels, in the semantic to instance conversion. Default: ``1``.
+
+    Returns
+    -------
+        Number of instances.
+    """
+    label_nib = load_nifti(input_label)
+    image_affine = load_nifti(input_image).affine
+
+    label_array = np.asanyarray(label_nib.dataobj)
+    if not np.issubdtype(label_array.dtype, np.integer):
+        label_array = np.rint(label_array).astype(np.int32)
+
+    if semantic:
+        instance_array, instance_class_map = semantic_to_instance_per_class(label_array, connectivity, min_size, True)
+        instance_classes = {instance: class_label - 1 for instance, class_label in instance_class_map.items()}
+    else:
+        instance_array = label_array
+        instance_classes = None
+    del label_array
+    instance_boxes, instance_sizes = get_instance_boxes(instance_array)
+    if instance_classes is None:
+        instance_classes = {instance: 0 for instance in instance_boxes}
+
+    save_nifti_image(nib.Nifti1Image(instance_array, image_affine), output_label)
+    with open(output_json, "w") as json_file:
+        json.dump(
+            {
+                "instances": {str(instance): instance_class for instance, instance_class in instance_classes.items()},
+                "instance_boxes": {str(instance): box for instance, box in instance_boxes.items()},
+                "instance_sizes": {str(instance): size for instance, size in instance_sizes.items()},
+            },
+            json_file,
+        )
+    return len(instance_classes)
+
+
+def semantic_segmentation_to_instance_per_class(
+        mask_filename: str,
+        output_path: str,
+        output_json: str = None,
+        connectivity: int = 3,
+        min_volume: float = 0.0,
+        memory_lean: bool = False,
+) -> Dict[int, int]:
+    """
+    Given a multi-class semantic segmentation mask, convert each class to instance segmentation (see
+    :func:`semantic_to_instance_per_class`) and save in the given output path. Regions smaller than ``min_volume``
+    (in mm3, computed from the mask affine) are ignored. The instance to class map is optionally saved in the nnDetection
+    label JSON format, as ``{"instances": {"<INSTANCE>": <CLASS>}}``, with the class index equal to the semantic label
+    minus one.
+
+    Parameters
+    ----------
+    mask_filename:
+        File path of semantic segmentation mask, or NIFTI image already loaded.
+    output_path:
+        Output path including new instance segmentation mask file name.
+    output_json:
+        Optional output path of the nnDetection label JSON file.
+    connectivity:
+        Connectivity used to label the connected regions, in the range 1-3 (3 for 26-connectivity). Default: ``3``.
+    min_volume:
+        Minimum region volume, in mm3. Default: ``0``.
+    memory_lean:
+        Flag to save the instance mask with the smallest unsigned integer dtype. Default: ``False``.
+
+    Returns
+    -------
+        Map from instance label to semantic class label.
+    """
+    mask = load_nifti(mask_filename)
+    semantic_array = np.asanyarray(mask.dataobj)
+    if not np.issubdtype(semantic_array.dtype, np.integer):
+        semantic_array = np.rint(semantic_array).astype(np.int32)
+
+    instance_array, instance_class_map = semantic_to_instance_per_class(
+        semantic_array, connectivity, get_min_component_size(mask.affine, min_volume), memory_lean
+    )
+    save_nifti_image(nib.Nifti1Image(instance_array, affine=mask.affine), output_path)
+
+    if output_json is not None:
+        with open(output_json, "w") as json_file:
+            json.dump(
+                {"instances": {str(instance): class_label - 1 for instance, class_label in instance_class_map.items()}},
+                json_file,
+            )
+    return instance_class_map
+
+
+def iter_chunk_slices(shape: Sequence[int], chunk_size: Sequence[int]) -> Iterator[Tuple[slice, ...]]:
+    """
+    Iterate over the non-overlapping chunks of an array, in C order.
+
+    Parameters
+    ----------
+    shape :
+        Array shape.
+    chunk_size :
+        Chunk size along each axis.
+
+    Returns
+    -------
+        Iterator over the chunk slices.
+    """
+    for chunk_start in itertools.product(*[range(0, size, step) for size, step in zip(shape, chunk_size)]):
+        yield tuple(slice(start, min(start + step, size)) for start, step, size in zip(chunk_start, chunk_size, shape))
+
+
+def _find_root(parent: np.ndarray, label_id: int) -> int:
+    while parent[label_id] != label_id:
+        parent[label_id] = parent[parent[label_id]]
+        label_id = parent[label_id]
+    return label_id
+
+
+def label_components_chunked(
+        mask,
+        structure: np.ndarray = None,
+        chunk_size: Union[int, Sequence[int]] = 256,
+        min_size: int = 1,
+        output: np.ndarray = None,
+) -> Tuple[np.ndarray, int]:
+    """
+    Label the connected components of a mask chunk by chunk, reading only one chunk at a time from ``mask`` (e.g. a
+    memory-mapped array or a nibabel array proxy). Each chunk is labeled with one extra voxel on its lower borders,
+    overlapping the previous chunks: the labels of the overlapping voxels are merged with union-find, and the
+    components smaller than ``min_size`` voxels are removed.
+    The result is identical to ``scipy.ndimage.label`` followed by :func:`remove_small_components` (components are
+    numbered in raster order), while the peak memory is bounded by the chunk size, the ``output`` array (which can be
+    memory-mapped) and the label lookup tables.
+
+    Parameters
+    ----------
+    mask :
+        Input mask, as any array-like supporting slicing. Non-zero voxels are foreground.
+    structure :
+        Connectivity structuring element. Default: ``None``, face connectivity.
+    chunk_size :
+        Chunk size, for all the axes or for each axis. Default: ``256``.
+    min_size :
+        Minimum component size, in voxels. Default: ``1``.
+    output :
+        Optional ``int32`` (or wider integer) output array, of the same shape as ``mask``. Default: ``None``, a new
+        ``int32`` array.
+
+    Returns
+    -------
+        Labeled array and number of components.
+    """
+    shape = tuple(mask.shape)
+    if isinstance(chunk_size, int):
+        chunk_size = (chunk_size,) * len(shape)
+    if output is None:
+        output = np.zeros(shape, dtype=np.int32)
+    max_label = np.iinfo(output.dtype).max
+
+    parent = [np.zeros(1, dtype=np.int64)]
+    first_voxel = [np.full(1, np.iinfo(np.int64).max, dtype=np.int64)]
+    component_sizes = [np.zeros(1, dtype=np.int64)]
+    num_labels = 0
+    merged_labels = []
+    for core_slice in iter_chunk_slices(shape, chunk_size):
+        read_slice = tuple(slice(max(core.start - 1, 0), core.stop) for core in core_slice)
+        core_in_chunk = tuple(slice(core.start - read.start, None) for core, read in zip(core_slice, read_slice))
+        chunk_labels, num_chunk_labels = label(np.asarray(mask[read_slice]) != 0, structure=structure)
+        if num_chunk_labels > 0:
+            if num_labels + num_chunk_labels > max_label:
+                raise ValueError("Too many provisional labels for the {} output array".format(output.dtype))
+            # labels are numbered in order of first appearance, and the raster order within a chunk is the global order
+            foreground_voxels = np.flatnonzero(chunk_labels)
+            foreground_labels = chunk_labels.ravel()[foreground_voxels]
+            previous_max = np.maximum.accumulate(np.concatenate(([0], foreground_labels[:-1])))
+            chunk_first_voxels = np.unravel_index(
+                foreground_voxels[foreground_labels > previous_max], chunk_labels.shape
+            )
+            del foreground_voxels, foreground_labels, previous_max
+            first_voxel.append(
+                np.ravel_multi_index(
+                    tuple(voxels + read.start for voxels, read in zip(chunk_first_voxels, read_slice)), shape
+                ).astype(np.int64)
+            )
+            component_sizes.append(
+                np.bincount(chunk_labels[core_in_chunk].ravel(), minlength=num_chunk_labels + 1)[1:].astype(np.int64)
+            )
+            parent.append(np.arange(num_labels + 1, num_labels + num_chunk_labels + 1, dtype=np.int64))
+            chunk_labels[chunk_labels > 0] += num_labels
+            num_labels += num_chunk_labels
+
+            # pair the labels of the voxels overlapping the previous chunks
+            for axis, (core, read) in enumerate(zip(core_slice, read_slice)):
+                if core.start == read.start:
+                    continue
+                overlap_in_chunk = tuple(slice(0, 1) if i == axis else slice(None) for i in range(len(shape)))
+                overlap = tuple(slice(read.start, read.start + 1) if i == axis else s for i, s in enumerate(read_slice))
+                new_labels = chunk_labels[overlap_in_chunk]
+                foreground = new_labels > 0
+                merged_labels.append(
+                    np.unique(np.stack((new_labels[foreground], np.asarray(output[overlap])[foreground]), axis=1), axis=0)
+                )
+        output[core_slice] = chunk_labels[core_in_chunk]
+        del chunk_labels
+
+        if len(merged_labels) > 0:
+            parent = [np.concatenate(parent)]
+            for new_label, previous_label in np.concatenate(merged_labels):
+                new_root, previous_root = _find_root(parent[0], new_label), _find_root(parent[0], previous_label)
+                if new_root != previous_root:
+                    parent[0][max(new_root, previous_root)] = min(new_root, previous_root)
+            merged_labels = []
+
+    parent = np.concatenate(parent)
+    while True:
+        roots = parent[parent]
+        if np.array_equal(roots, parent):
+            break
+        parent = roots
+    first_voxel = np.concatenate(first_voxel)
+    component_first_voxel = np.full(len(parent), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(component_first_voxel, parent, first_voxel)
+    component_sizes = np.bincount(parent, weights=np.concatenate(component_sizes), minlength=len(parent))
+
+    kept_roots = np.flatnonzero((parent == np.arange(len(parent))) & (component_sizes >= min_size))
+    kept_roots = kept_roots[kept_roots > 0]
+    kept_roots = kept_roots[np.argsort(component_first_voxel[kept_roots], kind="stable")]
+    num_features = len(kept_roots)
+    root_labels = np.zeros(len(parent), dtype=output.dtype)
+    root_labels[kept_roots] = np.arange(1, num_features + 1)
+    lookup_table = root_labels[parent]
+
+    for core_slice in iter_chunk_slices(shape, chunk_size):
+        output[core_slice] = lookup_table[np.asarray(output[core_slice])]
+    return output, num_features
+
+
+def semantic_segmentation_to_instance_chunked(
+        mask_filename: str,
+        output_path: str,
+        chunk_size: Union[int, Sequence[int]] = 256,
+        connectivity: int = 3,
+        min_size: int = 10,
+        min_volume: float = None,
+) -> int:
+    """
+    Out-of-core version of :func:`semantic_segmentation_to_instance`, for volumes not fitting in memory together with
+    their labeled copy. The mask is read chunk by chunk from a memory-mapped file (compressed masks are first
+    decompressed into the volume cache, or into a temporary folder next to the output if the cache is disabled), and
+    labeled with :func:`label_components_chunked` into a memory-mapped ``int32`` NIFTI file, compressed into
+    ``output_path`` at the end if required. The instance mask is identical to the one of
+    :func:`semantic_segmentation_to_instance`.
+
+    Parameters
+    ----------
+    mask_filename:
+        File path of semantic segmentation mask.
+    output_path:
+        Output path including new instance segmentation mask file name.
+    chunk_size:
+        Chunk size, for all the axes or for each axis. Default: ``256``.
+    connectivity:
+        Connectivity used to label the connected regions, in the range 1-3 (3 for 26-connectivity). Default: ``3``.
+    min_size:
+        Minimum region size, in voxels. Smaller regions are ignored. Default: ``10``.
+    min_volume:
+        Optional minimum region volume, in mm3, computed from the mask affine. If given, it replaces ``min_size``.
+
+    Returns
+    -------
+        Number of labels in converted instance segmentation mask.
+    """
+    output_folder = Path(output_path).parent
+    output_folder.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output_folder) as tmp_folder:
+        cache_folder = get_volume_cache_folder()
+        mask = nib.load(get_cached_volume_file(mask_filename, cache_folder if cache_folder is not None else tmp_folder))
+        if min_volume is not None:
+            min_size = get_min_component_size(mask.affine, min_volume)
+
+        header = nib.Nifti1Header()
+        header.set_data_dtype(np.int32)
+        header.set_data_shape(mask.shape)
+        header.set_sform(mask.affine, code="aligned")
+        header.set_qform(mask.affine, code="unknown")
+        header.set_data_offset(352)
+        labeled_file = Path(tmp_folder).joinpath("{}.nii".format(uuid.uuid4().hex))
+        with open(labeled_file, "wb") as labeled_fileobj:
+            header.write_to(labeled_fileobj)
+            labeled_fileobj.truncate(352 + int(np.prod(mask.shape)) * 4)
+        labeled_array = np.memmap(labeled_file, dtype=np.int32, mode="r+", offset=352, shape=mask.shape, order="F")
+
+        labeled_array, num_features = label_components_chunked(
+            mask.dataobj, generate_binary_structure(len(mask.shape), connectivity), chunk_size, min_size, labeled_array
+        )
+        labeled_array.flush()
+        del labeled_array, mask
+
+        if str(output_path).endswith(".gz"):
+            compress_file(labeled_file, output_path)
+        else:
+            os.replace(labeled_file, output_path)
     return num_features
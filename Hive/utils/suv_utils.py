@@ -0,0 +1,567 @@
+import datetime
+import json
+import math
+from os import PathLike
+from pathlib import Path
+from multiprocessing import Pool
+from typing import Union, Dict, List, Tuple
+
+import SimpleITK as sitk
+import pydicom
+from tqdm import tqdm
+
+from Hive.utils.gzip_utils import write_image
+from Hive.utils.log_utils import get_logger, DEBUG, INFO
+from Hive.utils.volume_cache_utils import read_image
+
+logger = get_logger(__name__)
+
+SUV_TYPES = ("bw", "lbm", "bsa")
+BQML_UNITS = "BQML"
+
+
+def _parse_dicom_datetime(dicom_date: str, dicom_time: str) -> datetime.datetime:
+    dicom_time = str(dicom_time).strip()
+    seconds_fraction = 0.0
+    if "." in dicom_time:
+        dicom_time, fraction = dicom_time.split(".", 1)
+        seconds_fraction = float("0." + fraction)
+    dicom_time = dicom_time.ljust(6, "0")
+    return datetime.datetime.strptime(str(dicom_date).strip() + dicom_time, "%Y%m%d%H%M%S") + datetime.timedelta(
+        seconds=seconds_fraction
+    )
+
+
+def read_SUV_parameters(ds: pydicom.Dataset) -> Dict[str, object]:
+    """
+    Read the DICOM header fields needed to compute the SUV scale factor of a PET series.
+
+    Parameters
+    ----------
+    ds :
+        DICOM dataset of a PET series file. Pixel data are not needed (``stop_before_pixels=True``).
+
+    Returns
+    -------
+        JSON serializable dictionary with the SUV parameters: ``units``, ``corrected_image``, ``decay_correction``,
+        ``scan_datetime``, ``injection_datetime`` (ISO format), ``injected_dose`` [Bq], ``half_life`` [s],
+        ``patient_weight`` [kg], ``patient_size`` [m] and ``patient_sex``.
+
+    Raises
+    ------
+    ValueError
+        If any of the required fields is missing.
+    """
+    required_fields = ["Units", "CorrectedImage", "DecayCorrection", "PatientWeight", "RadiopharmaceuticalInformationSequence"]
+    missing_fields = [field for field in required_fields if field not in ds]
+    if len(missing_fields) > 0:
+        raise ValueError("Missing DICOM fields required for SUV normalization: {}".format(missing_fields))
+
+    radiopharmaceutical_information = ds.RadiopharmaceuticalInformationSequence[0]
+
+    if "SeriesDate" in ds and "SeriesTime" in ds and "AcquisitionDate" in ds and "AcquisitionTime" in ds:
+        series_datetime = _parse_dicom_datetime(ds.SeriesDate, ds.SeriesTime)
+        acquisition_datetime = _parse_dicom_datetime(ds.AcquisitionDate, ds.AcquisitionTime)
+        scan_datetime = min(series_datetime, acquisition_datetime)
+    elif "SeriesDate" in ds and "SeriesTime" in ds:
+        scan_datetime = _parse_dicom_datetime(ds.SeriesDate, ds.SeriesTime)
+    else:
+        raise ValueError("Missing DICOM fields required for SUV normalization: ['SeriesDate', 'SeriesTime']")
+
+    if "RadiopharmaceuticalStartDateTime" in radiopharmaceutical_information:
+        start_datetime = str(radiopharmaceutical_information.RadiopharmaceuticalStartDateTime)
+        injection_datetime = _parse_dicom_datetime(start_datetime[:8], start_datetime[8:].split("+")[0].split("-")[0])
+    elif "RadiopharmaceuticalStartTime" in radiopharmaceutical_information:
+        injection_datetime = _parse_dicom_datetime(
+            scan_datetime.strftime("%Y%m%d"), radiopharmaceutical_information.RadiopharmaceuticalStartTime
+        )
+    else:
+        raise ValueError("Missing DICOM fields required for SUV normalization: ['RadiopharmaceuticalStartTime']")
+
+    for field in ["RadionuclideTotalDose", "RadionuclideHalfLife"]:
+        if field not in radiopharmaceutical_information:
+            raise ValueError("Missing DICOM fields required for SUV normalization: ['{}']".format(field))
+
+    return {
+        "units": str(ds.Units),
+        "corrected_image": [str(x) for x in ds.CorrectedImage],
+        "decay_correction": str(ds.DecayCorrection),
+        "scan_datetime": scan_datetime.isoformat(),
+        "injection_datetime": injection_datetime.isoformat(),
+        "injected_dose": float(radiopharmaceutical_information.RadionuclideTotalDose),
+        "half_life": float(radiopharmaceutical_information.RadionuclideHalfLife),
+        "patient_weight": float(ds.PatientWeight),
+        "patient_size": float(ds.PatientSize) if ds.get("PatientSize", None) else None,
+        "patient_sex": str(ds.get("PatientSex", "")),
+    }
+
+
+def compute_SUV_scale_factor(suv_parameters: Dict[str, object], suv_type: str = "bw") -> float:
+    """
+    Compute the SUV scale factor, to be applied to a PET volume in Bq/ml. The SUV variants are:
+
+        ``bw``: body weight, [g/ml].
+        ``lbm``: lean body mass (James formula), [g/ml].
+        ``bsa``: body surface area (Du Bois formula), [cm2/ml].
+
+    Images decay corrected to the series start (``START``) use the injected dose decayed to the scan time, while
+    images decay corrected to the administration time (``ADMIN``) use the injected dose.
+
+    Parameters
+    ----------
+    suv_parameters :
+        SUV parameters, as returned by :func:`read_SUV_parameters`.
+    suv_type :
+        SUV variant, one of ``bw``, ``lbm`` and ``bsa``. Default: ``bw``.
+
+    Returns
+    -------
+        SUV scale factor.
+
+    Raises
+    ------
+    ValueError
+        If the PET series does not fit any supported case.
+    """
+    if suv_type not in SUV_TYPES:
+        raise ValueError("SUV type must be one of {}, got '{}'".format(SUV_TYPES, suv_type))
+
+    if suv_parameters["units"] == "GML":
+        if suv_type != "bw":
+            raise ValueError("PET series is already normalized to SUV bw (Units: GML), SUV {} is not supported".format(suv_type))
+        return 1.0
+    if suv_parameters["units"] != "BQML":
+        raise ValueError("Unsupported PET Units '{}': only BQML and GML are supported".format(suv_parameters["units"]))
+    if "ATTN" not in suv_parameters["corrected_image"] or "DECY" not in suv_parameters["corrected_image"]:
+        raise ValueError(
+            "PET series must be attenuation and decay corrected (ATTN, DECY), found CorrectedImage: {}".format(
+                suv_parameters["corrected_image"]
+            )
+        )
+
+    if suv_parameters["decay_correction"] == "START":
+        decay_time = (
+            datetime.datetime.fromisoformat(suv_parameters["scan_datetime"])
+            - datetime.datetime.fromisoformat(suv_parameters["injection_datetime"])
+        ).total_seconds()
+        decayed_dose = suv_parameters["injected_dose"] * math.pow(2, -decay_time / suv_parameters["half_life"])
+    elif suv_parameters["decay_correction"] == "ADMIN":
+        decayed_dose = suv_parameters["injected_dose"]
+    else:
+        raise ValueError(
+            "Unsupported PET DecayCorrection '{}': only START and ADMIN are supported".format(suv_parameters["decay_correction"])
+        )
+
+    weight = suv_parameters["patient_weight"]
+    if suv_type == "bw":
+        return weight * 1000 / decayed_dose
+
+    if suv_parameters["patient_size"] is None:
+        raise ValueError("PatientSize is required to compute SUV {}".format(suv_type))
+    height = suv_parameters["patient_size"] * 100
+
+    if suv_type == "lbm":
+        if suv_parameters["patient_sex"] == "M":
+            lean_body_mass = 1.10 * weight - 128 * (weight / height) ** 2
+        elif suv_parameters["patient_sex"] == "F":
+            lean_body_mass = 1.07 * weight - 148 * (weight / height) ** 2
+        else:
+            raise ValueError("PatientSex (M/F) is required to compute SUV lbm, got '{}'".format(suv_parameters["patient_sex"]))
+        return lean_body_mass * 1000 / decayed_dose
+
+    body_surface_area = 0.007184 * weight**0.425 * height**0.725
+    return body_surface_area * 10000 / decayed_dose
+
+
+def get_SUV_sidecar_filename(pet_filename: Union[str, PathLike]) -> str:
+    """
+    Returns the SUV sidecar JSON filename for a PET NIFTI file (e.g. ``PET.nii.gz`` -> ``PET_SUV.json``).
+
+    Parameters
+    ----------
+    pet_filename :
+        PET NIFTI file path.
+
+    Returns
+    -------
+        SUV sidecar JSON file path.
+    """
+    pet_filename = str(pet_filename)
+    for extension in (".nii.gz", ".nii"):
+        if pet_filename.endswith(extension):
+            pet_filename = pet_filename[: -len(extension)]
+            break
+    return pet_filename + "_SUV.json"
+
+
+def _read_series_header(dicom_pet_series_folder: Union[str, PathLike]) -> pydicom.Dataset:
+    dicom_files = sorted(Path(dicom_pet_series_folder).glob("*.dcm"))
+    if len(dicom_files) == 0:
+        raise ValueError("No DICOM files found in {}".format(dicom_pet_series_folder))
+    return pydicom.dcmread(str(dicom_files[0]), stop_before_pixels=True)
+
+
+def compute_SUV_sidecar(dicom_pet_series_folder: Union[str, PathLike], ds: pydicom.Dataset = None) -> Dict[str, object]:
+    """
+    Compute the SUV scale factors for all the SUV variants of a DICOM PET series, reading a single DICOM header. The
+    returned sidecar records the SUV parameters, the scale factors (``None`` for the unsupported variants) and the
+    corresponding errors, to be saved as JSON and re-used without reading the DICOM series again.
+
+    Parameters
+    ----------
+    dicom_pet_series_folder :
+        DICOM PET series folder.
+    ds :
+        Optional DICOM dataset of a file of the series. Default: ``None``, the first DICOM file of the series is read.
+
+    Returns
+    -------
+        SUV sidecar dictionary.
+    """
+    if ds is None:
+        ds = _read_series_header(dicom_pet_series_folder)
+    suv_parameters = read_SUV_parameters(ds)
+
+    scale_factors = {}
+    errors = {}
+    for suv_type in SUV_TYPES:
+        try:
+            scale_factors[suv_type] = compute_SUV_scale_factor(suv_parameters, suv_type)
+        except ValueError as e:
+            scale_factors[suv_type] = None
+            errors[suv_type] = str(e)
+
+    return {
+        "series_folder": str(dicom_pet_series_folder),
+        "series_instance_uid": str(ds.get("SeriesInstanceUID", "")),
+        "suv_parameters": suv_parameters,
+        "scale_factors": scale_factors,
+        "errors": errors,
+    }
+
+
+def save_SUV_sidecar(suv_sidecar: Dict[str, object], sidecar_file: Union[str, PathLike]):
+    """
+    Save the SUV sidecar as JSON file.
+
+    Parameters
+    ----------
+    suv_sidecar :
+        SUV sidecar dictionary, as returned by :func:`compute_SUV_sidecar`.
+    sidecar_file :
+        JSON file path.
+    """
+    with open(sidecar_file, "w") as fp:
+        json.dump(suv_sidecar, fp, indent=4)
+
+
+def load_SUV_sidecar(sidecar_file: Union[str, PathLike]) -> Dict[str, object]:
+    """
+    Load a SUV sidecar JSON file.
+
+    Parameters
+    ----------
+    sidecar_file :
+        SUV sidecar JSON file.
+
+    Returns
+    -------
+        SUV sidecar dictionary.
+    """
+    with open(sidecar_file, "r") as fp:
+        return json.load(fp)
+
+
+def is_SUV_sidecar_matching(
+        suv_sidecar: Dict[str, object], dicom_pet_series_folder: Union[str, PathLike], series_instance_uid: str = None
+) -> bool:
+    """
+    Check if a SUV sidecar belongs to a DICOM PET series, comparing the ``SeriesInstanceUID`` when available in both,
+    otherwise the series folder.
+
+    Parameters
+    ----------
+    suv_sidecar :
+        SUV sidecar dictionary.
+    dicom_pet_series_folder :
+        DICOM PET series folder.
+    series_instance_uid :
+        Optional ``SeriesInstanceUID`` of the series.
+
+    Returns
+    -------
+        ``True`` if the sidecar was computed for the series, ``False`` otherwise.
+    """
+    if series_instance_uid and suv_sidecar.get("series_instance_uid", ""):
+        return suv_sidecar["series_instance_uid"] == series_instance_uid
+    return Path(suv_sidecar.get("series_folder", "")).resolve() == Path(dicom_pet_series_folder).resolve()
+
+
+def get_SUV_sidecar(
+        dicom_pet_series_folder: Union[str, PathLike],
+        sidecar_file: Union[str, PathLike],
+        ds: pydicom.Dataset = None,
+        overwrite: bool = False,
+) -> Dict[str, object]:
+    """
+    Load the SUV sidecar of a DICOM PET series, if it exists and belongs to the series (see
+    :func:`is_SUV_sidecar_matching`), otherwise compute and save it. The ``output_units`` of the PET volume are kept
+    when recomputing the sidecar of the same series.
+
+    Parameters
+    ----------
+    dicom_pet_series_folder :
+        DICOM PET series folder.
+    sidecar_file :
+        SUV sidecar JSON file.
+    ds :
+        Optional DICOM dataset of a file of the series. Default: ``None``, the first DICOM file of the series is read.
+    overwrite :
+        Flag to recompute the existing sidecar. Default: ``False``.
+
+    Returns
+    -------
+        SUV sidecar dictionary.
+
+    Raises
+    ------
+    ValueError
+        If the SUV parameters can not be read from the DICOM header.
+    """
+    if ds is None:
+        ds = _read_series_header(dicom_pet_series_folder)
+    series_instance_uid = str(ds.get("SeriesInstanceUID", ""))
+
+    existing_sidecar = None
+    if Path(sidecar_file).is_file():
+        existing_sidecar = load_SUV_sidecar(sidecar_file)
+        if not is_SUV_sidecar_matching(existing_sidecar, dicom_pet_series_folder, series_instance_uid):
+            logger.warning(
+                "SUV sidecar {} does not belong to {}, recomputing it".format(sidecar_file, dicom_pet_series_folder)
+            )
+            Path(sidecar_file).unlink()
+            existing_sidecar = None
+        elif not overwrite:
+            return existing_sidecar
+
+    suv_sidecar = compute_SUV_sidecar(dicom_pet_series_folder, ds)
+    if existing_sidecar is not None and "output_units" in existing_sidecar:
+        suv_sidecar["output_units"] = existing_sidecar["output_units"]
+    save_SUV_sidecar(suv_sidecar, sidecar_file)
+    return suv_sidecar
+
+
+def get_SUV_scale_factor_from_sidecar(
+        sidecar_file: Union[str, PathLike], suv_type: str = "bw", suv_sidecar: Dict[str, object] = None
+) -> float:
+    """
+    Load the SUV scale factor from a SUV sidecar JSON file.
+
+    Parameters
+    ----------
+    sidecar_file :
+        SUV sidecar JSON file.
+    suv_type :
+        SUV variant, one of ``bw``, ``lbm`` and ``bsa``. Default: ``bw``.
+    suv_sidecar :
+        Optional SUV sidecar dictionary, already loaded from ``sidecar_file``.
+
+    Returns
+    -------
+        SUV scale factor.
+
+    Raises
+    ------
+    ValueError
+        If the SUV variant could not be computed for the series.
+    """
+    if suv_sidecar is None:
+        suv_sidecar = load_SUV_sidecar(sidecar_file)
+    if suv_sidecar["scale_factors"].get(suv_type, None) is None:
+        raise ValueError(
+            "SUV {} is not available in {}: {}".format(suv_type, sidecar_file, suv_sidecar["errors"].get(suv_type, ""))
+        )
+    return suv_sidecar["scale_factors"][suv_type]
+
+
+def convert_PET_to_SUV(
+        dicom_pet_series_folder: Union[str, PathLike],
+        suv_pet_filename: Union[str, PathLike],
+        suv_type: str = "bw",
+        compression_level: int = 1,
+        sidecar_file: Union[str, PathLike] = None,
+) -> float:
+    """
+    SUV Normalization of DICOM PET volume. The SUV scale factor is computed from the DICOM header of the first file,
+    then applied in place to the PET volume, read directly as float32. The resulting SUV PET volume is saved at
+    **suv_pet_filename**.
+    If ``sidecar_file`` is given, the scale factor is loaded from it when it exists and belongs to the series, otherwise
+    the SUV sidecar is computed and saved. The units of the saved volume (``BQML`` for Bq/ml, or ``SUV <suv_type>``)
+    are recorded in the sidecar as ``output_units``. When ``suv_type`` is ``None``, series without the SUV DICOM fields
+    are converted without sidecar.
+
+    Parameters
+    ----------
+    dicom_pet_series_folder :
+        DICOM PET Folder to be normalized.
+    suv_pet_filename :
+        Normalized SUV PET file location.
+    suv_type :
+        SUV variant, one of ``bw``, ``lbm`` and ``bsa``. If ``None``, the PET volume is saved in Bq/ml. Default: ``bw``.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    sidecar_file :
+        Optional SUV sidecar JSON file.
+
+    Returns
+    -------
+        Applied SUV scale factor.
+    """
+    reader = sitk.ImageSeriesReader()
+    dicom_names = reader.GetGDCMSeriesFileNames(str(dicom_pet_series_folder))
+    ds = pydicom.dcmread(dicom_names[0], stop_before_pixels=True)
+
+    suv_sidecar = None
+    if sidecar_file is not None:
+        try:
+            suv_sidecar = get_SUV_sidecar(dicom_pet_series_folder, sidecar_file, ds)
+        except ValueError as e:
+            if suv_type is not None:
+                raise
+            logger.warning("SUV sidecar for {} not computed: {}".format(dicom_pet_series_folder, e))
+
+    if suv_type is None:
+        suv_scale_factor = 1.0
+        output_units = str(ds.get("Units", ""))
+    elif suv_sidecar is not None:
+        suv_scale_factor = get_SUV_scale_factor_from_sidecar(sidecar_file, suv_type, suv_sidecar)
+        output_units = "SUV {}".format(suv_type)
+    else:
+        suv_scale_factor = compute_SUV_scale_factor(read_SUV_parameters(ds), suv_type)
+        output_units = "SUV {}".format(suv_type)
+    logger.log(DEBUG, "SUV {} scale factor for {}: {}".format(suv_type, dicom_pet_series_folder, suv_scale_factor))
+
+    reader.SetFileNames(dicom_names)
+    reader.SetOutputPixelType(sitk.sitkFloat32)
+    image = reader.Execute()
+    if suv_scale_factor != 1.0:
+        image *= suv_scale_factor
+
+    write_image(image, suv_pet_filename, compression_level)
+    if suv_sidecar is not None:
+        suv_sidecar["output_units"] = output_units
+        save_SUV_sidecar(suv_sidecar, sidecar_file)
+    return suv_scale_factor
+
+
+def read_SUV_image(
+        pet_filename: Union[str, PathLike], suv_type: str = "bw", sidecar_file: Union[str, PathLike] = None
+) -> sitk.Image:
+    """
+    Read a PET NIFTI volume in Bq/ml as float32, applying the SUV scale factor stored in the SUV sidecar. The
+    ``output_units`` recorded in the sidecar must be ``BQML``.
+
+    Parameters
+    ----------
+    pet_filename :
+        PET NIFTI file, in Bq/ml.
+    suv_type :
+        SUV variant, one of ``bw``, ``lbm`` and ``bsa``. Default: ``bw``.
+    sidecar_file :
+        SUV sidecar JSON file. Default: ``None``, derived from ``pet_filename`` (see :func:`get_SUV_sidecar_filename`).
+
+    Returns
+    -------
+        SUV PET image.
+
+    Raises
+    ------
+    ValueError
+        If the PET volume is not in Bq/ml, or if the SUV variant could not be computed for the series.
+    """
+    if sidecar_file is None:
+        sidecar_file = get_SUV_sidecar_filename(pet_filename)
+    suv_sidecar = load_SUV_sidecar(sidecar_file)
+    if suv_sidecar.get("output_units", None) != BQML_UNITS:
+        raise ValueError(
+            "{} is not in Bq/ml (units: {}), SUV scale factor not applied".format(
+                pet_filename, suv_sidecar.get("output_units", "unknown")
+            )
+        )
+    scale_factor = get_SUV_scale_factor_from_sidecar(sidecar_file, suv_type, suv_sidecar)
+    image = read_image(pet_filename, sitk.sitkFloat32)
+    image *= scale_factor
+    return image
+
+
+def apply_SUV_scale_factor(
+        pet_filename: Union[str, PathLike],
+        suv_pet_filename: Union[str, PathLike],
+        suv_type: str = "bw",
+        sidecar_file: Union[str, PathLike] = None,
+        compression_level: int = 1,
+):
+    """
+    Normalize an existing PET NIFTI volume in Bq/ml to SUV, using the scale factor stored in the SUV sidecar, without
+    reading the DICOM series.
+
+    Parameters
+    ----------
+    pet_filename :
+        PET NIFTI file, in Bq/ml.
+    suv_pet_filename :
+        Normalized SUV PET file location.
+    suv_type :
+        SUV variant, one of ``bw``, ``lbm`` and ``bsa``. Default: ``bw``.
+    sidecar_file :
+        SUV sidecar JSON file. Default: ``None``, derived from ``pet_filename`` (see :func:`get_SUV_sidecar_filename`).
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    """
+    image = read_SUV_image(pet_filename, suv_type, sidecar_file)
+    write_image(image, suv_pet_filename, compression_level)
+
+
+def _compute_and_save_SUV_sidecar(sidecar_args: Tuple[str, str, bool]) -> Tuple[str, bool]:
+    dicom_pet_series_folder, sidecar_file, overwrite = sidecar_args
+    try:
+        get_SUV_sidecar(dicom_pet_series_folder, sidecar_file, overwrite=overwrite)
+    except ValueError as e:
+        logger.warning("SUV sidecar for {} not computed: {}".format(dicom_pet_series_folder, e))
+        return sidecar_file, False
+    return sidecar_file, True
+
+
+def compute_SUV_sidecars(
+        pet_series: List[Tuple[Union[str, PathLike], Union[str, PathLike]]], num_threads: int = 1, overwrite: bool = False
+) -> List[str]:
+    """
+    Compute and save the SUV sidecars for a list of DICOM PET series, reading only one DICOM header for each series.
+    Existing sidecars are kept if they belong to the same series, unless ``overwrite`` is set.
+
+    Parameters
+    ----------
+    pet_series :
+        List of (DICOM PET series folder, SUV sidecar JSON file) pairs.
+    num_threads :
+        Number of processes used to compute the sidecars. Default: ``1``.
+    overwrite :
+        Flag to recompute existing sidecars. Default: ``False``.
+
+    Returns
+    -------
+        List of the available SUV sidecar files.
+    """
+    sidecar_files = []
+    with Pool(num_threads) as pool:
+        for sidecar_file, available in tqdm(
+                pool.imap_unordered(
+                    _compute_and_save_SUV_sidecar,
+                    [(str(series_folder), str(sidecar_file), overwrite) for series_folder, sidecar_file in pet_series],
+                ),
+                total=len(pet_series),
+        ):
+            if available:
+                sidecar_files.append(sidecar_file)
+    logger.log(INFO, "{} SUV sidecars available for {} PET series".format(len(sidecar_files), len(pet_series)))
+    return sidecar_files
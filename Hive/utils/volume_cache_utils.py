@@ -0,0 +1,302 @@
+import gzip
+import hashlib
+import os
+import shutil
+import uuid
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from os import PathLike
+from pathlib import Path
+from typing import Union, Optional, Dict, Iterable, Iterator, Tuple
+
+import SimpleITK as sitk
+import nibabel as nib
+import numpy as np
+
+from Hive.utils.log_utils import get_logger, DEBUG
+
+logger = get_logger(__name__)
+
+VOLUME_CACHE_FOLDER_ENV = "HIVE_VOLUME_CACHE"
+VOLUME_CACHE_SIZE_ENV = "HIVE_VOLUME_CACHE_SIZE_GB"
+DEFAULT_VOLUME_CACHE_SIZE_GB = 20
+VOLUME_CACHE_RETRIES = 3
+
+
+def get_volume_cache_folder() -> Optional[str]:
+    """
+    Returns the volume cache folder, set with the ``HIVE_VOLUME_CACHE`` environment variable.
+
+    Returns
+    -------
+        Volume cache folder, or ``None`` if the volume cache is disabled.
+    """
+    cache_folder = os.environ.get(VOLUME_CACHE_FOLDER_ENV, "")
+    if cache_folder == "":
+        return None
+    return cache_folder
+
+
+def get_volume_cache_size() -> int:
+    """
+    Returns the maximum volume cache size in bytes, set in GB with the ``HIVE_VOLUME_CACHE_SIZE_GB`` environment
+    variable (Default: 20 GB).
+
+    Returns
+    -------
+        Maximum volume cache size, in bytes.
+    """
+    return int(float(os.environ.get(VOLUME_CACHE_SIZE_ENV, DEFAULT_VOLUME_CACHE_SIZE_GB)) * 1024**3)
+
+
+def get_volume_cache_key(filename: Union[str, PathLike]) -> str:
+    """
+    Returns the cache key of a source volume, computed as hash of the absolute file path, size and modification time.
+    A modified source file gets a new key, and the stale cache entry is evicted when the cache is full.
+
+    Parameters
+    ----------
+    filename :
+        Source volume file.
+
+    Returns
+    -------
+        Cache key.
+    """
+    stat = os.stat(filename)
+    source_id = "{}:{}:{}".format(Path(filename).resolve(), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(source_id.encode("utf-8")).hexdigest()
+
+
+def evict_volume_cache(cache_folder: Union[str, PathLike], max_cache_size: int, keep_file: Union[str, PathLike] = None) -> int:
+    """
+    Remove the least recently used volumes from the cache folder, until the cache size is below ``max_cache_size``.
+    Volumes returned by :func:`load_nifti` are memory-mapped when loaded, so they stay readable after eviction; cached
+    files referenced only by name (e.g. nibabel images loaded directly from :func:`get_cached_volume_file`) do not.
+
+    Parameters
+    ----------
+    cache_folder :
+        Volume cache folder.
+    max_cache_size :
+        Maximum cache size, in bytes.
+    keep_file :
+        Optional cached volume to never evict.
+
+    Returns
+    -------
+        Number of evicted volumes.
+    """
+    with os.scandir(cache_folder) as entries:
+        cached_files = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in entries
+            if entry.is_file() and entry.name.endswith(".nii")
+        ]
+    if keep_file is not None:
+        cached_files = [cached_file for cached_file in cached_files if Path(cached_file[2]).name != Path(keep_file).name]
+    cache_size = sum(size for _, size, _ in cached_files)
+    if keep_file is not None:
+        cache_size += os.stat(keep_file).st_size
+    n_evicted = 0
+    for _, size, path in sorted(cached_files):
+        if cache_size <= max_cache_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+        n_evicted += 1
+    if n_evicted > 0:
+        logger.log(DEBUG, "Evicted {} volumes from {}".format(n_evicted, cache_folder))
+    return n_evicted
+
+
+def get_cached_volume_file(
+        filename: Union[str, PathLike], cache_folder: Union[str, PathLike] = None, max_cache_size: int = None
+) -> str:
+    """
+    Returns the path of the uncompressed ``.nii`` version of a ``.nii.gz`` volume, decompressing it into the volume
+    cache folder on the first access. Cache hits are marked as recently used, and the least recently used volumes
+    are evicted when the cache exceeds ``max_cache_size``.
+    Uncompressed volumes, and all volumes when the cache is disabled, are returned unchanged.
+
+    Parameters
+    ----------
+    filename :
+        Source volume file.
+    cache_folder :
+        Volume cache folder. Default: ``None``, set from the ``HIVE_VOLUME_CACHE`` environment variable. If not set,
+        the volume cache is disabled.
+    max_cache_size :
+        Maximum cache size, in bytes. Default: ``None``, set from the ``HIVE_VOLUME_CACHE_SIZE_GB`` environment
+        variable.
+
+    Returns
+    -------
+        Volume file to read.
+    """
+    if cache_folder is None:
+        cache_folder = get_volume_cache_folder()
+    if cache_folder is None or not str(filename).endswith(".nii.gz"):
+        return str(filename)
+    if max_cache_size is None:
+        max_cache_size = get_volume_cache_size()
+
+    cached_file = Path(cache_folder).joinpath(get_volume_cache_key(filename) + ".nii")
+    try:
+        os.utime(cached_file)
+        return str(cached_file)
+    except FileNotFoundError:
+        # not cached, or evicted by another process: cache miss
+        pass
+
+    Path(cache_folder).mkdir(parents=True, exist_ok=True)
+    # decompress to a unique temporary file, so that concurrent processes never read partial volumes
+    tmp_file = Path(cache_folder).joinpath("{}.{}.tmp".format(cached_file.name, uuid.uuid4().hex))
+    try:
+        with gzip.open(filename, "rb") as source, open(tmp_file, "wb") as destination:
+            shutil.copyfileobj(source, destination, 16 * 1024**2)
+        os.replace(tmp_file, cached_file)
+    finally:
+        if tmp_file.is_file():
+            os.remove(tmp_file)
+    logger.log(DEBUG, "Cached {} as {}".format(filename, cached_file))
+
+    evict_volume_cache(cache_folder, max_cache_size, cached_file)
+    return str(cached_file)
+
+
+def load_nifti(filename: Union[str, PathLike, nib.Nifti1Image]) -> nib.Nifti1Image:
+    """
+    Load a NIFTI volume with nibabel through the volume cache (see :func:`get_cached_volume_file`). Cached volumes are
+    memory-mapped before returning, so the volume data are read from disk only when accessed, and the image stays
+    readable even if the cached file is later evicted. If the cached file is evicted by another process before it is
+    opened, it is cached again.
+
+    Parameters
+    ----------
+    filename :
+        NIFTI file. NIFTI images already loaded (e.g. by :func:`prefetch_volumes`) are returned unchanged.
+
+    Returns
+    -------
+        NIFTI image.
+    """
+    if isinstance(filename, nib.Nifti1Image):
+        return filename
+    for attempt in range(VOLUME_CACHE_RETRIES):
+        cached_file = get_cached_volume_file(filename)
+        if cached_file == str(filename):
+            return nib.load(filename, mmap=True)
+        try:
+            image = nib.load(cached_file, mmap=True)
+            # map the data now, as the array proxy would reopen the cached file by name on each access
+            return nib.Nifti1Image(np.asanyarray(image.dataobj), image.affine, image.header)
+        except FileNotFoundError:
+            if attempt == VOLUME_CACHE_RETRIES - 1:
+                raise
+            logger.log(DEBUG, "{} evicted before loading, caching it again".format(cached_file))
+
+
+def load_nifti_in_memory(filename: Union[str, PathLike]) -> nib.Nifti1Image:
+    """
+    Load a NIFTI volume through the volume cache (see :func:`load_nifti`), reading and decompressing the whole volume
+    data into memory.
+
+    Parameters
+    ----------
+    filename :
+        NIFTI file.
+
+    Returns
+    -------
+        NIFTI image, with the volume data in memory.
+    """
+    image = load_nifti(filename)
+    return nib.Nifti1Image(np.array(image.dataobj), image.affine, image.header)
+
+
+def _load_case_volumes(case: Tuple[str, Dict[str, str]]) -> Tuple[str, Dict[str, nib.Nifti1Image]]:
+    case_id, case_files = case
+    return case_id, {key: load_nifti_in_memory(filename) for key, filename in case_files.items()}
+
+
+def prefetch_volumes(
+        cases: Iterable[Tuple[str, Dict[str, str]]],
+        num_prefetch: int = 2,
+        memory_budget: int = None,
+        num_threads: int = None,
+) -> Iterator[Tuple[str, Dict[str, nib.Nifti1Image]]]:
+    """
+    Iterate over the cases of a dataset, loading the volumes of the next cases in a thread pool (see
+    :func:`load_nifti_in_memory`) while the current case is processed, so that reading and decompression overlap with
+    the computation. Cases are returned in order.
+    The number of prefetched cases is limited by ``num_prefetch`` and, optionally, by ``memory_budget``, estimating the
+    size of each case as the largest case loaded so far. At least one case is always loaded.
+
+    Parameters
+    ----------
+    cases :
+        Iterable of (case ID, ``{key -> NIFTI file}``) tuples.
+    num_prefetch :
+        Maximum number of cases loaded in advance. Default: ``2``.
+    memory_budget :
+        Optional memory budget for the prefetched cases, in bytes. Default: ``None``, no limit.
+    num_threads :
+        Number of loading threads. Default: ``None``, equal to ``num_prefetch``.
+
+    Returns
+    -------
+        Iterator over (case ID, ``{key -> NIFTI image}``) tuples.
+    """
+    num_prefetch = max(1, num_prefetch)
+    case_iterator = iter(cases)
+    pending_cases = deque()
+    case_size = 0
+
+    def submit_cases():
+        while len(pending_cases) < num_prefetch and (
+                len(pending_cases) == 0 or memory_budget is None or (len(pending_cases) + 1) * case_size <= memory_budget
+        ):
+            case = next(case_iterator, None)
+            if case is None:
+                return
+            pending_cases.append(pool.apply_async(_load_case_volumes, (case,)))
+
+    with ThreadPool(num_threads if num_threads is not None else num_prefetch) as pool:
+        submit_cases()
+        while len(pending_cases) > 0:
+            case_id, case_volumes = pending_cases.popleft().get()
+            case_size = max(case_size, sum(volume.dataobj.nbytes for volume in case_volumes.values()))
+            submit_cases()
+            logger.log(DEBUG, "Prefetched {} ({} cases pending)".format(case_id, len(pending_cases)))
+            yield case_id, case_volumes
+
+
+def read_image(filename: Union[str, PathLike], pixel_type: int = sitk.sitkUnknown) -> sitk.Image:
+    """
+    Read a NIFTI volume with SimpleITK through the volume cache (see :func:`get_cached_volume_file`). If the cached
+    file is evicted by another process before it is read, it is cached again.
+
+    Parameters
+    ----------
+    filename :
+        NIFTI file.
+    pixel_type :
+        Optional SimpleITK output pixel type. Default: ``sitk.sitkUnknown``, the pixel type stored in the file.
+
+    Returns
+    -------
+        SimpleITK image.
+    """
+    for attempt in range(VOLUME_CACHE_RETRIES):
+        cached_file = get_cached_volume_file(filename)
+        try:
+            return sitk.ReadImage(cached_file, pixel_type)
+        except RuntimeError:
+            # SimpleITK raises RuntimeError for any read failure: retry only if the cached file was evicted
+            if cached_file == str(filename) or os.path.isfile(cached_file) or attempt == VOLUME_CACHE_RETRIES - 1:
+                raise
+        logger.log(DEBUG, "{} evicted before loading, caching it again".format(cached_file))
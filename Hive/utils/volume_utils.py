@@ -1,46 +1,211 @@
-import shutil
-import tempfile
+import datetime
+import json
+import os
+import queue
 import time
+import traceback
+from multiprocessing import Pool
 from os import PathLike
 from pathlib import Path
-from typing import Union
+from typing import Union, List, Dict, Tuple, Iterator, Callable, Optional
 
-import SimpleITK as sitk
 import dicom2nifti
-import math
+import dicom2nifti.common
+import dicom2nifti.convert_dicom
 import nibabel as nib
 import numpy as np
 import pydicom
-from pydicom import dcmread
+from nibabel.orientations import axcodes2ornt, io_orientation, ornt_transform
+from tqdm import tqdm
 
+from Hive.utils.dicom_utils import index_patient_dicom_folder, query_dicom_index
 from Hive.utils.file_utils import subfolders
-from Hive.utils.log_utils import get_logger
+from Hive.utils.gzip_utils import save_nifti_image
+from Hive.utils.log_utils import get_logger, DEBUG, INFO
+from Hive.utils.suv_utils import convert_PET_to_SUV, get_SUV_sidecar_filename
 
 logger = get_logger(__name__)
 
+CONVERSION_SUFFIXES = {"CT": "_CT", "PT": "_PET", "SEG": "_SEG"}
 
-def dcm2nii_CT(CT_dcm_path: Union[str, PathLike], nii_out_path: Union[str, PathLike]):
+
+def dcm2nii_CT(CT_dcm_path: Union[str, PathLike], nii_out_path: Union[str, PathLike], compression_level: int = 1):
     """
-    Conversion of CT DICOM to nifti and save in nii_out_path.
+    Conversion of CT DICOM to nifti (LAS oriented) and save in nii_out_path. The NIFTI volume is created in memory and
+    written directly to the output file.
 
     Parameters
     ----------
     CT_dcm_path :
         CT DICOM folder path.
     nii_out_path :
-        Output NIFTI file path.
+        Output NIFTI file path. If the file extension is ``.nii``, the volume is saved uncompressed.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    """
+    # the DICOM files are read directly from the series folder, without copying the series to a temporary folder
+    dicom_input = dicom2nifti.common.read_dicom_directory(str(CT_dcm_path))
+    nii = dicom2nifti.convert_dicom.dicom_array_to_nifti(dicom_input, None, reorient_nifti=False)["NII"]
+    # dicom2nifti reorientation always writes to disk: the equivalent LAS reorientation is done in memory
+    nii = nii.as_reoriented(ornt_transform(io_orientation(nii.affine), axcodes2ornt(("L", "A", "S"))))
+    save_nifti_image(nii, nii_out_path, compression_level)
+
+
+def _get_frame_functional_group_attribute(seg: pydicom.Dataset, frame_index: int, sequence_name: str, attribute: str):
+    per_frame_groups = seg.get("PerFrameFunctionalGroupsSequence", None)
+    if per_frame_groups is not None and sequence_name in per_frame_groups[frame_index]:
+        return per_frame_groups[frame_index][sequence_name][0].get(attribute, None)
+    shared_groups = seg.get("SharedFunctionalGroupsSequence", None)
+    if shared_groups is not None and sequence_name in shared_groups[0]:
+        return shared_groups[0][sequence_name][0].get(attribute, None)
+    return None
+
+
+def iter_SEG_frames(seg: pydicom.Dataset) -> Iterator[np.ndarray]:
     """
+    Iterate over the frames of a DICOM SEG dataset, decoding one frame at a time from the (bit-packed) pixel data.
+    Frames of compressed SEG files are decoded with ``pixel_array``.
 
-    with tempfile.TemporaryDirectory() as tmp:
-        tmp = Path(str(tmp))
-        dicom2nifti.convert_directory(CT_dcm_path, str(tmp), compression=True, reorient=True)
-        nii = next(tmp.glob("*nii.gz"))
-        shutil.copy(nii, nii_out_path)
+    Parameters
+    ----------
+    seg :
+        DICOM SEG dataset.
 
+    Returns
+    -------
+        Iterator over the ``(Rows, Columns)`` frames.
+    """
+    rows, columns = int(seg.Rows), int(seg.Columns)
+    n_frames = int(seg.get("NumberOfFrames", 1))
+    frame_size = rows * columns
+
+    if seg.file_meta.TransferSyntaxUID.is_compressed:
+        yield from seg.pixel_array.reshape(n_frames, rows, columns)
+        return
+
+    pixel_data = seg.PixelData
+    if seg.BitsAllocated == 1:
+        for frame_index in range(n_frames):
+            first_bit = frame_index * frame_size
+            bit_offset = first_bit % 8
+            frame_bytes = np.frombuffer(pixel_data, np.uint8, (bit_offset + frame_size + 7) // 8, first_bit // 8)
+            frame_bits = np.unpackbits(frame_bytes, bitorder="little")
+            yield frame_bits[bit_offset: bit_offset + frame_size].reshape(rows, columns)
+    else:
+        dtype = np.dtype("<u{}".format(seg.BitsAllocated // 8))
+        for frame_index in range(n_frames):
+            yield np.frombuffer(
+                pixel_data, dtype, frame_size, frame_index * frame_size * dtype.itemsize
+            ).reshape(rows, columns)
+
+
+def _get_frame_pixel_grid(
+        image_orientation: Tuple[float, ...], pixel_spacing: Tuple[float, ...], rows: int, columns: int, ras_to_voxel: np.ndarray
+) -> np.ndarray:
+    # DICOM LPS to NIFTI RAS
+    lps_to_ras = np.diag([-1.0, -1.0, 1.0])
+    row_direction = lps_to_ras @ np.array(image_orientation[:3], dtype=float) * float(pixel_spacing[1])
+    column_direction = lps_to_ras @ np.array(image_orientation[3:], dtype=float) * float(pixel_spacing[0])
+    row_step = ras_to_voxel[:3, :3] @ row_direction
+    column_step = ras_to_voxel[:3, :3] @ column_direction
+    return (
+        np.arange(rows, dtype=float)[:, None, None] * column_step[None, None, :]
+        + np.arange(columns, dtype=float)[None, :, None] * row_step[None, None, :]
+    )
+
+
+def decode_SEG_to_label_volume(
+        seg: pydicom.Dataset, ref_nii: nib.Nifti1Image, segment_labels: Dict[int, int] = None
+) -> np.ndarray:
+    """
+    Decode a DICOM SEG dataset into a label volume, in the voxel space of a reference NIFTI image. Frames are decoded
+    one at a time and the foreground pixels are placed in the preallocated label volume using the per-frame
+    ``PlanePositionSequence``, the ``PlaneOrientationSequence`` and the ``PixelMeasuresSequence``. Each frame is
+    assigned to the label of its ``ReferencedSegmentNumber``; where segments overlap, the last decoded frame is kept.
 
-def dcm2nii_mask(mask_dcm_path: Union[str, PathLike], nii_out_path: Union[str, PathLike], ref_nii_path: Union[str, PathLike]):
+    Parameters
+    ----------
+    seg :
+        DICOM SEG dataset.
+    ref_nii :
+        Reference NIFTI image, defining the output shape and affine.
+    segment_labels :
+        Optional map from DICOM Segment Number to label value. Default: ``None``, the Segment Number is used as label.
+
+    Returns
+    -------
+        ``uint8`` label volume, with the same shape as the reference image.
+
+    Raises
+    ------
+    ValueError
+        If a segment is missing from ``segment_labels``, if a label is not in the ``uint8`` range, or if a frame is
+        missing its plane position, orientation or pixel spacing.
+    """
+    label_volume = np.zeros(ref_nii.shape[:3], dtype=np.uint8)
+    ras_to_voxel = np.linalg.inv(ref_nii.affine)
+    threshold = 0
+    if seg.get("SegmentationType", "BINARY") == "FRACTIONAL":
+        threshold = int(seg.get("MaximumFractionalValue", 255)) // 2
+
+    pixel_grids = {}
+    for frame_index, frame in enumerate(iter_SEG_frames(seg)):
+        foreground_rows, foreground_columns = np.nonzero(frame > threshold)
+        if len(foreground_rows) == 0:
+            continue
+        segment_number = int(
+            _get_frame_functional_group_attribute(
+                seg, frame_index, "SegmentIdentificationSequence", "ReferencedSegmentNumber"
+            )
+            or 1
+        )
+        if segment_labels is not None and segment_number not in segment_labels:
+            raise ValueError(
+                "Segment {} is not in the segment label map (available segments: {})".format(
+                    segment_number, sorted(segment_labels.keys())
+                )
+            )
+        label = segment_labels[segment_number] if segment_labels is not None else segment_number
+        if not 0 < label < 256:
+            raise ValueError("Label {} for Segment {} is not in the uint8 range".format(label, segment_number))
+
+        image_position = _get_frame_functional_group_attribute(seg, frame_index, "PlanePositionSequence", "ImagePositionPatient")
+        image_orientation = _get_frame_functional_group_attribute(
+            seg, frame_index, "PlaneOrientationSequence", "ImageOrientationPatient"
+        )
+        pixel_spacing = _get_frame_functional_group_attribute(seg, frame_index, "PixelMeasuresSequence", "PixelSpacing")
+        if image_position is None or image_orientation is None or pixel_spacing is None:
+            raise ValueError("Frame {} is missing the plane position, orientation or pixel spacing".format(frame_index))
+
+        grid_key = (tuple(float(x) for x in image_orientation), tuple(float(x) for x in pixel_spacing))
+        if grid_key not in pixel_grids:
+            pixel_grids[grid_key] = _get_frame_pixel_grid(
+                grid_key[0], grid_key[1], int(seg.Rows), int(seg.Columns), ras_to_voxel
+            )
+        frame_origin = ras_to_voxel[:3, :3] @ (np.diag([-1.0, -1.0, 1.0]) @ np.array(image_position, dtype=float))
+        frame_origin += ras_to_voxel[:3, 3]
+
+        voxels = np.rint(pixel_grids[grid_key][foreground_rows, foreground_columns] + frame_origin).astype(np.int64)
+        inside = np.all((voxels >= 0) & (voxels < np.array(label_volume.shape)), axis=1)
+        if not np.all(inside):
+            logger.log(DEBUG, "{} voxels of frame {} are outside the reference volume".format(np.sum(~inside), frame_index))
+        voxels = voxels[inside]
+        label_volume[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = label
+
+    return label_volume
+
+
+def dcm2nii_mask(
+        mask_dcm_path: Union[str, PathLike],
+        nii_out_path: Union[str, PathLike],
+        ref_nii_path: Union[str, PathLike],
+        compression_level: int = 1,
+        segment_labels: Dict[int, int] = None,
+):
     """
     Converts a SEG DICOM volume into NIFTI format. Requires an existing NIFTI file to derive the corresponding affine transform.
+    The SEG frames are placed in the reference NIFTI volume according to their position (see
+    :func:`decode_SEG_to_label_volume`), and each segment is saved with its own label.
 
     Parameters
     ----------
@@ -50,177 +215,527 @@ def dcm2nii_mask(mask_dcm_path: Union[str, PathLike], nii_out_path: Union[str, P
         NIFTI file saved as output.
     ref_nii_path :
         Reference NIFTI used to correctly saved the segmentation volume.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    segment_labels :
+        Optional map from DICOM Segment Number to label value. Default: ``None``, the Segment Number is used as label.
     """
-    mask_dcm = list(mask_dcm_path.glob("*.dcm"))[0]
-    mask = pydicom.read_file(str(mask_dcm))
-    mask_array = mask.pixel_array
-
-    mask_array = np.transpose(mask_array, (2, 1, 0))
-    mask_orientation = mask[0x5200, 0x9229][0].PlaneOrientationSequence[0].ImageOrientationPatient
-    if mask_orientation[4] == -1:
-        mask_array = np.flip(mask_array, 1)
+    mask_dcm = sorted(Path(mask_dcm_path).glob("*.dcm"))[0]
+    mask = pydicom.dcmread(str(mask_dcm))
 
-    # get affine matrix from the corresponding pet
+    # get affine matrix and shape from the corresponding pet, without loading the image data
     pet = nib.load(ref_nii_path)
-    pet_affine = pet.affine
+    mask_array = decode_SEG_to_label_volume(mask, pet, segment_labels)
 
     # return mask as nifti object
-    mask_out = nib.Nifti1Image(mask_array, pet_affine)
-    nib.save(mask_out, nii_out_path)
+    mask_out = nib.Nifti1Image(mask_array, pet.affine)
+    save_nifti_image(mask_out, nii_out_path, compression_level)
 
 
-def convert_DICOM_folder_to_NIFTI_image(patient_dicom_folder: Union[str, PathLike], patient_nifti_folder: Union[str, PathLike]):
+def get_study_nifti_filename(
+        patient_nifti_folder: Union[str, PathLike], patient: str, study_id: int, single_study: bool, suffix: str
+) -> str:
     """
-    Converts a given Patient DICOM folder into NIFTI format, saving the DICOM Studies in different folders.
+    Returns the NIFTI filename for a given patient study. When the patient has multiple studies, the study index is
+    appended to the patient NIFTI folder and to the filename.
+
+    Parameters
+    ----------
+    patient_nifti_folder :
+        Output NIFTI folder used as stem to save the DICOM Studies.
+    patient :
+        Patient name, used as filename prefix.
+    study_id :
+        Study index.
+    single_study :
+        Flag indicating if the patient has a single study.
+    suffix :
+        Filename suffix (e.g. ``_CT.nii.gz``).
+
+    Returns
+    -------
+        NIFTI filename.
+    """
+    if not single_study:
+        return str(Path(str(patient_nifti_folder) + "_{}".format(study_id)).joinpath("{}_{}{}".format(patient, study_id, suffix)))
+    return str(Path(str(patient_nifti_folder)).joinpath("{}{}".format(patient, suffix)))
+
+
+def get_patient_conversion_jobs(
+        patient_dicom_folder: Union[str, PathLike],
+        patient_nifti_folder: Union[str, PathLike],
+        series_records: List[Dict[str, object]] = None,
+        file_extension: str = ".nii.gz",
+        compression_level: int = 1,
+        suv_type: str = "bw",
+) -> Tuple[List[Dict[str, object]], Dict[str, Dict[int, str]]]:
+    """
+    Split the conversion of a Patient DICOM folder into per-series conversion jobs, creating the NIFTI study folders.
+    Each job is a dictionary including the ``patient``, the ``modality``, the ``series_folder`` to convert, the
+    ``output_file``, the ``reference_file`` (the PET NIFTI file, for SEG series), the output ``compression_level``, the
+    PET ``suv_type`` and the estimated job size ``n_files``.
+    When several series of a study have the same modality (and hence the same output file), only the series with the
+    most files is converted, and the other ones are skipped with a warning.
 
     Parameters
     ----------
     patient_dicom_folder :
         DICOM folder containing a single patient Studies.
     patient_nifti_folder :
-        Output NIFTI folder used as stem to save the DICOM Studies. The Study index is appended to this path to create
-        the corresponding NIFTI study folder path.
+        Output NIFTI folder used as stem to save the DICOM Studies.
+    series_records :
+        Optional list of series records for the patient, as returned by
+        :func:`Hive.utils.dicom_utils.query_dicom_index`. If ``None``, the patient folder is indexed reading one DICOM
+        header for each series.
+    file_extension :
+        NIFTI file extension: ``.nii.gz`` or ``.nii`` (uncompressed). Default: ``.nii.gz``.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    suv_type :
+        SUV variant used to normalize the PET series: ``bw``, ``lbm`` or ``bsa``. If ``None``, the PET series are saved
+        in Bq/ml. The SUV sidecar (see :func:`Hive.utils.suv_utils.compute_SUV_sidecar`) is saved next to each PET
+        volume, and re-used if already present. Default: ``bw``.
+
+    Returns
+    -------
+        List of conversion jobs (CT and PT jobs first, followed by the SEG jobs) and Patient-Study map.
     """
     studies = subfolders(patient_dicom_folder, join=False)
     single_study = False
     if len(studies) == 1:
         single_study = True
 
-    patient_study_map = {Path(patient_dicom_folder).name: {}}
+    if series_records is None:
+        series_records = index_patient_dicom_folder(patient_dicom_folder)
+
+    patient = Path(patient_dicom_folder).name
+    patient_study_map = {patient: {}}
+    output_jobs = {}
     for study_id, study in enumerate(studies):
-        patient_study_map[Path(patient_dicom_folder).name][study_id] = study
+        patient_study_map[patient][study_id] = study
         if not single_study:
             Path(str(patient_nifti_folder) + "_{}".format(study_id)).mkdir(parents=True, exist_ok=True)
         else:
             Path(str(patient_nifti_folder)).mkdir(parents=True, exist_ok=True)
-        series = subfolders(Path(patient_dicom_folder).joinpath(study), join=False)
-        for serie in series:
-            first_file = next(Path(patient_dicom_folder).joinpath(study, serie).glob("*.dcm"))
-            ds = pydicom.dcmread(str(first_file))
-
-            if ds.Modality == "CT":
-                if not single_study:
-                    ct_filename = str(
-                        Path(str(patient_nifti_folder) + "_{}".format(study_id)).joinpath(
-                            "{}_{}_CT.nii.gz".format(Path(patient_dicom_folder).name, study_id)
-                        )
-                    )
-                else:
-                    ct_filename = str(
-                        Path(str(patient_nifti_folder)).joinpath("{}_CT.nii.gz".format(Path(patient_dicom_folder).name))
+        for series_record in series_records:
+            if series_record["study"] != study or series_record["modality"] not in CONVERSION_SUFFIXES:
+                continue
+            job = {
+                "patient": patient,
+                "modality": series_record["modality"],
+                "series_folder": series_record["series_folder"],
+                "output_file": get_study_nifti_filename(
+                    patient_nifti_folder,
+                    patient,
+                    study_id,
+                    single_study,
+                    CONVERSION_SUFFIXES[series_record["modality"]] + file_extension,
+                ),
+                "reference_file": None,
+                "compression_level": compression_level,
+                "suv_type": suv_type,
+                "n_files": series_record["n_files"],
+            }
+            if series_record["modality"] == "SEG":
+                job["reference_file"] = get_study_nifti_filename(
+                    patient_nifti_folder, patient, study_id, single_study, CONVERSION_SUFFIXES["PT"] + file_extension
+                )
+            kept_job = output_jobs.get(job["output_file"], None)
+            if kept_job is not None:
+                # several series with the same output file would overwrite each other: keep the largest one
+                if job["n_files"] > kept_job["n_files"]:
+                    output_jobs[job["output_file"]] = job
+                    job, kept_job = kept_job, job
+                logger.warning(
+                    "Skipping {} series {}: {} is already the output of series {}".format(
+                        job["modality"], job["series_folder"], job["output_file"], kept_job["series_folder"]
                     )
+                )
+                continue
+            output_jobs[job["output_file"]] = job
+
+    image_jobs = [job for job in output_jobs.values() if job["modality"] != "SEG"]
+    seg_jobs = [job for job in output_jobs.values() if job["modality"] == "SEG"]
+    return image_jobs + seg_jobs, patient_study_map
 
-                dcm2nii_CT(str(Path(patient_dicom_folder).joinpath(study, serie)), ct_filename)
-            elif ds.Modality == "PT":
-                if not single_study:
-                    pet_filename = str(
-                        Path(str(patient_nifti_folder) + "_{}".format(study_id)).joinpath(
-                            "{}_{}_PET.nii.gz".format(Path(patient_dicom_folder).name, study_id)
-                        )
-                    )
-                else:
-                    pet_filename = str(
-                        Path(str(patient_nifti_folder)).joinpath("{}_PET.nii.gz".format(Path(patient_dicom_folder).name))
-                    )
-                normalize_PET_to_SUV_BW(str(Path(patient_dicom_folder).joinpath(study, serie)), pet_filename)
-
-        for study_id, study in enumerate(studies):
-            series = subfolders(Path(patient_dicom_folder).joinpath(study), join=False)
-            for serie in series:
-                first_file = next(Path(patient_dicom_folder).joinpath(study, serie).glob("*.dcm"))
-                ds = pydicom.dcmread(str(first_file))
-
-                if ds.Modality == "SEG":
-                    if not single_study:
-                        seg_filename = str(
-                            Path(str(patient_nifti_folder) + "_{}".format(study_id)).joinpath(
-                                "{}_{}_SEG.nii.gz".format(Path(patient_dicom_folder).name, study_id)
-                            )
-                        )
-                        ref_filename = str(
-                            Path(str(patient_nifti_folder) + "_{}".format(study_id)).joinpath(
-                                "{}_{}_PET.nii.gz".format(Path(patient_dicom_folder).name, study_id)
-                            )
-                        )
-                    else:
-                        seg_filename = str(
-                            Path(str(patient_nifti_folder)).joinpath("{}_SEG.nii.gz".format(Path(patient_dicom_folder).name))
-                        )
-                        ref_filename = str(
-                            Path(str(patient_nifti_folder)).joinpath("{}_PET.nii.gz".format(Path(patient_dicom_folder).name))
-                        )
-                    dcm2nii_mask(Path(patient_dicom_folder).joinpath(study, serie), seg_filename, ref_filename)
-    return patient_study_map
 
-def normalize_PET_to_SUV_BW(dicom_pet_series_folder: Union[str, PathLike], suv_pet_filename: Union[str, PathLike]):
+def convert_series_job(job: Dict[str, object]) -> Dict[str, object]:
     """
-    SUV BW Normalization of DICOM PET volume. The resulting normalized PET volume is saved at **suv_pet_filename**.
+    Run a single series conversion job, as created by :func:`get_patient_conversion_jobs`.
 
     Parameters
     ----------
-    dicom_pet_series_folder :
-        DICOM PET Folder to be normalized.
-    suv_pet_filename:
-        Normalized SUV PET file location.
-    """
-    reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(dicom_pet_series_folder)
-
-    ds = dcmread(dicom_names[0])
-
-    corrected_image = ds[0x0028, 0x0051].value
-    decay_correction = ds[0x0054, 0x1102].value
-    units = ds[0x0054, 0x1001].value
+    job :
+        Series conversion job.
 
-    series_date = ds.SeriesDate
-    acquisition_date = ds.AcquisitionDate
-    series_time = ds.SeriesTime
-    acquisition_time = ds.AcquisitionTime
-    half_life = ds.RadiopharmaceuticalInformationSequence[0].RadionuclideHalfLife
-    weight = ds.PatientWeight
-
-    if "ATTN" in corrected_image and "DECY" in corrected_image and decay_correction == "START":
-        if units == "BQML":
-            if series_time <= acquisition_time and series_date <= acquisition_date:
-                scan_date = series_date
-                scan_time = series_time
-            else:
-                scan_date = acquisition_date
-                scan_time = acquisition_time
-            # if not RadiopharmaceuticalStartTime in ds.RadiopharmaceuticalInformationSequence[0]:
-            #    ...
-            # else:
-            start_time = ds.RadiopharmaceuticalInformationSequence[0].RadiopharmaceuticalStartTime
-            start_date = scan_date
-
-            scan_time = str(round(float(scan_time)))
-            str_scan_time = time.strptime(scan_date + scan_time, "%Y%m%d%H%M%S")
-
-            start_time = str(round(float(start_time)))
+    Returns
+    -------
+        The converted job, including the conversion ``elapsed_time`` in seconds.
+    """
+    start_time = time.time()
+    if job["modality"] == "CT":
+        dcm2nii_CT(job["series_folder"], job["output_file"], job["compression_level"])
+    elif job["modality"] == "PT":
+        convert_PET_to_SUV(
+            job["series_folder"],
+            job["output_file"],
+            job["suv_type"],
+            job["compression_level"],
+            get_SUV_sidecar_filename(job["output_file"]),
+        )
+    elif job["modality"] == "SEG":
+        dcm2nii_mask(Path(job["series_folder"]), job["output_file"], job["reference_file"], job["compression_level"])
+    job["elapsed_time"] = time.time() - start_time
+    return job
+
+
+def run_series_conversion_jobs(
+        jobs: List[Dict[str, object]],
+        num_threads: int = 1,
+        job_callback: Callable[[Dict[str, object], Optional[BaseException]], None] = None,
+        raise_errors: bool = True,
+) -> List[Dict[str, object]]:
+    """
+    Run series conversion jobs on a shared process pool. Jobs are started from the largest one (by number of DICOM
+    files), to minimize stragglers. SEG jobs are started only when the job producing their reference PET NIFTI file is
+    completed. If a job fails, the jobs depending on it are skipped, and the first error is raised once all the other
+    jobs are completed.
 
-            str_start_time = time.strptime(start_date + start_time, "%Y%m%d%H%M%S")
+    Parameters
+    ----------
+    jobs :
+        List of series conversion jobs, as created by :func:`get_patient_conversion_jobs`.
+    num_threads :
+        Number of worker processes. Default: ``1``.
+    job_callback :
+        Optional function called in the main process for each completed, failed or skipped job, with the job and the
+        error (``None`` for completed jobs).
+    raise_errors :
+        Flag to raise the first error once all the jobs are completed. Default: ``True``.
+
+    Returns
+    -------
+        List of completed jobs.
+    """
+    produced_files = {job["output_file"] for job in jobs}
+    dependent_jobs = {}
+    ready_jobs = []
+    for job in jobs:
+        if job["reference_file"] is not None and job["reference_file"] in produced_files:
+            dependent_jobs.setdefault(job["reference_file"], []).append(job)
+        else:
+            ready_jobs.append(job)
+
+    completed_jobs = []
+    errors = []
+    job_results = queue.Queue()
+    with Pool(num_threads) as pool:
+
+        def submit(job_to_submit):
+            pool.apply_async(
+                convert_series_job,
+                (job_to_submit,),
+                callback=lambda result: job_results.put((result, None)),
+                error_callback=lambda error: job_results.put((job_to_submit, error)),
+            )
+
+        for job in sorted(ready_jobs, key=lambda x: x["n_files"], reverse=True):
+            submit(job)
+        n_running = len(ready_jobs)
+
+        with tqdm(total=len(jobs)) as progress_bar:
+            while n_running > 0:
+                job, error = job_results.get()
+                n_running -= 1
+                progress_bar.update(1)
+                if error is not None:
+                    logger.error("Conversion of {} failed: {!r}".format(job["series_folder"], error))
+                    errors.append(error)
+                    skipped_jobs = dependent_jobs.pop(job["output_file"], [])
+                    progress_bar.update(len(skipped_jobs))
+                    if job_callback is not None:
+                        job_callback(job, error)
+                        for skipped_job in skipped_jobs:
+                            job_callback(skipped_job, RuntimeError("Reference {} not converted".format(job["output_file"])))
+                    continue
+                completed_jobs.append(job)
+                if job_callback is not None:
+                    job_callback(job, None)
+                for dependent_job in sorted(dependent_jobs.pop(job["output_file"], []), key=lambda x: x["n_files"], reverse=True):
+                    submit(dependent_job)
+                    n_running += 1
+
+    if len(errors) > 0 and raise_errors:
+        raise errors[0]
+    return completed_jobs
+
+
+def convert_DICOM_folder_to_NIFTI_image(
+        patient_dicom_folder: Union[str, PathLike],
+        patient_nifti_folder: Union[str, PathLike],
+        series_records: List[Dict[str, object]] = None,
+        file_extension: str = ".nii.gz",
+        compression_level: int = 1,
+        suv_type: str = "bw",
+):
+    """
+    Converts a given Patient DICOM folder into NIFTI format, saving the DICOM Studies in different folders.
 
-            decay_time = time.mktime(str_scan_time) - time.mktime(str_start_time)
+    Parameters
+    ----------
+    patient_dicom_folder :
+        DICOM folder containing a single patient Studies.
+    patient_nifti_folder :
+        Output NIFTI folder used as stem to save the DICOM Studies. The Study index is appended to this path to create
+        the corresponding NIFTI study folder path.
+    series_records :
+        Optional list of series records for the patient, as returned by
+        :func:`Hive.utils.dicom_utils.query_dicom_index`. If ``None``, the patient folder is indexed reading one DICOM
+        header for each series.
+    file_extension :
+        NIFTI file extension: ``.nii.gz`` or ``.nii`` (uncompressed). Default: ``.nii.gz``.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    suv_type :
+        SUV variant used to normalize the PET series: ``bw``, ``lbm`` or ``bsa``. If ``None``, the PET series are saved
+        in Bq/ml. The SUV sidecar (see :func:`Hive.utils.suv_utils.compute_SUV_sidecar`) is saved next to each PET
+        volume, and re-used if already present. Default: ``bw``.
+    """
+    jobs, patient_study_map = get_patient_conversion_jobs(
+        patient_dicom_folder, patient_nifti_folder, series_records, file_extension, compression_level, suv_type
+    )
+    for job in jobs:
+        convert_series_job(job)
+    return patient_study_map
 
-            injected_dose = ds.RadiopharmaceuticalInformationSequence[0].RadionuclideTotalDose
-            decayed_dose = injected_dose * math.pow(2, -decay_time / half_life)
 
-            SUB_BW_scale_factor = (weight * 1000) / decayed_dose
+def read_conversion_log(log_file: Union[str, PathLike]) -> Dict[str, Dict[str, object]]:
+    """
+    Read a JSONL conversion log, as written by :func:`convert_DICOM_dataset_to_NIFTI_dataset`. Incomplete lines, left
+    by an interrupted run, are skipped.
 
-    rescale_slope = 1  # ds[0x0028,0x1053].value
+    Parameters
+    ----------
+    log_file :
+        JSONL conversion log file.
 
-    total_factor = rescale_slope * SUB_BW_scale_factor
+    Returns
+    -------
+        Dictionary with the last log record for each patient.
+    """
+    log_records = {}
+    if not Path(log_file).is_file():
+        return log_records
+    with open(log_file, "r") as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                log_record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping incomplete line in {}: {}".format(log_file, line))
+                continue
+            log_records[log_record["patient"]] = log_record
+    return log_records
+
+
+def _get_conversion_log_record(
+        patient: str, patient_study_map: Dict[int, str], elapsed_time: float, error_traceback: str = None
+) -> Dict[str, object]:
+    return {
+        "patient": patient,
+        "status": "done" if error_traceback is None else "failed",
+        "patient_study_map": patient_study_map,
+        "elapsed_time": elapsed_time,
+        "traceback": error_traceback,
+        "timestamp": datetime.datetime.now().isoformat(),
+    }
+
+
+def _convert_patient(conversion_args: Tuple) -> Dict[str, object]:
+    patient = Path(conversion_args[0]).name
+    start_time = time.time()
+    try:
+        patient_study_map = convert_DICOM_folder_to_NIFTI_image(*conversion_args)
+    except Exception:
+        return _get_conversion_log_record(patient, {}, time.time() - start_time, traceback.format_exc())
+    return _get_conversion_log_record(patient, patient_study_map[patient], time.time() - start_time)
+
+
+def _collect_patient_conversion_jobs(
+        conversion_args: Tuple,
+) -> Tuple[str, List[Dict[str, object]], Dict[int, str], Optional[str]]:
+    patient = Path(conversion_args[0]).name
+    try:
+        jobs, patient_study_map = get_patient_conversion_jobs(*conversion_args)
+    except Exception:
+        return patient, [], {}, traceback.format_exc()
+    return patient, jobs, patient_study_map[patient], None
+
+
+def convert_DICOM_dataset_to_NIFTI_dataset(
+        dicom_data_folder: Union[str, PathLike],
+        nifti_data_folder: Union[str, PathLike],
+        log_file: Union[str, PathLike],
+        dicom_index: Union[str, PathLike] = None,
+        file_extension: str = ".nii.gz",
+        compression_level: int = 1,
+        suv_type: str = "bw",
+        parallelism: str = "series",
+        num_threads: int = 1,
+        resume: bool = False,
+) -> Dict[str, Dict[int, str]]:
+    """
+    Convert a DICOM dataset (structured as Patient-Study-Series) into a NIFTI dataset, streaming the results. As soon as
+    a patient is converted, a record with the patient ``status`` (``done`` or ``failed``), the Patient-Study map, the
+    conversion ``elapsed_time`` and the error ``traceback`` is appended to the JSONL ``log_file``. Failed patients do
+    not stop the conversion. With ``resume``, the patients already converted in the log are skipped.
 
-    reader.SetFileNames(dicom_names)
+    Parameters
+    ----------
+    dicom_data_folder :
+        DICOM dataset folder.
+    nifti_data_folder :
+        Output NIFTI dataset folder.
+    log_file :
+        JSONL conversion log file.
+    dicom_index :
+        Optional DICOM index SQLite file, created with :func:`Hive.utils.dicom_utils.build_dicom_index`.
+    file_extension :
+        NIFTI file extension: ``.nii.gz`` or ``.nii`` (uncompressed). Default: ``.nii.gz``.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    suv_type :
+        SUV variant used to normalize the PET series: ``bw``, ``lbm`` or ``bsa``. If ``None``, the PET series are saved
+        in Bq/ml. Default: ``bw``.
+    parallelism :
+        ``series``, to convert each DICOM series as a separate job (see :func:`run_series_conversion_jobs`), or
+        ``patient``, to convert each patient as a single job. Default: ``series``.
+    num_threads :
+        Number of worker processes. Default: ``1``.
+    resume :
+        Flag to skip the patients already converted in ``log_file``. If ``False``, ``log_file`` is overwritten.
+        Default: ``False``.
+
+    Returns
+    -------
+        Patient-Study map for all the converted patients, including the ones converted in previous runs.
+    """
+    patients_map = {}
+    if resume:
+        for patient, log_record in read_conversion_log(log_file).items():
+            if log_record["status"] == "done":
+                patients_map[patient] = log_record["patient_study_map"]
+
+    conversion_args = []
+    for patient in subfolders(dicom_data_folder, join=False):
+        if patient in patients_map:
+            logger.log(DEBUG, "Patient {} already converted: skipping".format(patient))
+            continue
+        series_records = None
+        if dicom_index is not None:
+            series_records = query_dicom_index(dicom_index, patient=patient)
+        conversion_args.append(
+            (
+                str(Path(dicom_data_folder).joinpath(patient)),
+                str(Path(nifti_data_folder).joinpath(patient)),
+                series_records,
+                file_extension,
+                compression_level,
+                suv_type,
+            )
+        )
+    logger.log(INFO, "Converting {} patients ({} already converted)".format(len(conversion_args), len(patients_map)))
+
+    Path(nifti_data_folder).mkdir(parents=True, exist_ok=True)
+    failed_patients = []
+    incomplete_last_line = False
+    if resume and Path(log_file).is_file() and Path(log_file).stat().st_size > 0:
+        with open(log_file, "rb") as fp:
+            fp.seek(-1, os.SEEK_END)
+            incomplete_last_line = fp.read(1) != b"\n"
+
+    with open(log_file, "a" if resume else "w") as log_fp:
+        if incomplete_last_line:
+            log_fp.write("\n")
+
+        def append_log_record(log_record):
+            log_fp.write(json.dumps(log_record) + "\n")
+            log_fp.flush()
+            os.fsync(log_fp.fileno())
+            if log_record["status"] == "done":
+                patients_map[log_record["patient"]] = log_record["patient_study_map"]
+            else:
+                failed_patients.append(log_record["patient"])
+                logger.error("Conversion of patient {} failed:\n{}".format(log_record["patient"], log_record["traceback"]))
 
-    image = reader.Execute()
+        if parallelism == "patient":
+            with Pool(num_threads) as pool:
+                for log_record in tqdm(pool.imap_unordered(_convert_patient, conversion_args), total=len(conversion_args)):
+                    append_log_record(log_record)
+        else:
+            jobs = []
+            pending_jobs = {}
+            patient_study_maps = {}
+            elapsed_times = {}
+            error_tracebacks = {}
+            with Pool(num_threads) as pool:
+                for patient, patient_jobs, patient_study_map, error_traceback in pool.imap_unordered(
+                        _collect_patient_conversion_jobs, conversion_args
+                ):
+                    if error_traceback is not None or len(patient_jobs) == 0:
+                        append_log_record(_get_conversion_log_record(patient, patient_study_map, 0.0, error_traceback))
+                        continue
+                    jobs.extend(patient_jobs)
+                    pending_jobs[patient] = len(patient_jobs)
+                    patient_study_maps[patient] = patient_study_map
+                    elapsed_times[patient] = 0.0
+                    error_tracebacks[patient] = []
+
+            def on_job_done(job, error):
+                patient = job["patient"]
+                if error is None:
+                    elapsed_times[patient] += job["elapsed_time"]
+                else:
+                    error_tracebacks[patient].append(
+                        "{}:\n{}".format(
+                            job["series_folder"], "".join(traceback.format_exception(type(error), error, error.__traceback__))
+                        )
+                    )
+                pending_jobs[patient] -= 1
+                if pending_jobs[patient] == 0:
+                    append_log_record(
+                        _get_conversion_log_record(
+                            patient,
+                            patient_study_maps[patient],
+                            elapsed_times[patient],
+                            "\n".join(error_tracebacks[patient]) if len(error_tracebacks[patient]) > 0 else None,
+                        )
+                    )
 
-    image_array = sitk.GetArrayFromImage(image)
+            logger.log(INFO, "Running {} series conversions".format(len(jobs)))
+            run_series_conversion_jobs(jobs, num_threads, on_job_done, raise_errors=False)
 
-    image_array *= total_factor
+    if len(failed_patients) > 0:
+        logger.warning("{} patients failed, see {}: {}".format(len(failed_patients), log_file, failed_patients))
+    return patients_map
 
-    itk_image = sitk.GetImageFromArray(image_array)
 
-    itk_image.CopyInformation(image)
+def normalize_PET_to_SUV_BW(
+        dicom_pet_series_folder: Union[str, PathLike], suv_pet_filename: Union[str, PathLike], compression_level: int = 1
+):
+    """
+    SUV BW Normalization of DICOM PET volume. The resulting normalized PET volume is saved at **suv_pet_filename**.
+    See :func:`Hive.utils.suv_utils.convert_PET_to_SUV` for the other SUV variants.
 
-    sitk.WriteImage(itk_image, suv_pet_filename)
+    Parameters
+    ----------
+    dicom_pet_series_folder :
+        DICOM PET Folder to be normalized.
+    suv_pet_filename:
+        Normalized SUV PET file location.
+    compression_level :
+        gzip compression level, in the range 1-9. Default: ``1``.
+    """
+    convert_PET_to_SUV(dicom_pet_series_folder, suv_pet_filename, "bw", compression_level)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import datetime
+import os
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from textwrap import dedent
+
+from Hive.utils.dicom_utils import build_dicom_index
+from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args
+
+TIMESTAMP = "{:%Y-%m-%d_%H-%M-%S}".format(datetime.datetime.now())
+
+DESC = dedent(
+    """
+    Script to index a ``DICOM`` dataset (structured as Patient-Study-Series), reading a single DICOM header (without pixel data)
+    for each series. The index (Patient, Study and Series UIDs, Modality, Orientation and file list for each series) is saved
+    as a SQLite database, to be used by the DICOM conversion scripts without re-reading the DICOM headers.
+    """  # noqa: E501
+)
+EPILOG = dedent(
+    """
+    Example call:
+    ::
+        {filename}  --data-folder /PATH/TO/DICOM_DATA --index-file /PATH/TO/DICOM_INDEX.db
+        {filename}  --data-folder /PATH/TO/DICOM_DATA --index-file /PATH/TO/DICOM_INDEX.db --n-workers 16
+    """.format(  # noqa: E501
+        filename=Path(__file__).stem
+    )
+)
+
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
+
+def main():
+    parser = get_arg_parser()
+
+    arguments = vars(parser.parse_args())
+
+    logger = get_logger(  # NOQA: F841
+        name=Path(__file__).name,
+        level=log_lvl_from_verbosity_args(arguments),
+    )
+
+    build_dicom_index(arguments["data_folder"], arguments["index_file"], int(arguments["n_workers"]))
+
+
+def get_arg_parser():
+    pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
+
+    pars.add_argument(
+        "--data-folder",
+        type=str,
+        required=True,
+        help="DICOM Dataset folder.",
+    )
+
+    pars.add_argument(
+        "--index-file",
+        type=str,
+        required=True,
+        help="SQLite file where to save the DICOM index.",
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker processes to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
+    add_verbosity_options_to_argparser(pars)
+
+    return pars
+
+
+if __name__ == "__main__":
+    main()
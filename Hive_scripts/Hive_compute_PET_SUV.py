@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import datetime
+import os
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from textwrap import dedent
+
+from tqdm import tqdm
+
+from Hive.utils.dicom_utils import query_dicom_index
+from Hive.utils.file_utils import subfolders
+from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args, str2bool
+from Hive.utils.suv_utils import SUV_TYPES, apply_SUV_scale_factor, compute_SUV_sidecars, get_SUV_sidecar_filename
+from Hive.utils.volume_utils import get_patient_conversion_jobs
+
+TIMESTAMP = "{:%Y-%m-%d_%H-%M-%S}".format(datetime.datetime.now())
+
+DESC = dedent(
+    """
+    Script to compute the SUV scale factors for all the PET series in a ``DICOM`` dataset (structured as Patient-Study-Series),
+    reading a single DICOM header for each series. For each PET series, the SUV parameters and the scale factors (bw, lbm and bsa)
+    are saved in a SUV sidecar JSON file (``*_PET_SUV.json``), in the same NIFTI dataset layout created by
+    ``Hive_convert_DICOM_dataset_to_NIFTI_dataset``. Existing sidecars are kept if they belong to the same series, unless
+    ``--overwrite yes`` is set. If ``--apply-suv-type`` is set, the scale factor is applied to the existing PET volumes in Bq/ml
+    (converted with ``--suv-type none``), without reading the DICOM series again. PET volumes whose sidecar does not record
+    Bq/ml output units are skipped.
+    """  # noqa: E501
+)
+EPILOG = dedent(
+    """
+    Example call:
+    ::
+        {filename}  --data-folder /PATH/TO/DICOM_DATA --output-folder /PATH/TO/NIFTI_DATASET
+        {filename}  --data-folder /PATH/TO/DICOM_DATA --output-folder /PATH/TO/NIFTI_DATASET --apply-suv-type lbm --suv-suffix _SUV_LBM
+    """.format(  # noqa: E501
+        filename=Path(__file__).stem
+    )
+)
+
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
+
+def main():
+    parser = get_arg_parser()
+
+    arguments = vars(parser.parse_args())
+
+    logger = get_logger(
+        name=Path(__file__).name,
+        level=log_lvl_from_verbosity_args(arguments),
+    )
+
+    pet_jobs = []
+    for subject in subfolders(arguments["data_folder"], join=False):
+        series_records = None
+        if arguments["dicom_index"] is not None:
+            series_records = query_dicom_index(arguments["dicom_index"], patient=subject)
+        jobs, _ = get_patient_conversion_jobs(
+            str(Path(arguments["data_folder"]).joinpath(subject)),
+            str(Path(arguments["output_folder"]).joinpath(subject)),
+            series_records,
+            arguments["file_extension"],
+        )
+        pet_jobs.extend([job for job in jobs if job["modality"] == "PT"])
+
+    sidecar_files = compute_SUV_sidecars(
+        [(job["series_folder"], get_SUV_sidecar_filename(job["output_file"])) for job in pet_jobs],
+        int(arguments["n_workers"]),
+        arguments["overwrite"],
+    )
+
+    if arguments["apply_suv_type"] is None:
+        return
+
+    sidecar_files = set(sidecar_files)
+    for job in tqdm(pet_jobs):
+        pet_filename = job["output_file"]
+        sidecar_file = get_SUV_sidecar_filename(pet_filename)
+        if sidecar_file not in sidecar_files or not Path(pet_filename).is_file():
+            logger.warning("Skipping {}: PET volume or SUV sidecar not found".format(pet_filename))
+            continue
+        suv_pet_filename = "{}{}{}".format(
+            pet_filename[: -len(arguments["file_extension"])], arguments["suv_suffix"], arguments["file_extension"]
+        )
+        try:
+            apply_SUV_scale_factor(
+                pet_filename, suv_pet_filename, arguments["apply_suv_type"], sidecar_file, arguments["compression_level"]
+            )
+        except ValueError as e:
+            logger.warning("Skipping {}: {}".format(pet_filename, e))
+
+
+def get_arg_parser():
+    pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
+
+    pars.add_argument(
+        "--data-folder",
+        type=str,
+        required=True,
+        help="DICOM Dataset folder.",
+    )
+
+    pars.add_argument(
+        "--output-folder",
+        type=str,
+        required=True,
+        help="NIFTI Dataset folder, where to save the SUV sidecars.",
+    )
+
+    pars.add_argument(
+        "--dicom-index",
+        type=str,
+        required=False,
+        default=None,
+        help="Optional DICOM index SQLite file, created with ``Hive_build_DICOM_index``.",
+    )
+
+    pars.add_argument(
+        "--file-extension",
+        type=str,
+        required=False,
+        choices=[".nii.gz", ".nii"],
+        default=".nii.gz",
+        help="NIFTI file extension of the PET volumes. (Default: .nii.gz)",
+    )
+
+    pars.add_argument(
+        "--overwrite",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", recompute the existing SUV sidecars. (Default: no)',
+    )
+
+    pars.add_argument(
+        "--apply-suv-type",
+        type=str,
+        required=False,
+        choices=SUV_TYPES,
+        default=None,
+        help="Optional SUV variant to apply to the existing PET volumes in Bq/ml.",
+    )
+
+    pars.add_argument(
+        "--suv-suffix",
+        type=str,
+        required=False,
+        default="_SUV",
+        help="Suffix appended to the PET filename to save the SUV PET volumes. (Default: _SUV)",
+    )
+
+    pars.add_argument(
+        "--compression-level",
+        type=int,
+        required=False,
+        choices=range(1, 10),
+        metavar="[1-9]",
+        default=1,
+        help="gzip compression level for ``.nii.gz`` volumes. (Default: 1)",
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker processes to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
+    add_verbosity_options_to_argparser(pars)
+
+    return pars
+
+
+if __name__ == "__main__":
+    main()
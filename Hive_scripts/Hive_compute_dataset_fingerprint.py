@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import importlib.resources
+import json
+import os
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from textwrap import dedent
+
+import Hive.configs
+from Hive.utils.file_utils import index_dataset_folder
+from Hive.utils.fingerprint_utils import compute_dataset_fingerprint
+from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args, str2bool
+
+DESC = dedent(
+    """
+    Compute the fingerprint of a dataset (structured as ``<DATA_FOLDER>/<SUBJECT>/<SUBJECT><SUFFIX>``), reading each image and label
+    volume once, in parallel. For each modality listed in the configuration file, the intensity minimum, maximum, mean, standard
+    deviation and percentiles (from mergeable fixed-width histograms, computed on the label foreground) are reported, together with
+    the spacings and shapes of the volumes and the lesion volume distribution. Non-finite intensities and intensities outside
+    the modality intensity range are excluded from the histograms and counted separately (a warning is logged for each modality with
+    out-of-range values). The intensity range is set with ``--intensity-range``, or for each modality in the configuration file
+    (**IntensityRange**, e.g. ``"IntensityRange": {"PET": [0, 1e7]}``).
+    The dataset fingerprint is saved as ``<OUTPUT_FILE>.json``, while the per-case statistics are saved as ``<OUTPUT_FILE>.npz``,
+    so that they can be merged with new cases, or re-used in later steps and reports without reading the volumes again.
+    """  # noqa: E501
+)
+EPILOG = dedent(
+    """
+    Example call:
+    ::
+        {filename} --data-folder /PATH/TO/DATA_FOLDER --config-file Example_config.json --output-file /PATH/TO/FINGERPRINT
+        {filename} --data-folder /PATH/TO/DATA_FOLDER --config-file Example_config.json --output-file /PATH/TO/FINGERPRINT --bin-width 0.1 --n-workers 8
+    """.format(  # noqa: E501
+        filename=Path(__file__).stem
+    )
+)
+
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
+
+def main():
+    parser = get_arg_parser()
+
+    arguments = vars(parser.parse_args())
+
+    logger = get_logger(
+        name=Path(__file__).name,
+        level=log_lvl_from_verbosity_args(arguments),
+    )
+
+    try:
+        with open(arguments["config_file"]) as json_file:
+            config_dict = json.load(json_file)
+    except FileNotFoundError:
+        with importlib.resources.path(Hive.configs, arguments["config_file"]) as json_path:
+            with open(json_path) as json_file:
+                config_dict = json.load(json_file)
+
+    dataset_index = index_dataset_folder(arguments["data_folder"], file_extension=config_dict.get("FileExtension", None))
+    dataset_fingerprint = compute_dataset_fingerprint(
+        dataset_index,
+        config_dict,
+        arguments["output_file"],
+        int(arguments["n_workers"]),
+        arguments["bin_width"],
+        not arguments["semantic_labels"],
+        arguments["intensity_range"],
+    )
+    logger.info(
+        "Dataset fingerprint computed for {} subjects, saved in {}.json".format(
+            len(dataset_fingerprint["subjects"]), arguments["output_file"]
+        )
+    )
+
+
+def get_arg_parser():
+    pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
+
+    pars.add_argument(
+        "--data-folder",
+        type=str,
+        required=True,
+        help="Dataset folder.",
+    )
+
+    pars.add_argument(
+        "--config-file",
+        type=str,
+        required=True,
+        help="Configuration JSON file with the dataset parameters (**Modalities**, **label_suffix** and **FileExtension**, "
+             "and optionally the per-modality **IntensityRange**).",
+    )
+
+    pars.add_argument(
+        "--output-file",
+        type=str,
+        required=True,
+        help="Output file path, without extension. The fingerprint is saved as JSON and NPZ files.",
+    )
+
+    pars.add_argument(
+        "--bin-width",
+        type=float,
+        required=False,
+        default=1.0,
+        help="Bin width of the intensity histograms, used to estimate the percentiles. (Default: 1.0)",
+    )
+
+    pars.add_argument(
+        "--intensity-range",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        required=False,
+        default=[-1e5, 1e5],
+        help="Intensity range of the histograms, for the modalities without **IntensityRange** in the configuration file: "
+             "values outside the range are counted separately. (Default: -1e5 1e5)",
+    )
+
+    pars.add_argument(
+        "--semantic-labels",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", the lesions are the connected components of the label masks, instead of the label values '
+             "of instance segmentation masks. (Default: no)",
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker processes to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
+    add_verbosity_options_to_argparser(pars)
+
+    return pars
+
+
+if __name__ == "__main__":
+    main()
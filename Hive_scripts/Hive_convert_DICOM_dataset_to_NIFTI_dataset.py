@@ -4,15 +4,12 @@ import datetime
 import json
 import os
 from argparse import ArgumentParser, RawTextHelpFormatter
-from multiprocessing import Pool
 from pathlib import Path
 from textwrap import dedent
 
-from tqdm import tqdm
-
-from Hive.utils.file_utils import subfolders
-from Hive.utils.log_utils import add_verbosity_options_to_argparser, get_logger, log_lvl_from_verbosity_args
-from Hive.utils.volume_utils import convert_DICOM_folder_to_NIFTI_image
+from Hive.utils.log_utils import add_verbosity_options_to_argparser, get_logger, log_lvl_from_verbosity_args, str2bool
+from Hive.utils.suv_utils import SUV_TYPES
+from Hive.utils.volume_utils import convert_DICOM_dataset_to_NIFTI_dataset
 
 TIMESTAMP = "{:%Y-%m-%d_%H-%M-%S}".format(datetime.datetime.now())
 
@@ -21,6 +18,10 @@ DESC = dedent(
     Script to convert a ``DICOM`` dataset (structured as Patient-Study-Series) into a NIFTI format (with the `Patient ID` as the folder name).
     When multiple studies for the same patient are found, different **DICOM studies** are saved in different folders, appending the study index to the patient name.
     *DICOM series* for the same study are saved in the same patient folder.
+    By default, the DICOM series are converted in parallel as independent jobs (SEG series are converted after the corresponding PET series).
+    An optional DICOM index, created with ``Hive_build_DICOM_index``, can be given to avoid reading the DICOM headers again.
+    The status, Patient-Study map and conversion time of each patient are appended to a JSONL log file as soon as the patient is converted.
+    Failed patients are logged with their traceback, without stopping the conversion. With ``--resume yes``, the patients already converted are skipped.
     """  # noqa: E501
 )
 EPILOG = dedent(
@@ -28,6 +29,8 @@ EPILOG = dedent(
     Example call:
     ::
         {filename}  --data-folder /PATH/TO/DICOM_DATA --output-folder /PATH/TO/NIFTI_DATASET
+        {filename}  --data-folder /PATH/TO/DICOM_DATA --output-folder /PATH/TO/NIFTI_DATASET --dicom-index /PATH/TO/DICOM_INDEX.db
+        {filename}  --data-folder /PATH/TO/DICOM_DATA --output-folder /PATH/TO/NIFTI_DATASET --resume yes
     """.format(  # noqa: E501
         filename=Path(__file__).stem
     )
@@ -54,6 +57,73 @@ def get_arg_parser():
         help="Output folder where to save the converted NIFTI dataset.",
     )
 
+    pars.add_argument(
+        "--dicom-index",
+        type=str,
+        required=False,
+        default=None,
+        help="Optional DICOM index SQLite file, created with ``Hive_build_DICOM_index``.",
+    )
+
+    pars.add_argument(
+        "--file-extension",
+        type=str,
+        required=False,
+        choices=[".nii.gz", ".nii"],
+        default=".nii.gz",
+        help="NIFTI file extension. Use ``.nii`` to save uncompressed volumes. (Default: .nii.gz)",
+    )
+
+    pars.add_argument(
+        "--compression-level",
+        type=int,
+        required=False,
+        choices=range(1, 10),
+        metavar="[1-9]",
+        default=1,
+        help="gzip compression level for ``.nii.gz`` volumes. (Default: 1)",
+    )
+
+    pars.add_argument(
+        "--suv-type",
+        type=str,
+        required=False,
+        choices=list(SUV_TYPES) + ["none"],
+        default="bw",
+        help="SUV normalization used for the PET series: body weight, lean body mass or body surface area. If set to "
+             "``none``, the PET series are saved in Bq/ml. A SUV sidecar JSON file, with the SUV scale factors, is "
+             "saved next to each PET volume. (Default: bw)",
+    )
+
+    pars.add_argument(
+        "--parallelism",
+        type=str,
+        required=False,
+        choices=["patient", "series"],
+        default="series",
+        help="Conversion parallelism level. If set to ``series``, each DICOM series is converted as a separate job, "
+             "starting from the largest ones. If set to ``patient``, each patient is converted as a single job. "
+             "(Default: series)",
+    )
+
+    pars.add_argument(
+        "--log-file",
+        type=str,
+        required=False,
+        default=None,
+        help="JSONL file where to log the conversion status, Patient-Study map and time of each patient, as soon as the "
+             "patient is converted. (Default: ``<OUTPUT_FOLDER>_log.jsonl``)",
+    )
+
+    pars.add_argument(
+        "--resume",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", skip the patients already converted in the log file. Failed patients are converted again. '
+             "(Default: no)",
+    )
+
     pars.add_argument(
         "--n-workers",
         type=int,
@@ -75,25 +145,24 @@ def main():
         name=Path(__file__).name,
         level=log_lvl_from_verbosity_args(arguments),
     )
-    subjects = subfolders(arguments["data_folder"], join=False)
-
-    pool = Pool(int(arguments["n_workers"]))
-    Path(arguments["output_folder"]).mkdir(parents=True, exist_ok=True)
-    DICOM_to_NIFTI_conversions = []
-    for subject in subjects:
-        subject_dicom_folder = str(Path(arguments["data_folder"]).joinpath(subject))
-        subject_nifti_filename = str(Path(arguments["output_folder"]).joinpath(subject))
-        DICOM_to_NIFTI_conversions.append(
-            pool.starmap_async(
-                convert_DICOM_folder_to_NIFTI_image,
-                ((subject_dicom_folder, subject_nifti_filename),),
-            )
-        )
-
-    patients_map = {}
-    for i in tqdm(DICOM_to_NIFTI_conversions):
-        patient_study_map = i.get()
-        patients_map[list(patient_study_map[0].keys())[0]] = patient_study_map[0][list(patient_study_map[0].keys())[0]]
+    suv_type = arguments["suv_type"] if arguments["suv_type"] != "none" else None
+
+    log_file = arguments["log_file"]
+    if log_file is None:
+        log_file = str(Path(arguments["output_folder"]).parent.joinpath(Path(arguments["output_folder"]).name + "_log.jsonl"))
+
+    patients_map = convert_DICOM_dataset_to_NIFTI_dataset(
+        arguments["data_folder"],
+        arguments["output_folder"],
+        log_file,
+        arguments["dicom_index"],
+        arguments["file_extension"],
+        arguments["compression_level"],
+        suv_type,
+        arguments["parallelism"],
+        int(arguments["n_workers"]),
+        arguments["resume"],
+    )
 
     with open(Path(arguments["output_folder"]).parent.joinpath(Path(arguments["output_folder"]).name + ".json"),
               "w") as file:
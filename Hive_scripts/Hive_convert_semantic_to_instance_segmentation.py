@@ -3,13 +3,22 @@
 import datetime
 import json
 import os
+import time
 from argparse import ArgumentParser, RawTextHelpFormatter
+from multiprocessing import Pool
 from pathlib import Path
 from textwrap import dedent
+from typing import Dict, Tuple, List, Iterator
 
 from Hive.utils.file_utils import subfolders
-from Hive.utils.log_utils import add_verbosity_options_to_argparser
-from Hive.utils.seg_mask_utils import semantic_segmentation_to_instance
+from Hive.utils.log_utils import (
+    add_verbosity_options_to_argparser,
+    get_logger,
+    log_lvl_from_verbosity_args,
+    str2bool,
+)
+from Hive.utils.seg_mask_utils import semantic_segmentation_to_instance, semantic_segmentation_to_instance_per_class
+from Hive.utils.volume_cache_utils import prefetch_volumes
 
 TIMESTAMP = "{:%Y-%m-%d_%H-%M-%S}".format(datetime.datetime.now())
 
@@ -19,6 +28,11 @@ DESC = dedent(
     Instance segmentation masks are saved within the same patient folder with the standard format "INST_SEG.nii.gz". Regions in instance 
     segmentation containing less than 10 voxels are ignored and the number of labels in each instance segmentation mask is saved in a 
     separate json file ('inst_seg_labels.json') alongside its 'Patient ID'. 
+    With ``--per-class yes``, each semantic class is converted separately, and the nnDetection label JSON file (instance to class map)
+    is saved next to each instance mask.
+    Subjects are converted in parallel (with ``--n-workers 1``, the masks of the next subjects are read in background while the
+    current subject is converted), and the json file is updated as soon as each subject is converted. Subjects whose instance
+    segmentation mask is newer than the semantic segmentation mask, and already in the json file, are skipped.
     """  # noqa: E501
 )
 EPILOG = dedent(
@@ -26,11 +40,15 @@ EPILOG = dedent(
     Example call:
     ::
         {filename}  --data-folder /PATH/TO/SEMANTIC_SEG_DATA --sem-seg-suffix _SEG.nii.gz --inst-seg-suffix _INST_SEG.nii.gz --output-json-path /PATH/TO/JSON/inst_seg_labels.json
+        {filename}  --data-folder /PATH/TO/SEMANTIC_SEG_DATA --sem-seg-suffix _SEG.nii.gz --inst-seg-suffix _INST_SEG.nii.gz --output-json-path /PATH/TO/JSON/inst_seg_labels.json --n-workers 8
     """.format(  # noqa: E501
         filename=Path(__file__).stem
     )
 )
 
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
 
 def get_arg_parser():
     pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
@@ -63,32 +81,175 @@ def get_arg_parser():
         help="Output path of json file.",
     )
 
+    pars.add_argument(
+        "--memory-lean",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", the semantic masks are read without float conversion, and the instance masks are saved '
+             'with the smallest integer type holding the number of instances.',
+    )
+
+    pars.add_argument(
+        "--connectivity",
+        type=int,
+        required=False,
+        choices=[1, 2, 3],
+        default=3,
+        help="Connectivity used to label the connected regions (1: 6-connectivity, 2: 18-connectivity, "
+             "3: 26-connectivity). (Default: 3)",
+    )
+
+    pars.add_argument(
+        "--min-volume",
+        type=float,
+        required=False,
+        default=None,
+        help="Minimum region volume, in mm3. Smaller regions are ignored. (Default: 10 voxels, or no threshold with "
+             "``--per-class yes``)",
+    )
+
+    pars.add_argument(
+        "--per-class",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", each semantic class is converted separately, and the instance to class map is saved '
+             'next to each instance mask as nnDetection label JSON file.',
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker processes to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
+    pars.add_argument(
+        "--n-prefetch",
+        type=int,
+        required=False,
+        default=2,
+        help="Number of masks read in advance, when running with a single worker. (Default: 2)",
+    )
+
+    pars.add_argument(
+        "--prefetch-memory",
+        type=float,
+        required=False,
+        default=None,
+        help="Optional memory budget for the masks read in advance, in GB.",
+    )
+
     add_verbosity_options_to_argparser(pars)
 
     return pars
 
 
+def convert_subject(subject_conversion: Tuple[str, str, str, Dict[str, object]]) -> Tuple[str, int, float]:
+    subject, subject_sem_seg_filename, subject_inst_seg_filename, arguments = subject_conversion
+    start_time = time.time()
+    if arguments["per_class"]:
+        instance_class_map = semantic_segmentation_to_instance_per_class(
+            subject_sem_seg_filename,
+            subject_inst_seg_filename,
+            get_instance_json_filename(subject_inst_seg_filename),
+            arguments["connectivity"],
+            arguments["min_volume"] if arguments["min_volume"] is not None else 0.0,
+            arguments["memory_lean"],
+        )
+        num_features = len(instance_class_map)
+    else:
+        num_features = semantic_segmentation_to_instance(
+            subject_sem_seg_filename,
+            subject_inst_seg_filename,
+            arguments["memory_lean"],
+            arguments["connectivity"],
+            min_volume=arguments["min_volume"],
+        )
+    return subject, num_features, time.time() - start_time
+
+
+def iter_subject_conversions(
+        subject_conversions: List[Tuple[str, str, str, Dict[str, object]]], arguments: Dict[str, object]
+) -> Iterator[Tuple[str, int, float]]:
+    if int(arguments["n_workers"]) > 1:
+        with Pool(int(arguments["n_workers"])) as pool:
+            yield from pool.imap_unordered(convert_subject, subject_conversions)
+        return
+
+    memory_budget = None
+    if arguments["prefetch_memory"] is not None:
+        memory_budget = int(arguments["prefetch_memory"] * 1024**3)
+    for (subject, _, subject_inst_seg_filename, _), (_, subject_volumes) in zip(
+            subject_conversions,
+            prefetch_volumes(
+                [(subject, {"mask": sem_seg_filename}) for subject, sem_seg_filename, _, _ in subject_conversions],
+                arguments["n_prefetch"],
+                memory_budget,
+            ),
+    ):
+        yield convert_subject((subject, subject_volumes["mask"], subject_inst_seg_filename, arguments))
+
+
+def get_instance_json_filename(subject_inst_seg_filename: str) -> str:
+    for extension in (".nii.gz", ".nii"):
+        if subject_inst_seg_filename.endswith(extension):
+            return subject_inst_seg_filename[: -len(extension)] + ".json"
+    return subject_inst_seg_filename + ".json"
+
+
+def save_labels_json(labels_dict: Dict[str, int], out_json: str):
+    tmp_json = out_json + ".tmp"
+    with open(tmp_json, "w") as json_file:
+        json.dump(labels_dict, json_file)
+    os.replace(tmp_json, out_json)
+
+
 def main():
     parser = get_arg_parser()
     arguments = vars(parser.parse_args())
 
+    logger = get_logger(
+        name=Path(__file__).name,
+        level=log_lvl_from_verbosity_args(arguments),
+    )
+
     subjects = subfolders(arguments["data_folder"], join=False)
     sem_seg = arguments["sem_seg_suffix"]
     inst_seg = arguments["inst_seg_suffix"]
     out_json = arguments["output_json_path"]
 
-    # e.g. subject + sem_seg = "PETCT_0011f3deaf_0_SEG.nii.gz"
     labels_dict = {}
+    if Path(out_json).is_file():
+        with open(out_json, "r") as json_file:
+            labels_dict = json.load(json_file)
+
+    # e.g. subject + sem_seg = "PETCT_0011f3deaf_0_SEG.nii.gz"
+    subject_conversions = []
     for subject in subjects:
         subject_sem_seg_filename = os.path.join(arguments["data_folder"], subject, str(subject + sem_seg))
         subject_inst_seg_filename = os.path.join(arguments["data_folder"], subject, str(subject + inst_seg))
-        num_features = semantic_segmentation_to_instance(subject_sem_seg_filename, subject_inst_seg_filename)
-        labels_dict.update({str(subject): num_features})
-        print("Subject: ", subject, " converted mask done.")
+        if (
+                str(subject) in labels_dict
+                and Path(subject_inst_seg_filename).is_file()
+                and os.path.getmtime(subject_inst_seg_filename) >= os.path.getmtime(subject_sem_seg_filename)
+        ):
+            logger.debug("Subject {}: instance mask up to date, skipping".format(subject))
+            continue
+        subject_conversions.append((str(subject), subject_sem_seg_filename, subject_inst_seg_filename, arguments))
+    logger.info(
+        "Converting {} subjects ({} up to date)".format(len(subject_conversions), len(subjects) - len(subject_conversions))
+    )
 
-    # Create Json file with number of labels of instance segmentation for each patient.
-    with open(out_json, 'w') as json_file:
-        json.dump(labels_dict, json_file)
+    # Update the Json file with number of labels of instance segmentation for each patient, as soon as it is converted.
+    for subject, num_features, elapsed_time in iter_subject_conversions(subject_conversions, arguments):
+        labels_dict[subject] = num_features
+        save_labels_json(labels_dict, out_json)
+        logger.info("Subject {}: {} instances, converted in {:.2f} s".format(subject, num_features, elapsed_time))
+
+    save_labels_json(labels_dict, out_json)
 
 
 if __name__ == "__main__":
@@ -2,13 +2,14 @@
 
 import datetime
 import json
-import random
-import shutil
+import os
 from argparse import ArgumentParser, RawTextHelpFormatter
 from pathlib import Path
 from textwrap import dedent
 
-from Hive.utils.log_utils import add_verbosity_options_to_argparser
+from Hive.utils.dicom_utils import query_dicom_index_patients
+from Hive.utils.file_utils import COPY_MODES, copy_subject_folder_to_data_folder, index_dataset_folder, select_stratified_subset
+from Hive.utils.log_utils import add_verbosity_options_to_argparser, get_logger, log_lvl_from_verbosity_args
 
 TIMESTAMP = "{:%Y-%m-%d_%H-%M-%S}".format(datetime.datetime.now())
 
@@ -16,52 +17,78 @@ DESC = dedent(
     """
     Generates and saves a subset, given a dataset. The subset data are extracted from the original dataset according to the
     provided ``classes``. A JSON file mapping each subject to the corresponding class is needed ( ``data_class_file``).
-    An optional parameter ``max_size`` can be specified to limit the size of the subset.
+    An optional parameter ``max_size`` can be specified to limit the size of the subset: in this case, each class contributes
+    to the subset proportionally to its size. The selection is reproducible, given the same ``seed``.
+    Subject folders can be copied, hardlinked or symlinked ( ``copy-mode`` ).
+    For DICOM datasets, an optional DICOM index ( ``dicom-index``, created with ``Hive_build_DICOM_index``) can be used to restrict
+    the selection to the patients including all the given ``modalities``, without reading any DICOM header.
     """  # noqa: E501
 )
 EPILOG = dedent(
     """
     {filename} --data-folder /PATH/TO/DATASET --output-folder /PATH/TO/SUBSET --data-class-file /PATH/TO/SUBJECT_CLASSES.json --subclasses CLASS_1
     {filename} --data-folder /PATH/TO/DATASET --output-folder /PATH/TO/SUBSET --data-class-file /PATH/TO/SUBJECT_CLASSES.json --subclasses CLASS_1 --max-size 100
+    {filename} --data-folder /PATH/TO/DATASET --output-folder /PATH/TO/SUBSET --data-class-file /PATH/TO/SUBJECT_CLASSES.json --subclasses CLASS_1 CLASS_2 --max-size 100 --seed 42 --copy-mode hardlink --n-workers 8
+    {filename} --data-folder /PATH/TO/DICOM_DATASET --output-folder /PATH/TO/SUBSET --data-class-file /PATH/TO/SUBJECT_CLASSES.json --subclasses CLASS_1 --dicom-index /PATH/TO/DICOM_INDEX.sqlite --modalities CT PT
     """.format(  # noqa: E501
         filename=Path(__file__).stem
     )
 )
 
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
 
 def main():
     parser = get_arg_parser()
 
     arguments = vars(parser.parse_args())
+    if arguments["modalities"] is not None and arguments["dicom_index"] is None:
+        parser.error("--modalities requires --dicom-index")
+
+    logger = get_logger(
+        name=Path(__file__).name,
+        level=log_lvl_from_verbosity_args(arguments),
+    )
 
     with open(arguments["data_class_file"], "r") as fp:
         data_class_dict = json.load(fp)
 
-    count = 0
+    dataset_index = index_dataset_folder(arguments["data_folder"])
+    missing_patients = [patient for patient in data_class_dict if patient not in dataset_index]
+    if len(missing_patients) > 0:
+        logger.warning("{} subjects are not found in {}: skipping them".format(len(missing_patients), arguments["data_folder"]))
+
+    if arguments["dicom_index"] is not None:
+        indexed_patients = set(query_dicom_index_patients(arguments["dicom_index"], arguments["modalities"]))
+        logger.info(
+            "{} subjects in the DICOM index include the modalities {}".format(len(indexed_patients), arguments["modalities"])
+        )
+        data_class_dict = {patient: data_class_dict[patient] for patient in data_class_dict if patient in indexed_patients}
 
-    classes = arguments["subclasses"]
     max_size = arguments["max_size"]
-    Path(arguments["output_folder"]).mkdir(parents=True, exist_ok=True)
-    if max_size is None:
-        max_size = len(data_class_dict)
+    if max_size is not None:
+        max_size = int(max_size)
 
-    patients = list(data_class_dict.keys())
+    patients = select_stratified_subset(
+        data_class_dict, arguments["subclasses"], max_size, arguments["seed"], dataset_index=dataset_index
+    )
+    logger.info("Selected {} subjects".format(len(patients)))
 
-    random.shuffle(patients)
+    patients = [patient for patient in patients if not Path(arguments["output_folder"]).joinpath(patient).is_dir()]
 
-    for patient in patients:
-        if data_class_dict[patient] in classes and count <= int(max_size):
-            if Path(arguments["output_folder"]).joinpath(patient).is_dir():
-                ...
-            else:
-                shutil.copytree(
-                    Path(arguments["data_folder"]).joinpath(patient), Path(arguments["output_folder"]).joinpath(patient)
-                )
-            count += 1
+    copy_subject_folder_to_data_folder(
+        arguments["data_folder"],
+        patients,
+        arguments["output_folder"],
+        num_threads=int(arguments["n_workers"]),
+        copy_mode=arguments["copy_mode"],
+        dataset_index=dataset_index,
+    )
 
 
 def get_arg_parser():
-    pars = ArgumentParser(description=DESC, formatter_class=RawTextHelpFormatter)
+    pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
 
     pars.add_argument(
         "--data-folder",
@@ -99,6 +126,49 @@ def get_arg_parser():
         help="Maximum size of the generated subset. Default ``None```: no size limit is set.",
     )
 
+    pars.add_argument(
+        "--seed",
+        type=int,
+        required=False,
+        default=0,
+        help="Random seed used to select the subset. (Default: 0)",
+    )
+
+    pars.add_argument(
+        "--dicom-index",
+        type=str,
+        required=False,
+        default=None,
+        help="Optional DICOM index SQLite file, created with ``Hive_build_DICOM_index``, used to filter the subjects by "
+             "``--modalities``.",
+    )
+
+    pars.add_argument(
+        "--modalities",
+        type=str,
+        nargs="+",
+        required=False,
+        default=None,
+        help="Modalities (e.g. CT PT) required in the selected subjects, queried from the DICOM index.",
+    )
+
+    pars.add_argument(
+        "--copy-mode",
+        type=str,
+        required=False,
+        choices=COPY_MODES,
+        default="copy",
+        help="How the subject files are materialized in the subset folder. (Default: copy)",
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker threads to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
     add_verbosity_options_to_argparser(pars)
 
     return pars
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import json
+import os
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from textwrap import dedent
+
+from Hive.utils.dicom_utils import query_dicom_index
+from Hive.utils.file_utils import export_nifti_preds_to_dicom_seg, get_source_series_files, subfiles
+from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args
+
+DESC = dedent(
+    """
+    Script to export a folder of NIFTI predictions (segmentation masks) as DICOM SEG files, referencing the original DICOM series.
+    Each prediction file (``<SUBJECT><PREDICTION_SUFFIX>``) is matched to the original Patient and Study through the Patient-Study
+    map JSON file, created by ``Hive_convert_DICOM_dataset_to_NIFTI_dataset``, and to the source DICOM series (the first non-SEG
+    series in the Study) through the DICOM index, created with ``Hive_build_DICOM_index``.
+    The conversions run in parallel, loading the DICOM SEG template once for each worker.
+    """  # noqa: E501
+)
+EPILOG = dedent(
+    """
+    Example call:
+    ::
+        {filename} --prediction-folder /PATH/TO/PREDICTIONS --patient-study-map /PATH/TO/NIFTI_DATASET.json --dicom-index /PATH/TO/DICOM_INDEX.db --template-file /PATH/TO/TEMPLATE.json --output-folder /PATH/TO/DICOM_SEG
+        {filename} --prediction-folder /PATH/TO/PREDICTIONS --patient-study-map /PATH/TO/NIFTI_DATASET.json --dicom-index /PATH/TO/DICOM_INDEX.db --template-file /PATH/TO/TEMPLATE.json --output-folder /PATH/TO/DICOM_SEG --n-workers 8
+    """.format(  # noqa: E501
+        filename=Path(__file__).stem
+    )
+)
+
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
+
+def main():
+    parser = get_arg_parser()
+
+    arguments = vars(parser.parse_args())
+
+    logger = get_logger(
+        name=Path(__file__).name,
+        level=log_lvl_from_verbosity_args(arguments),
+    )
+
+    with open(arguments["patient_study_map"]) as json_file:
+        patients_map = json.load(json_file)
+
+    subject_studies = {}
+    for patient, patient_studies in patients_map.items():
+        for study_id, study in patient_studies.items():
+            subject = patient if len(patient_studies) == 1 else "{}_{}".format(patient, study_id)
+            subject_studies[subject] = (patient, study)
+
+    Path(arguments["output_folder"]).mkdir(parents=True, exist_ok=True)
+    export_jobs = []
+    for prediction_file in subfiles(arguments["prediction_folder"], join=False, suffix=arguments["prediction_suffix"]):
+        subject = prediction_file[: -len(arguments["prediction_suffix"])]
+        if subject not in subject_studies:
+            logger.warning("{} not found in the Patient-Study map: skipping".format(subject))
+            continue
+        patient, study = subject_studies[subject]
+        source_dicom_files = get_source_series_files(query_dicom_index(arguments["dicom_index"], patient=patient), study=study)
+        if source_dicom_files is None:
+            logger.warning("No source DICOM series found for {}: skipping".format(subject))
+            continue
+        export_jobs.append(
+            {
+                "nifti_pred_file": str(Path(arguments["prediction_folder"]).joinpath(prediction_file)),
+                "source_dicom_files": source_dicom_files,
+                "output_dicom_seg": str(Path(arguments["output_folder"]).joinpath(subject + arguments["output_suffix"])),
+            }
+        )
+
+    export_nifti_preds_to_dicom_seg(export_jobs, arguments["template_file"], int(arguments["n_workers"]))
+
+
+def get_arg_parser():
+    pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
+
+    pars.add_argument(
+        "--prediction-folder",
+        type=str,
+        required=True,
+        help="Folder including the NIFTI predictions.",
+    )
+
+    pars.add_argument(
+        "--patient-study-map",
+        type=str,
+        required=True,
+        help="Patient-Study map JSON file, created by ``Hive_convert_DICOM_dataset_to_NIFTI_dataset``.",
+    )
+
+    pars.add_argument(
+        "--dicom-index",
+        type=str,
+        required=True,
+        help="DICOM index SQLite file, created with ``Hive_build_DICOM_index``.",
+    )
+
+    pars.add_argument(
+        "--template-file",
+        type=str,
+        required=True,
+        help="DICOM SEG Template JSON file. Generated from : http://qiicr.org/dcmqi/#/home",
+    )
+
+    pars.add_argument(
+        "--output-folder",
+        type=str,
+        required=True,
+        help="Output folder where to save the DICOM SEG files.",
+    )
+
+    pars.add_argument(
+        "--prediction-suffix",
+        type=str,
+        required=False,
+        default=".nii.gz",
+        help="Filename suffix of the NIFTI predictions, following the subject name. (Default: .nii.gz)",
+    )
+
+    pars.add_argument(
+        "--output-suffix",
+        type=str,
+        required=False,
+        default="_SEG.dcm",
+        help="Filename suffix of the DICOM SEG files, following the subject name. (Default: _SEG.dcm)",
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker processes to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
+    add_verbosity_options_to_argparser(pars)
+
+    return pars
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,21 @@
 #!/usr/bin/env python
 
 import json
+import os
 from argparse import ArgumentParser, RawTextHelpFormatter
-from distutils.dir_util import copy_tree
 from pathlib import Path
 from textwrap import dedent
 
 # from old_src.evaluation import get_results_summary_filepath
-from Hive.utils.file_utils import subfolders
+from Hive.utils.file_utils import sync_folder_tree
 from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args
 
 DESC = dedent(
     """
     Script used to copy and save Experiment predictions, from the original experiment folder to the specified output folder.
+    The consolidated predictions are saved in the ``validation`` folder, while the predictions for each fold ``N`` (selected
+    with ``--folds``) are saved in the ``validation_fold_N`` folder.
+    Files already exported, with unchanged size and modification time, are skipped. The files can optionally be hardlinked.
     """  # noqa: E501 W291 W605
 )
 EPILOG = dedent(
@@ -20,11 +23,16 @@ EPILOG = dedent(
     Example call:
     ::
         {filename} --config-file /path/to/config_file.json --output-experiment-folder /home/Experiment_Predictions
+        {filename} --config-file /path/to/config_file.json --output-experiment-folder /home/Experiment_Predictions --folds -1 0 1 2 3 4 --n-workers 8
+        {filename} --config-file /path/to/config_file.json --output-experiment-folder /home/Experiment_Predictions --copy-mode hardlink
     """.format(  # noqa: E501 W291
         filename=Path(__file__).name
     )
 )
 
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
 
 def get_arg_parser():
     pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
@@ -43,6 +51,32 @@ def get_arg_parser():
         help="Folder path to set the output experiment folder.",
     )
 
+    pars.add_argument(
+        "--folds",
+        type=str,
+        nargs="+",
+        required=False,
+        default=["-1"],
+        help="Indexes of the folds to export. If set to ``-1``, the consolidated predictions are exported. (Default: -1)",
+    )
+
+    pars.add_argument(
+        "--copy-mode",
+        type=str,
+        required=False,
+        choices=["copy", "hardlink"],
+        default="copy",
+        help="How the prediction files are exported: copied or hardlinked. (Default: copy)",
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker threads to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
     add_verbosity_options_to_argparser(pars)
     return pars
 
@@ -52,7 +86,7 @@ def main():
 
     args = vars(parser.parse_args())
 
-    logger = get_logger(  # NOQA: F841
+    logger = get_logger(
         name=Path(__file__).name,
         level=log_lvl_from_verbosity_args(args),
     )
@@ -62,26 +96,31 @@ def main():
 
     output_path = args["output_experiment_folder"]
 
-    sections = ["validation"]
+    for fold in args["folds"]:
+        if fold == "-1":
+            section = "validation"
+            fold_folder = "consolidated"
+        else:
+            section = "validation_fold_{}".format(fold)
+            fold_folder = "fold{}".format(fold)
 
-    for section in sections:
         prediction_directory_out = Path(output_path).joinpath(
             "Task" + config_dict["Task_ID"] + "_{}".format(config_dict["Task_Name"]), section
         )
-        prediction_directory_out.mkdir(parents=True, exist_ok=True)
         prediction_directory = Path(config_dict["results_folder"]).joinpath(
             "Task" + config_dict["Task_ID"] + "_{}".format(config_dict["Task_Name"]),
             "RetinaUNetV001_D3V001_3d",
-            "consolidated",
+            fold_folder,
             "val_predictions_nii",
         )
         if prediction_directory.is_dir():
-            subject_predictions = subfolders(prediction_directory, join=False)
-            for subject_prediction in subject_predictions:
-                copy_tree(
-                    str(Path(prediction_directory).joinpath(subject_prediction)),
-                    str(Path(prediction_directory_out).joinpath(subject_prediction)),
-                )
+            logger.info("Exporting predictions from {}".format(prediction_directory))
+            copied_files = sync_folder_tree(
+                prediction_directory, prediction_directory_out, int(args["n_workers"]), args["copy_mode"]
+            )
+            logger.info("{} files exported to {}".format(copied_files, prediction_directory_out))
+        else:
+            logger.warning("{} is not found: skipping fold {}".format(prediction_directory, fold))
 
 
 if __name__ == "__main__":
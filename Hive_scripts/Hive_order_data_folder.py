@@ -13,6 +13,9 @@ from Hive.utils.log_utils import (
     str2bool,
 )
 
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
 DESC = dedent(
     """
     Order Dataset folder creating and moving the files in the corresponding patient subdirectories
@@ -23,7 +26,11 @@ DESC = dedent(
     Example:
         --patient-suffix _image.nii.gz
         PatientA_image.nii.gz  -> [patient_ID = PatientA]
+    The files are first collected from the input folder sub-folders ( <input_dir>/<folder>/<file> ) into the output folder.
+    If --assign-parent-dir-name [yes/no] is set to 'yes', the files one level deeper ( <input_dir>/<folder>/<subfolder>/<file> ) are
+    collected instead, appending the <subfolder> name to the filename. Entries at other depths are left in place.
     If -in-place [yes/no] is set to 'yes', --output-folder is not considered and the folder ordering is performed on the input folder
+    If --dry-run [yes/no] is set to 'yes', the planned file moves are logged and no file is moved.
     """  # noqa: E501
 )
 EPILOG = dedent(
@@ -99,6 +106,22 @@ def get_arg_parser():
              'the files for the same patient are saved in different folders ("image", "mask"), with the same name',
     )
 
+    parser.add_argument(
+        "--dry-run",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", the planned file moves are only logged, without moving any file.',
+    )
+
+    parser.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker threads used to move the files. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
     add_verbosity_options_to_argparser(parser)
 
     return parser
@@ -118,11 +141,13 @@ def main():
 
     if args['assign_parent_dir_name']:
         order_data_in_single_folder(args["input_folder"], args["output_folder"], True,
-                                    file_extension=args['file_extension'])
+                                    file_extension=args['file_extension'], num_threads=int(args["n_workers"]),
+                                    dry_run=args["dry_run"])
     else:
-        order_data_in_single_folder(args["input_folder"], args["output_folder"])
-    if args["create_subject_subfolders"]:
-        order_data_folder_by_patient(args["output_folder"], args["patient_suffix"])
+        order_data_in_single_folder(args["input_folder"], args["output_folder"], num_threads=int(args["n_workers"]),
+                                    dry_run=args["dry_run"])
+    if args["create_subject_subfolders"] and not args["dry_run"]:
+        order_data_folder_by_patient(args["output_folder"], args["patient_suffix"], int(args["n_workers"]))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os
+import sys
+from argparse import ArgumentParser, RawTextHelpFormatter
+from pathlib import Path
+from textwrap import dedent
+
+from Hive.utils.integrity_utils import verify_dataset_folder
+from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args, str2bool
+
+DESC = dedent(
+    """
+    Verify a prepared dataset folder (``imagesTr``, ``labelsTr``, ``imagesTs`` and ``labelsTs``, as created by ``nndet_prepare_data_folder``),
+    from the NIFTI headers, without loading the voxel data. Truncated files are detected from the file size (or, for compressed files,
+    from the uncompressed size stored in the gzip trailer); with ``--verify-gzip yes``, compressed files are also fully
+    stream-decompressed, to detect corrupt files. For each case, every modality file (``_0000``, ``_0001``, ...)
+    and the label file must exist and decode, and share the same shape and affine; the label data type is also checked, together
+    with the nnDetection label JSON file, if present. The expected number of modalities is read from ``dataset.json``.
+    Optionally, the checksums of all the files are computed (``--checksum``). The cases are verified in parallel, and the report
+    is saved as JSON file. The script exits with an error code if any case fails.
+    """  # noqa: E501
+)
+EPILOG = dedent(
+    """
+    Example call:
+    ::
+        {filename} --dataset-folder /PATH/TO/Task000_Example/raw_splitted --output-json /PATH/TO/verification_report.json
+        {filename} --dataset-folder /PATH/TO/Task000_Example/raw_splitted --output-json /PATH/TO/verification_report.json --checksum sha256 --n-workers 16
+    """.format(  # noqa: E501
+        filename=Path(__file__).stem
+    )
+)
+
+if "N_THREADS" not in os.environ:
+    os.environ["N_THREADS"] = "1"
+
+
+def main():
+    parser = get_arg_parser()
+
+    arguments = vars(parser.parse_args())
+
+    logger = get_logger(
+        name=Path(__file__).name,
+        level=log_lvl_from_verbosity_args(arguments),
+    )
+
+    report = verify_dataset_folder(
+        arguments["dataset_folder"],
+        arguments["output_json"],
+        arguments["file_extension"],
+        int(arguments["n_workers"]),
+        arguments["checksum"],
+        arguments["affine_tolerance"],
+        arguments["verify_gzip"],
+    )
+
+    if report["n_failed_cases"] > 0:
+        logger.error(
+            "{} of {} cases failed the verification: {}".format(
+                report["n_failed_cases"], report["n_cases"], report["failed_cases"]
+            )
+        )
+        return 1
+    logger.info("{} cases verified".format(report["n_cases"]))
+    return 0
+
+
+def get_arg_parser():
+    pars = ArgumentParser(description=DESC, epilog=EPILOG, formatter_class=RawTextHelpFormatter)
+
+    pars.add_argument(
+        "--dataset-folder",
+        type=str,
+        required=True,
+        help="Dataset folder, including the ``imagesTr``, ``labelsTr``, ``imagesTs`` and ``labelsTs`` folders.",
+    )
+
+    pars.add_argument(
+        "--output-json",
+        type=str,
+        required=True,
+        help="Output JSON file where to save the verification report.",
+    )
+
+    pars.add_argument(
+        "--file-extension",
+        type=str,
+        required=False,
+        default=".nii.gz",
+        help="NIFTI file extension. (Default: .nii.gz)",
+    )
+
+    pars.add_argument(
+        "--checksum",
+        type=str,
+        required=False,
+        choices=["sha256", "sha1", "md5", "blake2b", "xxhash"],
+        default=None,
+        help="Optional checksum algorithm, used to compute the checksum of each file (``xxhash`` requires the xxhash package).",
+    )
+
+    pars.add_argument(
+        "--affine-tolerance",
+        type=float,
+        required=False,
+        default=1e-3,
+        help="Absolute tolerance when comparing the image and label affines. (Default: 1e-3)",
+    )
+
+    pars.add_argument(
+        "--verify-gzip",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", stream-decompress the ``.gz`` files (in the same pass as the checksum), to detect corrupt '
+             'files. If set to "no", only the headers and the gzip trailers are read. (Default: no)',
+    )
+
+    pars.add_argument(
+        "--n-workers",
+        type=int,
+        required=False,
+        default=os.environ["N_THREADS"],
+        help="Number of worker threads to use. (Default: {})".format(os.environ["N_THREADS"]),
+    )
+
+    add_verbosity_options_to_argparser(pars)
+
+    return pars
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,13 +13,14 @@ from textwrap import dedent
 
 import Hive.configs
 from Hive.utils.file_utils import (
+    COPY_MODES,
     create_nndet_data_folder_tree,
     split_dataset,
     copy_data_to_dataset_folder,
     save_config_json,
     generate_dataset_json,
 )
-from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args
+from Hive.utils.log_utils import get_logger, add_verbosity_options_to_argparser, log_lvl_from_verbosity_args, str2bool
 
 TIMESTAMP = "{:%Y-%m-%d_%H-%M-%S}".format(datetime.datetime.now())
 
@@ -28,7 +29,10 @@ DESC = dedent(
     Prepare Dataset folder according to the nnDetection specifications, creating and populating the subfolders ``imagesTr``,
     ``labelsTr``, ``imagesTs`` and ``labelsTs``. In addition, a JSON instance configuration file (as required by nnDetection)
     for each label mask is generated, alongside a summary of the train/test split of the dataset.
-    The label mask images are expected to be as instance segmentation masks (NOT semantic segmentation representations).
+    The label mask images are expected to be as instance segmentation masks (NOT semantic segmentation representations), unless
+    ``--semantic-labels yes`` is set: in this case, each semantic label is converted into instances of the corresponding class.
+    Each label mask is decoded once, computing the instance mask, the JSON instance configuration file and the instance bounding
+    boxes and voxel counts in the same pass.
     """  # noqa: E501
 )
 EPILOG = dedent(
@@ -124,6 +128,8 @@ def main():
         config_dict,
         Path(dataset_path).joinpath("labelsTr"),
         save_label_instance_config=True,
+        copy_mode=arguments["copy_mode"],
+        semantic_labels=arguments["semantic_labels"],
     )
     copy_data_to_dataset_folder(
         arguments["input_data_folder"],
@@ -132,6 +138,8 @@ def main():
         config_dict,
         Path(dataset_path).joinpath("labelsTs"),
         save_label_instance_config=True,
+        copy_mode=arguments["copy_mode"],
+        semantic_labels=arguments["semantic_labels"],
     )
 
     generate_dataset_json(
@@ -215,6 +223,25 @@ def get_arg_parser():
         help="Configuration JSON file with experiment and dataset parameters.",
     )
 
+    pars.add_argument(
+        "--copy-mode",
+        type=str,
+        required=False,
+        choices=COPY_MODES,
+        default="copy",
+        help="How the image files are materialized in the dataset folder: copied, hardlinked or symlinked. "
+             "(Default: copy)",
+    )
+
+    pars.add_argument(
+        "--semantic-labels",
+        type=str2bool,
+        required=False,
+        default="no",
+        help='If set to "yes", the label masks are converted from semantic to instance segmentation, assigning the instances '
+             "of each semantic label to the corresponding class. (Default: no)",
+    )
+
     add_verbosity_options_to_argparser(pars)
 
     return pars
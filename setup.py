@@ -61,6 +61,11 @@ setup(
             "Hive_extract_experiment_predictions = Hive_scripts.Hive_extract_experiment_predictions:main",
             "nndet_compute_metric_results = Hive_scripts.nndet_compute_metric_results:main",
             "Hive_order_data_folder = Hive_scripts.Hive_order_data_folder:main",
+            "Hive_build_DICOM_index = Hive_scripts.Hive_build_DICOM_index:main",
+            "Hive_compute_PET_SUV = Hive_scripts.Hive_compute_PET_SUV:main",
+            "Hive_export_predictions_to_DICOM_SEG = Hive_scripts.Hive_export_predictions_to_DICOM_SEG:main",
+            "Hive_compute_dataset_fingerprint = Hive_scripts.Hive_compute_dataset_fingerprint:main",
+            "Hive_verify_dataset = Hive_scripts.Hive_verify_dataset:main",
         ],
     },
     keywords=["deep learning", "image segmentation", "medical image analysis", "medical image segmentation",